@@ -0,0 +1,195 @@
+#!/usr/bin/env python2
+
+"""Benchmark of the size on disk of saved itineraries, versus the time to
+save and load them:- as a file per trip or in an itin_store, each either
+as plain JSON, zlib-compressed, or compressed with the base or a names
+itin_codec dictionary.
+
+Itineraries are fake_otp_server synthetic ones, with agency and route
+names drawn from pools of --agencies and --routes names. Loads are timed
+with trip_itins_io.load_trip_itineraries(), after the files have just been
+written (so from the page cache).
+
+Example:
+    python bench_itin_storage.py --itins 20000 --routes 400
+"""
+
+import os, os.path
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from pyOTPA import itin_codec
+from pyOTPA import itin_store
+from pyOTPA import trip_itins_io
+from pyOTPA import TripItinerary
+from pyOTPA.Benchmarks import fake_otp_server
+
+BENCH_START_DT = datetime(2015, 2, 16, 7, 0)
+GRAPH_NAME = "bench_graph"
+
+# (name, use itin_store, compress, zdict type)
+STORAGE_SCENARIOS = [
+    ("files_json", False, False, None),
+    ("files_zlib", False, True, None),
+    ("files_zdict_base", False, True, 'base'),
+    ("files_zdict_names", False, True, 'names'),
+    ("store_json", True, False, None),
+    ("store_zlib", True, True, None),
+    ("store_zdict_base", True, True, 'base'),
+    ("store_zdict_names", True, True, 'names'),
+    ]
+
+class _FakeItinConfig:
+    def __init__(self, n_transit_legs, geometry_points):
+        self.n_transit_legs = n_transit_legs
+        self.geometry_points = geometry_points
+
+def make_bench_itins(n_itins, n_agencies, n_routes, keep_geometry, seed):
+    """Returns a dict of trip ID to itinerary JSON data."""
+    rand = random.Random(seed)
+    agency_names = ["Transit Agency %d" % ii for ii in range(n_agencies)]
+    route_names = [("%d" % (100 + ii),
+        "Route %d - City via Suburb %d" % (100 + ii, ii)) \
+        for ii in range(n_routes)]
+    itin_jsons = {}
+    for ii in range(n_itins):
+        config = _FakeItinConfig(rand.randint(1, 3),
+            20 if keep_geometry else 0)
+        from_lat_lon = (-38.0 + rand.random() * 0.3,
+            144.8 + rand.random() * 0.4)
+        to_lat_lon = (-38.0 + rand.random() * 0.3,
+            144.8 + rand.random() * 0.4)
+        start_dt = BENCH_START_DT + timedelta(minutes=rand.randint(0, 120))
+        itin_json = fake_otp_server.make_synthetic_itinerary(config,
+            from_lat_lon, to_lat_lon, start_dt)
+        for leg in itin_json['legs']:
+            if not keep_geometry:
+                del leg['legGeometry']
+            if 'agencyName' in leg:
+                # Route popularity is skewed, as in real networks.
+                route_i = min(int(rand.expovariate(5.0 / n_routes)),
+                    n_routes - 1)
+                leg['agencyName'] = agency_names[route_i % n_agencies]
+                leg['agencyId'] = "A%d" % (route_i % n_agencies)
+                leg['routeId'] = "R%d" % route_i
+                leg['routeShortName'], leg['routeLongName'] = \
+                    route_names[route_i]
+        itin_jsons["%08d" % ii] = itin_json
+    return itin_jsons
+
+def get_dir_size(dir_name):
+    """Returns the total size of the files in dir_name, and the disk space
+    they use (in whole blocks)."""
+    total_bytes = 0
+    total_disk_bytes = 0
+    for fname in os.listdir(dir_name):
+        stat = os.stat(os.path.join(dir_name, fname))
+        total_bytes += stat.st_size
+        total_disk_bytes += stat.st_blocks * 512
+    return total_bytes, total_disk_bytes
+
+def run_scenario(output_base_dir, itin_jsons, use_store, compress,
+        zdict_type, verbose):
+    graph_dir = os.path.join(output_base_dir, GRAPH_NAME)
+    shutil.rmtree(graph_dir, True)
+    os.makedirs(graph_dir)
+    trip_results = dict((trip_id, TripItinerary.TripItinerary(itin_json)) \
+        for trip_id, itin_json in itin_jsons.iteritems())
+
+    start_time = time.time()
+    if zdict_type == 'names':
+        zdict = itin_codec.build_names_zdict(itin_jsons.itervalues())
+        itin_codec.save_zdict(zdict, graph_dir)
+    elif zdict_type == 'base':
+        zdict = itin_codec.BASE_ZDICT
+    if use_store:
+        writer = itin_store.ItinStoreWriter(graph_dir, compress=compress,
+            zdict=zdict if zdict_type else None)
+        for trip_id, trip_itin in sorted(trip_results.iteritems()):
+            writer.append(trip_id, trip_itin, flush=False)
+        writer.close()
+    else:
+        for trip_id, trip_itin in sorted(trip_results.iteritems()):
+            trip_itin.save_to_file(os.path.join(graph_dir,
+                "%s.json" % trip_id), compress,
+                zdict if zdict_type else None)
+    save_elapsed = time.time() - start_time
+    del trip_results
+
+    total_bytes, total_disk_bytes = get_dir_size(graph_dir)
+
+    stdout = sys.stdout
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        start_time = time.time()
+        loaded = trip_itins_io.load_trip_itineraries(output_base_dir,
+            [GRAPH_NAME])[GRAPH_NAME]
+        load_elapsed = time.time() - start_time
+    finally:
+        if not verbose:
+            sys.stdout.close()
+            sys.stdout = stdout
+    if len(loaded) != len(itin_jsons):
+        print "Error:- loaded %d itineraries, but saved %d." \
+            % (len(loaded), len(itin_jsons))
+    return total_bytes, total_disk_bytes, save_elapsed, load_elapsed
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--itins', type='int', default=10000,
+        help="Number of itineraries to save and load.")
+    parser.add_option('--agencies', type='int', default=5)
+    parser.add_option('--routes', type='int', default=300)
+    parser.add_option('--keep_geometry', action='store_true', default=False,
+        help="Keep legs' geometry (as if saved without a plan projection).")
+    parser.add_option('--scenario', dest='scenarios', action='append',
+        help="Storage scenario to run (repeatable; default all). One of: "\
+            + ", ".join(name for name, use_store, compress, zdict_type \
+                in STORAGE_SCENARIOS))
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--output_dir',
+        help="Dir to save itineraries in (default a temporary dir).")
+    parser.add_option('--verbose', action='store_true', default=False)
+    options, args = parser.parse_args()
+
+    scenarios = STORAGE_SCENARIOS
+    if options.scenarios:
+        scenarios = [scenario for scenario in STORAGE_SCENARIOS \
+            if scenario[0] in options.scenarios]
+        if len(scenarios) != len(options.scenarios):
+            parser.error("unknown scenario in %s." % options.scenarios)
+
+    itin_jsons = make_bench_itins(options.itins, options.agencies,
+        options.routes, options.keep_geometry, options.seed)
+    if options.output_dir:
+        output_base_dir = options.output_dir
+        remove_output = False
+    else:
+        output_base_dir = tempfile.mkdtemp(prefix="bench_itin_storage-")
+        remove_output = True
+
+    print "Saving and loading %d itineraries:" % options.itins
+    print "%-18s %10s %10s %7s %8s %8s %9s" % ("scenario", "bytes",
+        "disk_bytes", "B/itin", "save_s", "load_s", "itins/s")
+    try:
+        for name, use_store, compress, zdict_type in scenarios:
+            total_bytes, total_disk_bytes, save_elapsed, load_elapsed = \
+                run_scenario(output_base_dir, itin_jsons, use_store,
+                    compress, zdict_type, options.verbose)
+            print "%-18s %10d %10d %7.0f %8.2f %8.2f %9.0f" % (name,
+                total_bytes, total_disk_bytes,
+                total_bytes / float(options.itins), save_elapsed,
+                load_elapsed, options.itins / load_elapsed)
+    finally:
+        if remove_output:
+            shutil.rmtree(output_base_dir, True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python2
+
+"""Benchmarks of routing (and isochrone download) throughput, run against a
+local fake_otp_server, so different routing modes can be compared
+reproducibly without needing a real OTP server.
+
+Each scenario is run in its own child process (so that its memory use can
+be measured separately), against a single fake server run by the parent.
+For each, reports requests/sec, request latency percentiles, and the peak
+memory used by the process.
+
+Example:
+    python bench_routing.py --trips 2000 --latency 0.05 \\
+        --scenario serial --scenario concurrent_8
+"""
+
+import os.path
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import resource
+import threading
+import subprocess
+from datetime import datetime, timedelta
+from optparse import OptionParser, SUPPRESS_HELP
+
+from pyOTPA import Trip
+from pyOTPA import http_pool
+from pyOTPA.TripRunner import otp_router
+from pyOTPA.TripRunner import rate_control
+from pyOTPA.TripRunner import plan_projection
+from pyOTPA.TripRunner import request_planning
+from pyOTPA.Benchmarks import fake_otp_server
+
+# Printed by child processes before their JSON-encoded results.
+RESULT_LINE_PREFIX = "BENCH_RESULT "
+
+BENCH_ROUTING_PARAMS = {
+    'arriveBy': 'false',
+    'maxWalkDistance': 2000,
+    'mode': 'TRANSIT,WALK',
+    'optimize': 'QUICK',
+    }
+# Area trips are generated in:- roughly metropolitan Melbourne.
+BENCH_BBOX = ((144.8, -38.0), (145.2, -37.7))
+BENCH_START_DT = datetime(2015, 2, 16, 7, 0)
+BENCH_DEPARTURE_WINDOW_MINS = 120
+ISO_BENCH_LOCATIONS = 5
+
+def _scenario_serial(options):
+    return {'max_in_flight': 1}
+
+def _scenario_concurrent(n_in_flight):
+    def make_kwargs(options):
+        return {'max_in_flight': n_in_flight}
+    return make_kwargs
+
+def _scenario_rate_controlled(options):
+    return {'rate_controller': rate_control.AIMDConcurrencyController(
+        options.target_p95, max_limit=16)}
+
+def _scenario_projected(options):
+    return {'max_in_flight': 8,
+        'itin_projection': plan_projection.PlanProjection()}
+
+def _scenario_interleaved(options):
+    return {'max_in_flight': 4, 'interleave_graphs': True}
+
+def _scenario_id_ordered(options):
+    return {'max_in_flight': 4,
+        'request_order': request_planning.ORDER_BY_ID}
+
+def _scenario_locality_ordered(options):
+    return {'max_in_flight': 4,
+        'request_order': request_planning.ORDER_BY_LOCALITY}
+
+def _scenario_deduped(options):
+    return {'max_in_flight': 8, 'dedupe_requests': True}
+
+# Name of each routing scenario, and a function returning the keyword args
+# for route_trip_set_on_graphs() to use in it.
+ROUTING_SCENARIOS = [
+    ('serial', _scenario_serial),
+    ('concurrent_4', _scenario_concurrent(4)),
+    ('concurrent_8', _scenario_concurrent(8)),
+    ('concurrent_16', _scenario_concurrent(16)),
+    ('rate_controlled', _scenario_rate_controlled),
+    ('projected', _scenario_projected),
+    ('deduped', _scenario_deduped),
+    ('interleaved', _scenario_interleaved),
+    ('id_ordered', _scenario_id_ordered),
+    ('locality_ordered', _scenario_locality_ordered),
+    ]
+ISO_SCENARIO = 'isochrones'
+
+class TimingConnPool(http_pool.HTTPConnectionPool):
+    """A connection pool that also records how long each request took."""
+
+    def __init__(self, *args, **kwargs):
+        http_pool.HTTPConnectionPool.__init__(self, *args, **kwargs)
+        self.latencies = []
+        self.n_errors = 0
+        self._timing_lock = threading.Lock()
+
+    def get(self, url, timeout=http_pool.DEFAULT_REQUEST_TIMEOUT_SECONDS):
+        start_time = time.time()
+        try:
+            return http_pool.HTTPConnectionPool.get(self, url, timeout)
+        except http_pool.HTTPRequestError:
+            with self._timing_lock:
+                self.n_errors += 1
+            raise
+        finally:
+            with self._timing_lock:
+                self.latencies.append(time.time() - start_time)
+
+def make_bench_trips(n_trips, seed=1):
+    """Returns a dict of n_trips random trips within BENCH_BBOX, keyed by
+    ID. The same seed always gives the same trips."""
+    rand = random.Random(seed)
+    (min_x, min_y), (max_x, max_y) = BENCH_BBOX
+    trips_by_id = {}
+    for ii in range(n_trips):
+        origin = (rand.uniform(min_x, max_x), rand.uniform(min_y, max_y))
+        dest = (rand.uniform(min_x, max_x), rand.uniform(min_y, max_y))
+        start_dt = BENCH_START_DT + timedelta(
+            minutes=rand.randint(0, BENCH_DEPARTURE_WINDOW_MINS))
+        trip_id = "%06d" % ii
+        trips_by_id[trip_id] = Trip.new_trip(origin, dest, start_dt,
+            "O", "D", trip_id)
+    return trips_by_id
+
+def _get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes on OS X, rather than KB.
+        peak_rss /= 1024.0
+    return peak_rss / 1024.0
+
+def _summarise(scenario_name, conn_pool, elapsed, extra=None):
+    latencies = conn_pool.latencies
+    n_requests = len(latencies)
+    result = {
+        'scenario': scenario_name,
+        'requests': n_requests,
+        'errors': conn_pool.n_errors,
+        'elapsed_s': elapsed,
+        'req_per_s': n_requests / elapsed if elapsed > 0 else 0.0,
+        'peak_rss_mb': _get_peak_rss_mb(),
+        }
+    for pct in [50, 90, 99]:
+        result['p%d_ms' % pct] = (rate_control.percentile(latencies, pct) \
+            or 0.0) * 1000.0
+    if extra:
+        result.update(extra)
+    return result
+
+def run_routing_scenario(scenario_name, server_url, options):
+    scenario_kwargs = dict(ROUTING_SCENARIOS)[scenario_name](options)
+    trips_by_id = make_bench_trips(options.trips, options.seed)
+    graph_specs = dict(("graph%d" % ii, router_id) \
+        for ii, router_id in enumerate(get_router_ids(options)))
+    max_conns = max(scenario_kwargs.get('max_in_flight', 1), 16)
+    conn_pool = TimingConnPool(max_idle_conns_per_host=max_conns)
+    http_pool.set_default_pool(conn_pool)
+    output_dir = tempfile.mkdtemp(prefix="bench_routing_")
+    try:
+        start_time = time.time()
+        results_by_graph = otp_router.route_trip_set_on_graphs(server_url,
+            BENCH_ROUTING_PARAMS, graph_specs, None, trips_by_id, output_dir,
+            **scenario_kwargs)
+        elapsed = time.time() - start_time
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    n_routed = sum(len(res) for res in results_by_graph.itervalues())
+    return _summarise(scenario_name, conn_pool, elapsed,
+        {'trips_routed': n_routed})
+
+def run_isochrones_scenario(server_url, options):
+    # Only imported here, as the Isochrones tools need GDAL installed.
+    from pyOTPA.Isochrones import download_isochrones
+    rand = random.Random(options.seed)
+    (min_x, min_y), (max_x, max_y) = BENCH_BBOX
+    locations = [("Location %d" % ii, (rand.uniform(min_x, max_x),
+        rand.uniform(min_y, max_y))) for ii in range(ISO_BENCH_LOCATIONS)]
+    conn_pool = TimingConnPool()
+    output_dir = tempfile.mkdtemp(prefix="bench_isos_")
+    try:
+        start_time = time.time()
+        download_isochrones.saveIsosForLocations(server_url,
+            get_router_ids(options)[0],
+            output_dir, "bench", locations, "2015-02-16",
+            ["07:30:00", "08:00:00", "08:30:00"], save_nearby_times=True,
+            nearby_minutes=10, num_each_side=2,
+            routing_params=BENCH_ROUTING_PARAMS,
+            raster_bounding_buf=(0.2, 0.2), raster_res=60, iso_inc=10,
+            iso_max=60, vec_types=["POINTS"], re_download=True,
+            conn_pool=conn_pool)
+        elapsed = time.time() - start_time
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return _summarise(ISO_SCENARIO, conn_pool, elapsed)
+
+def get_router_ids(options):
+    if options.router_ids:
+        return options.router_ids.split(',')
+    return ["router%d" % ii for ii in range(options.graphs)]
+
+def run_scenario(scenario_name, server_url, options):
+    if scenario_name == ISO_SCENARIO:
+        return run_isochrones_scenario(server_url, options)
+    return run_routing_scenario(scenario_name, server_url, options)
+
+def run_scenario_in_child(scenario_name, server_url, options):
+    """Runs a scenario in a fresh Python process, returning its results
+    dict (or None if it failed)."""
+    cmd = [sys.executable, os.path.abspath(__file__),
+        '--child', scenario_name, '--server_url', server_url,
+        '--trips', str(options.trips), '--graphs', str(options.graphs),
+        '--seed', str(options.seed), '--target_p95', str(options.target_p95),
+        '--router_ids', ",".join(get_router_ids(options))]
+    child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    result = None
+    for line in child.stdout:
+        if line.startswith(RESULT_LINE_PREFIX):
+            result = json.loads(line[len(RESULT_LINE_PREFIX):])
+        elif options.verbose:
+            sys.stdout.write(line)
+    child.wait()
+    if child.returncode != 0 or result is None:
+        print "Warning:- benchmark scenario %s failed (exit code %d)." \
+            % (scenario_name, child.returncode)
+        return None
+    return result
+
+def print_results_table(results):
+    print "\n%-16s %8s %7s %9s %8s %8s %8s %8s %9s" \
+        % ("scenario", "requests", "errors", "elapsed_s", "req/s",
+           "p50_ms", "p90_ms", "p99_ms", "peak_MB")
+    for res in results:
+        print "%-16s %8d %7d %9.2f %8.1f %8.1f %8.1f %8.1f %9.1f" \
+            % (res['scenario'], res['requests'], res['errors'],
+               res['elapsed_s'], res['req_per_s'], res['p50_ms'],
+               res['p90_ms'], res['p99_ms'], res['peak_rss_mb'])
+
+def main():
+    all_scenarios = [name for name, kwargs_func in ROUTING_SCENARIOS] \
+        + [ISO_SCENARIO]
+    parser = OptionParser(usage="%prog [options]",
+        description="Benchmarks routing throughput against a local fake "
+            "OTP server. Scenarios available: %s." % ", ".join(all_scenarios))
+    parser.add_option('--scenario', action='append', dest='scenarios',
+        help="Scenario to run (can be given several times). By default, "
+            "all routing scenarios are run.")
+    parser.add_option('--trips', type='int', default=1000)
+    parser.add_option('--graphs', type='int', default=1)
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--target_p95', type='float', default=0.2,
+        help="Target p95 latency (s) for the rate_controlled scenario.")
+    parser.add_option('--latency', type='float',
+        default=fake_otp_server.DEFAULT_LATENCY)
+    parser.add_option('--latency_jitter', type='float', default=0.0)
+    parser.add_option('--latency_per_in_flight', type='float', default=0.0)
+    parser.add_option('--error_rate', type='float', default=0.0)
+    parser.add_option('--no_path_rate', type='float', default=0.05)
+    parser.add_option('--geometry_points', type='int',
+        default=fake_otp_server.DEFAULT_GEOMETRY_POINTS)
+    parser.add_option('--cache_cells', type='int', default=0,
+        help="Simulate a server cache of this many areas/time periods, to "
+            "measure the effect of request order.")
+    parser.add_option('--cache_miss_latency', type='float', default=0.0)
+    parser.add_option('--server_url', help="Benchmark against this OTP "
+        "server (e.g. one with a real graph loaded), rather than a local "
+        "fake one.")
+    parser.add_option('--router_ids', help="Comma-separated router IDs to "
+        "route on (one per graph). Defaults to the fake server's routers.")
+    parser.add_option('--output_json', help="Also save results to this "
+        "file, as JSON.")
+    parser.add_option('--verbose', action='store_true', default=False,
+        help="Show the output of the routing runs.")
+    parser.add_option('--child', help=SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.child:
+        # Running a single scenario, on behalf of the parent process.
+        result = run_scenario(options.child, options.server_url, options)
+        print RESULT_LINE_PREFIX + json.dumps(result)
+        return
+
+    scenarios = options.scenarios or [name for name, kwargs_func \
+        in ROUTING_SCENARIOS]
+    for scenario_name in scenarios:
+        if scenario_name not in all_scenarios:
+            parser.error("unknown scenario '%s'." % scenario_name)
+
+    if options.server_url:
+        server = None
+        server_url = options.server_url
+        print "Running %d benchmark scenarios routing %d trips on routers "\
+            "%s, against OTP server at %s." \
+            % (len(scenarios), options.trips,
+               ", ".join(get_router_ids(options)), server_url)
+    else:
+        config = fake_otp_server.FakeOTPConfig(latency=options.latency,
+            latency_jitter=options.latency_jitter,
+            latency_per_in_flight=options.latency_per_in_flight,
+            error_rate=options.error_rate, no_path_rate=options.no_path_rate,
+            geometry_points=options.geometry_points,
+            router_ids=get_router_ids(options),
+            cache_cells=options.cache_cells,
+            cache_miss_latency=options.cache_miss_latency)
+        server = fake_otp_server.FakeOTPServer(config)
+        server_url = server.start()
+        print "Running %d benchmark scenarios routing %d trips on %d "\
+            "graphs, against fake OTP server at %s (latency %.3fs, error "\
+            "rate %.2f)." \
+            % (len(scenarios), options.trips, options.graphs, server_url,
+               options.latency, options.error_rate)
+    results = []
+    for scenario_name in scenarios:
+        print "...running scenario %s" % scenario_name
+        if server:
+            hits_before = server.n_cache_hits
+            misses_before = server.n_cache_misses
+        result = run_scenario_in_child(scenario_name, server_url, options)
+        if result:
+            if server and options.cache_cells:
+                hits = server.n_cache_hits - hits_before
+                misses = server.n_cache_misses - misses_before
+                result['server_cache_hit_pct'] = hits \
+                    / float(max(1, hits + misses)) * 100.0
+                print "   (simulated server cache hit rate %.1f%%)" \
+                    % result['server_cache_hit_pct']
+            results.append(result)
+    if server:
+        server.stop()
+    print_results_table(results)
+    if options.output_json:
+        f = open(options.output_json, 'w')
+        json.dump(results, f, indent=2)
+        f.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+
+"""Micro-benchmark of the CPU cost of building each routing request URL:-
+building the whole URL from scratch for every request (as the router used
+to), versus formatting only the per-trip fields into a pre-encoded
+url_templates.TripPlanURLTemplate.
+
+Example:
+    python bench_url_build.py --requests 200000
+"""
+
+import time
+import random
+import urllib2
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from pyOTPA import otp_config
+from pyOTPA import url_templates
+from pyOTPA.TripRunner import otp_router
+
+BENCH_ROUTING_PARAMS = {
+    'arriveBy': 'false',
+    'maxWalkDistance': 2000,
+    'walkSpeed': 1.33,
+    'walkBoardCost': 300,
+    'transferPenalty': 0,
+    'waitReluctance': 0.95,
+    'mode': 'TRANSIT,WALK',
+    'optimize': 'QUICK',
+    'numItineraries': 1,
+    }
+
+def build_url_from_scratch(server_url, routing_params, trip_date, trip_time,
+        origin_lon_lat, dest_lon_lat, otp_router_id):
+    """Builds the URL without a template, re-encoding every part of it."""
+    date_str = trip_date.strftime(otp_config.OTP_DATE_FMT)
+    time_str = trip_time.strftime(otp_config.OTP_TIME_FMT)
+    reqStr = url_templates.WS_BASE_PATH + "/plan" + '?'
+    reqStr += "&".join([name+'='+urllib2.quote(str(val)) for name, val \
+        in routing_params.iteritems()])
+    reqStr += '&'+'fromPlace'+'='+str(origin_lon_lat[1]) \
+        + ','+str(origin_lon_lat[0])
+    reqStr += '&'+'toPlace'+'='+str(dest_lon_lat[1])+','+str(dest_lon_lat[0])
+    reqStr += '&'+'time'+'='+date_str+'T'+urllib2.quote(time_str)
+    if otp_router_id is not None:
+        reqStr += '&'+'routerId'+'='+otp_router_id
+    return server_url + reqStr
+
+def make_bench_requests(n_requests, seed):
+    """Returns a list of (date, time, origin, dest) tuples, with departures
+    on the minute over a day (as for typical generated trips)."""
+    rand = random.Random(seed)
+    start_dt = datetime(2013, 8, 20, 0, 0)
+    requests = []
+    for ii in range(n_requests):
+        dep_dt = start_dt + timedelta(minutes=rand.randint(0, 24*60-1))
+        origin = (round(144.9 + rand.random() * 0.3, 6),
+            round(-37.9 + rand.random() * 0.2, 6))
+        dest = (round(144.9 + rand.random() * 0.3, 6),
+            round(-37.9 + rand.random() * 0.2, 6))
+        requests.append((dep_dt.date(), dep_dt.time(), origin, dest))
+    return requests
+
+def time_builds(build_func, requests):
+    start_time = time.time()
+    for trip_date, trip_time, origin, dest in requests:
+        build_func(trip_date, trip_time, origin, dest)
+    return time.time() - start_time
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--requests', type='int', default=100000)
+    parser.add_option('--seed', type='int', default=1)
+    options, args = parser.parse_args()
+
+    server_url = "http://localhost:8080"
+    router_id = "router0"
+    requests = make_bench_requests(options.requests, options.seed)
+
+    def from_scratch(trip_date, trip_time, origin, dest):
+        return build_url_from_scratch(server_url, BENCH_ROUTING_PARAMS,
+            trip_date, trip_time, origin, dest, router_id)
+
+    def via_router(trip_date, trip_time, origin, dest):
+        return otp_router.build_trip_request_url(server_url,
+            BENCH_ROUTING_PARAMS, trip_date, trip_time, origin, dest,
+            router_id)
+
+    template = url_templates.TripPlanURLTemplate(BENCH_ROUTING_PARAMS,
+        router_id)
+    def via_template(trip_date, trip_time, origin, dest):
+        return template.build_url(server_url, trip_date, trip_time, origin,
+            dest)
+
+    for trip_date, trip_time, origin, dest in requests[:100]:
+        url = from_scratch(trip_date, trip_time, origin, dest)
+        if url != via_router(trip_date, trip_time, origin, dest) \
+                or url != via_template(trip_date, trip_time, origin, dest):
+            print "Error:- URLs built differ, for trip at %s %s." \
+                % (trip_date, trip_time)
+            return
+
+    print "Building %d routing request URLs:" % options.requests
+    print "%-22s %10s %12s" % ("method", "elapsed_s", "us/request")
+    base_elapsed = None
+    for name, build_func in [("from_scratch", from_scratch),
+            ("build_trip_request_url", via_router),
+            ("template", via_template)]:
+        elapsed = time_builds(build_func, requests)
+        if base_elapsed is None:
+            base_elapsed = elapsed
+        print "%-22s %10.3f %12.2f  (x%.1f)" % (name, elapsed,
+            elapsed / options.requests * 1e6, base_elapsed / elapsed)
+
+if __name__ == "__main__":
+    main()
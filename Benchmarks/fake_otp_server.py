@@ -0,0 +1,349 @@
+#!/usr/bin/env python2
+
+"""A lightweight local stand-in for an OTP server, for benchmarking and
+trying out the routing and isochrone download tools without a real OTP
+instance.
+
+Serves the parts of the OTP 0.x API that pyOTPA uses:-
+ * /opentripplanner-api-webapp/ws/plan :- returns a synthetic itinerary
+   between the requested fromPlace and toPlace, departing at the requested
+   time.
+ * /opentripplanner-api-webapp/ws/wms :- returns a dummy raster image.
+ * /opentripplanner-api-webapp/ws/iso :- returns a dummy isochrone vector.
+ * /opentripplanner-api-webapp/ws/routers :- lists the configured routers.
+
+How long each response takes, how often requests fail or find no
+itinerary, and how large each response is, can all be configured.
+Itineraries (and whether one is found) are the same each time a request is
+made, so runs can be compared - but HTTP errors are random, so retries of
+a failed request can succeed.
+"""
+
+import time
+import math
+import json
+import random
+import threading
+import collections
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from datetime import datetime
+# Imported up front, since otherwise the first calls to datetime.strptime()
+# made at once from several threads can fail (Python issue 7980).
+import _strptime
+from optparse import OptionParser
+
+from pyOTPA import otp_config
+
+WS_PATH = "/opentripplanner-api-webapp/ws"
+
+DEFAULT_PORT = 8080
+DEFAULT_LATENCY = 0.05
+DEFAULT_N_TRANSIT_LEGS = 2
+DEFAULT_GEOMETRY_POINTS = 50
+DEFAULT_RASTER_BYTES = 64 * 1024
+
+# Speeds used to make synthetic itineraries, in m/s.
+WALK_SPEED = 1.33
+TRANSIT_SPEED = 8.0
+TRANSFER_WAIT_SEC = 180
+METRES_PER_DEGREE = 111000.0
+
+# Size of the areas and time periods the simulated routing cache holds
+# entries for.
+CACHE_CELL_DEGREES = 0.02
+CACHE_TIME_BUCKET_MINUTES = 30
+
+class FakeOTPConfig:
+    """Behaviour of a FakeOTPServer.
+
+    latency is the base time in seconds to answer each request, with a
+    random extra of up to latency_jitter seconds. latency_per_in_flight
+    adds that many seconds more for each other request being handled at the
+    same time, to mimic a server getting slower under load.
+
+    error_rate is the fraction of plan requests answered with a HTTP 500
+    error, and no_path_rate the fraction that return OTP's "no path found"
+    planner error. Payload size is set by n_itineraries, n_transit_legs and
+    geometry_points (the length of each leg's encoded geometry), and
+    raster_bytes for /wms responses.
+
+    If cache_cells is set, the server simulates OTP's internal caches (and
+    the OS page cache) by keeping a least-recently used set of that many
+    (origin area, departure time period) cells:- plan requests from a cell
+    not in the set take cache_miss_latency seconds more. So the effect of
+    the order requests are sent in can be measured."""
+
+    def __init__(self, latency=DEFAULT_LATENCY, latency_jitter=0.0,
+            latency_per_in_flight=0.0, error_rate=0.0, no_path_rate=0.0,
+            n_itineraries=1, n_transit_legs=DEFAULT_N_TRANSIT_LEGS,
+            geometry_points=DEFAULT_GEOMETRY_POINTS,
+            raster_bytes=DEFAULT_RASTER_BYTES, router_ids=None,
+            cache_cells=0, cache_miss_latency=0.0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.latency_per_in_flight = latency_per_in_flight
+        self.error_rate = error_rate
+        self.no_path_rate = no_path_rate
+        self.n_itineraries = n_itineraries
+        self.n_transit_legs = n_transit_legs
+        self.geometry_points = geometry_points
+        self.raster_bytes = raster_bytes
+        self.router_ids = router_ids or ["default"]
+        self.cache_cells = cache_cells
+        self.cache_miss_latency = cache_miss_latency
+
+def get_cache_cell(query):
+    """Returns the simulated cache cell of a plan request, or None if it
+    can't be worked out."""
+    try:
+        lat, lon = _parse_lat_lon(query['fromPlace'])
+        date_str, time_str = query['time'].split('T')
+        hours, mins = time_str.split(':')[:2]
+    except (KeyError, ValueError):
+        return None
+    time_bucket = (int(hours) * 60 + int(mins)) // CACHE_TIME_BUCKET_MINUTES
+    return int(lat // CACHE_CELL_DEGREES), int(lon // CACHE_CELL_DEGREES), \
+        date_str, time_bucket
+
+def _parse_lat_lon(place_str):
+    lat, lon = place_str.split(',')
+    return float(lat), float(lon)
+
+def _to_ms(dt):
+    return int(time.mktime(dt.timetuple()) * 1000)
+
+def make_synthetic_itinerary(config, from_lat_lon, to_lat_lon, start_dt,
+        itin_i=0):
+    """Returns an itinerary dict in the format of OTP's plan response, of a
+    walk - transit - walk trip between the two places. Later itineraries
+    (itin_i > 0) just start a few minutes later."""
+    dist = math.hypot(to_lat_lon[0] - from_lat_lon[0],
+        to_lat_lon[1] - from_lat_lon[1]) * METRES_PER_DEGREE
+    walk_dist = min(400.0, dist * 0.1)
+    n_transit = max(1, config.n_transit_legs)
+    transit_dist = max(dist - 2 * walk_dist, 100.0) / n_transit
+    leg_specs = [('WALK', walk_dist, WALK_SPEED)]
+    for ii in range(n_transit):
+        if ii > 0:
+            leg_specs.append(('WALK', 50.0, WALK_SPEED))
+        leg_specs.append((otp_config.OTP_NON_WALK_MODES[ii % \
+            len(otp_config.OTP_NON_WALK_MODES)], transit_dist, TRANSIT_SPEED))
+    leg_specs.append(('WALK', walk_dist, WALK_SPEED))
+
+    geometry = {'points': "_p~iF~ps|U" * config.geometry_points,
+        'length': config.geometry_points}
+    curr_ms = _to_ms(start_dt) + (itin_i * 5 + 2) * 60 * 1000
+    itin_start_ms = curr_ms
+    walk_sec = transit_sec = wait_sec = 0
+    walk_dist_total = 0.0
+    legs = []
+    for ii, (mode, leg_dist, speed) in enumerate(leg_specs):
+        if mode != otp_config.OTP_WALK_MODE and ii > 1:
+            curr_ms += TRANSFER_WAIT_SEC * 1000
+            wait_sec += TRANSFER_WAIT_SEC
+        leg_sec = int(leg_dist / speed)
+        leg = {'mode': mode, 'distance': leg_dist,
+            'duration': leg_sec * 1000, 'startTime': curr_ms,
+            'endTime': curr_ms + leg_sec * 1000, 'legGeometry': geometry}
+        if mode == otp_config.OTP_WALK_MODE:
+            walk_sec += leg_sec
+            walk_dist_total += leg_dist
+        else:
+            transit_sec += leg_sec
+            route_num = str(ii)
+            leg.update({'agencyName': "Fake Transit", 'agencyId': "FT",
+                'routeId': route_num, 'routeShortName': route_num,
+                'routeLongName': "Fake route %s" % route_num})
+        legs.append(leg)
+        curr_ms += leg_sec * 1000
+    return {'startTime': itin_start_ms, 'endTime': curr_ms,
+        'duration': curr_ms - itin_start_ms, 'walkTime': walk_sec,
+        'transitTime': transit_sec, 'waitingTime': wait_sec,
+        'walkDistance': walk_dist_total, 'transfers': n_transit - 1,
+        'legs': legs}
+
+class FakeOTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep-alive support, as the real OTP server (in Tomcat/Grizzly) has.
+    protocol_version = "HTTP/1.1"
+    # Buffer responses, so headers and body go out in one packet.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        config = server.config
+        server.request_started()
+        try:
+            url = urlparse.urlparse(self.path)
+            query = dict((k, v[0]) for k, v in \
+                urlparse.parse_qs(url.query).iteritems())
+            # Seed from the request, so the same request always gets the
+            # same outcome.
+            rand = random.Random(url.query)
+            delay = config.latency + rand.random() * config.latency_jitter \
+                + config.latency_per_in_flight * (server.get_in_flight() - 1)
+            if url.path == WS_PATH + "/plan" and config.cache_cells \
+                    and not server.check_cache(get_cache_cell(query)):
+                delay += config.cache_miss_latency
+            time.sleep(delay)
+            if url.path == WS_PATH + "/plan":
+                self._send_plan(config, query, rand)
+            elif url.path == WS_PATH + "/wms":
+                self._send(200, "image/geotiff", "II*\x00" \
+                    + "\x00" * max(0, config.raster_bytes - 4))
+            elif url.path == WS_PATH + "/iso":
+                self._send(200, "application/json", json.dumps(
+                    {'type': 'FeatureCollection', 'features': []}))
+            elif url.path == WS_PATH + "/routers":
+                self._send(200, "application/json", json.dumps(
+                    {'routerInfo': [{'routerId': r_id} for r_id in \
+                        config.router_ids]}))
+            else:
+                self._send(404, "text/plain", "Not found")
+        finally:
+            server.request_finished()
+
+    def _send_plan(self, config, query, rand):
+        if random.random() < config.error_rate:
+            self._send(500, "text/plain", "Internal server error")
+            return
+        if rand.random() < config.no_path_rate:
+            res = {'plan': None, 'error': {'id': 404,
+                'msg': "No trip found. There may be no transit service "\
+                    "within the maximum specified distance or at the "\
+                    "specified time, or your start or end point might be "\
+                    "in a place that is not accessible."}}
+        else:
+            try:
+                from_ll = _parse_lat_lon(query['fromPlace'])
+                to_ll = _parse_lat_lon(query['toPlace'])
+                start_dt = datetime.strptime(query['time'],
+                    otp_config.OTP_DATE_FMT + "T" + otp_config.OTP_TIME_FMT)
+            except (KeyError, ValueError):
+                self._send(400, "text/plain", "Bad request")
+                return
+            itins = [make_synthetic_itinerary(config, from_ll, to_ll,
+                start_dt, itin_i) for itin_i in range(config.n_itineraries)]
+            res = {'plan': {'date': _to_ms(start_dt),
+                'from': {'lat': from_ll[0], 'lon': from_ll[1]},
+                'to': {'lat': to_ll[0], 'lon': to_ll[1]},
+                'itineraries': itins}}
+        self._send(200, "application/json", json.dumps(res))
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeOTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded fake OTP server. Use start() to serve in a background
+    thread (e.g. within a benchmark script), or serve_forever()."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # Listen backlog:- the default of 5 overflows with more connections
+    # than that being opened at once, stalling them for about a second
+    # while they're retried, which would skew the concurrent benchmarks.
+    request_queue_size = 128
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+            FakeOTPRequestHandler)
+        self.config = config or FakeOTPConfig()
+        self.n_requests = 0
+        self.n_cache_hits = 0
+        self.n_cache_misses = 0
+        self._cache = collections.OrderedDict()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get_url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def request_started(self):
+        with self._lock:
+            self.n_requests += 1
+            self._in_flight += 1
+
+    def request_finished(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def check_cache(self, cache_cell):
+        """Returns whether cache_cell is in the simulated cache, adding it
+        (and evicting the least recently used cell) if it isn't."""
+        with self._lock:
+            if cache_cell in self._cache:
+                del self._cache[cache_cell]
+                self._cache[cache_cell] = True
+                self.n_cache_hits += 1
+                return True
+            self._cache[cache_cell] = True
+            if len(self._cache) > self.config.cache_cells:
+                self._cache.popitem(last=False)
+            self.n_cache_misses += 1
+            return False
+
+    def get_in_flight(self):
+        with self._lock:
+            return self._in_flight
+
+    def start(self):
+        """Serves requests in a background thread. Returns the server's
+        URL."""
+        self._thread = threading.Thread(target=self.serve_forever,
+            name="fake-otp-server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.get_url()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+        description="Runs a fake OTP server, returning synthetic results.")
+    parser.add_option('--port', type='int', default=DEFAULT_PORT)
+    parser.add_option('--latency', type='float', default=DEFAULT_LATENCY,
+        help="Base seconds to answer each request.")
+    parser.add_option('--latency_jitter', type='float', default=0.0)
+    parser.add_option('--latency_per_in_flight', type='float', default=0.0)
+    parser.add_option('--error_rate', type='float', default=0.0)
+    parser.add_option('--no_path_rate', type='float', default=0.0)
+    parser.add_option('--n_itineraries', type='int', default=1)
+    parser.add_option('--n_transit_legs', type='int',
+        default=DEFAULT_N_TRANSIT_LEGS)
+    parser.add_option('--geometry_points', type='int',
+        default=DEFAULT_GEOMETRY_POINTS)
+    parser.add_option('--raster_bytes', type='int',
+        default=DEFAULT_RASTER_BYTES)
+    parser.add_option('--cache_cells', type='int', default=0)
+    parser.add_option('--cache_miss_latency', type='float', default=0.0)
+    (options, args) = parser.parse_args()
+    config = FakeOTPConfig(options.latency, options.latency_jitter,
+        options.latency_per_in_flight, options.error_rate,
+        options.no_path_rate, options.n_itineraries, options.n_transit_legs,
+        options.geometry_points, options.raster_bytes,
+        cache_cells=options.cache_cells,
+        cache_miss_latency=options.cache_miss_latency)
+    server = FakeOTPServer(config, port=options.port)
+    print "Fake OTP server listening at %s (Ctrl-C to stop)." \
+        % server.get_url()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -4,59 +4,49 @@ import urllib
 import urllib2
 import os.path
 
+from pyOTPA import http_pool
+from pyOTPA import url_templates
 import utils
 
 """A Python script to help download a series of Isochrone files from
 an OpenTripPlanner server"""
 
 def buildRequestStringRaster(server_url, routing_params, date, time, lon_lat,
-        img_bbox, raster_res, otp_router_id=None):
-    reqStr = "/opentripplanner-api-webapp/ws" + "/wms" + '?'
-    # General OTP routing request stuff
-    reqStr += "&".join([name+'='+urllib2.quote(str(val)) for name, val \
-        in routing_params.iteritems()])
-    reqStr += '&'+'fromPlace'+'='+str(lon_lat[1])+','+str(lon_lat[0])
-    reqStr += '&'+'toPlace'+'='+str(lon_lat[1])+','+str(lon_lat[0])
-    reqStr += '&'+'time'+'='+date+'T'+urllib2.quote(time)
-    # Stuff specific to raster output
-    reqStr += '&'+'format'+'='+"image/geotiff"
-    reqStr += '&'+'srs'+'='+"EPSG:4326"
-    reqStr += '&'+'resolution'+'='+str(raster_res)
-    reqStr += '&'+'bbox'+'='+','.join(str(ii) for ii in img_bbox[0] + \
-        img_bbox[1])
-    if otp_router_id is not None:
-        reqStr += '&'+'routerId'+'='+otp_router_id
-    # Add server URL
-    url = server_url + reqStr
-    return url
+        img_bbox, raster_res, otp_router_id=None, url_template=None):
+    """If many rasters are requested with the same routing_params,
+    raster_res and router, pass a url_templates.IsoRasterURLTemplate as
+    url_template, so these are only encoded once."""
+    if url_template is None:
+        url_template = url_templates.IsoRasterURLTemplate(routing_params,
+            raster_res, otp_router_id)
+    return url_template.build_url(server_url, date, time, lon_lat, img_bbox)
 
 def buildRequestStringVector(server_url, routing_params, date, time, lon_lat,
-        time_radius, vec_type, otp_router_id=None):
-    reqStr = "/opentripplanner-api-webapp/ws" + "/iso" + '?'
-    # General OTP routing request stuff
-    reqStr += "&".join([name+'='+urllib2.quote(str(val)) for name, val \
-        in routing_params.iteritems()])
-    reqStr += '&'+'fromPlace'+'='+str(lon_lat[1])+','+str(lon_lat[0])
-    reqStr += '&'+'toPlace'+'='+str(lon_lat[1])+','+str(lon_lat[0])
-    reqStr += '&'+'time'+'='+date+'T'+urllib2.quote(time)
-    # Stuff specific to raster output
-    reqStr += '&'+'walkTime'+'='+str(time_radius)
-    reqStr += '&'+'output'+'='+vec_type
-    if otp_router_id is not None:
-        reqStr += '&'+'routerId'+'='+otp_router_id
-    # Add server URL
-    url = server_url + reqStr
-    return url
+        time_radius, vec_type, otp_router_id=None, url_template=None):
+    if url_template is None:
+        url_template = url_templates.IsoVectorURLTemplate(routing_params,
+            otp_router_id)
+    return url_template.build_url(server_url, date, time, lon_lat,
+        time_radius, vec_type)
 
 def saveIsosForLocations(server_url, otp_router_id, save_path,
         save_suffix, locations, date, times,
         save_nearby_times, nearby_minutes, num_each_side,
         routing_params, 
         raster_bounding_buf, raster_res,
-        iso_inc, iso_max, vec_types, re_download=False):
+        iso_inc, iso_max, vec_types, re_download=False, conn_pool=None):
+    """Downloads isochrone rasters (and vectors) for each location. Requests
+    re-use the keep-alive connections of conn_pool, or of the shared default
+    http_pool if not given."""
 
     if os.path.exists(save_path) is False: 
         os.makedirs(save_path)
+    if conn_pool is None:
+        conn_pool = http_pool.get_default_pool()
+    raster_template = url_templates.IsoRasterURLTemplate(routing_params,
+        raster_res, otp_router_id)
+    vector_template = url_templates.IsoVectorURLTemplate(routing_params,
+        otp_router_id)
 
     for loc in locations:
         loc_name_orig = loc[0]
@@ -90,10 +80,9 @@ def saveIsosForLocations(server_url, otp_router_id, save_path,
                     date_mod, time_mod = date_time_tuple
                     url = buildRequestStringRaster(server_url, routing_params,
                         date_mod, time_mod, lon_lat, img_bbox, raster_res,
-                        otp_router_id)
+                        otp_router_id, raster_template)
                     print url
-                    response = urllib2.urlopen(url)
-                    data = response.read()
+                    data = conn_pool.get(url, timeout=None)
                     f = open(fname, "w")
                     f.write(data)
                     f.close()
@@ -110,14 +99,15 @@ def saveIsosForLocations(server_url, otp_router_id, save_path,
                         save_path, save_suffix)
                     if re_download or not os.path.exists(vec_fname):
                         url = buildRequestStringVector(server_url, routing_params, 
-                            date, time, lon_lat, iso, vec_type, otp_router_id)
+                            date, time, lon_lat, iso, vec_type, otp_router_id,
+                            vector_template)
                         print url
-                        response = urllib2.urlopen(url)
-                        data = response.read()
+                        data = conn_pool.get(url, timeout=None)
                         f = open(vec_fname, "w")
                         f.write(data)
                         f.close()
             print "DONE!\n"
+    conn_pool.print_stats()
     return
 
 def save_isos(multi_graph_iso_set, re_download=False):
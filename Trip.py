@@ -9,6 +9,7 @@ import copy
 from datetime import datetime
 
 import otp_config
+import itin_store
 
 #Note that trip's Origin and Dest coords are in the EPSG of otp_config
 #OTP_ROUTER_EPSG
@@ -66,6 +67,15 @@ def get_trip_req_start_dts(trips_by_id, trip_req_start_date):
     return trip_req_start_dts
 
 def get_trips_subset_by_ids(trip_results_dict, trip_ids_to_select):
+    """If trip_results_dict is an itin_store.MappedItinStore, returns a
+    subset of it (so itineraries are still only read as needed)."""
+    if isinstance(trip_results_dict, itin_store.MappedItinStore):
+        try:
+            return trip_results_dict.get_subset(trip_ids_to_select)
+        except KeyError, e:
+            raise ValueError("Input trip_results_dict didn't contain at "\
+                "least one of the trip IDs ('%s') you requested in "\
+                "trip_ids_to_select." % e.args[0])
     trip_results_filtered = {}
     for trip_id in trip_ids_to_select:
         try:
@@ -77,6 +87,15 @@ def get_trips_subset_by_ids(trip_results_dict, trip_ids_to_select):
     return trip_results_filtered
 
 def get_trips_subset_by_ids_to_exclude(trip_results_dict, trip_ids_to_exclude):
+    if isinstance(trip_results_dict, itin_store.MappedItinStore):
+        trip_ids_to_exclude = set(trip_ids_to_exclude)
+        for trip_id in trip_ids_to_exclude:
+            if trip_id not in trip_results_dict:
+                print "Warning: Input trip_results_dict didn't contain at "\
+                    "least one of the trip IDs ('%s') you requested to "\
+                    "exclude in trip_ids_to_exclude." % trip_id
+        return trip_results_dict.get_subset(trip_id for trip_id \
+            in trip_results_dict if trip_id not in trip_ids_to_exclude)
     # In the excluding IDs case:- start by creating a copy of the entire 
     # first dict:- since it will be faster to just delete dictionary entries
     # that are excluded. copy.copy just creates a new dictionary pointing to
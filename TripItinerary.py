@@ -1,27 +1,163 @@
 from datetime import datetime, timedelta
+import array
+import math
 import json
+import functools
+import threading
 
+from pyOTPA import itin_codec
 from pyOTPA import otp_config
+from pyOTPA import result_files
 from pyOTPA import time_utils
 
-class TripItinerary:
+# Values repeated across many itineraries' legs (modes, agency names and
+# routes) are held once here, and the legs store their index into it.
+_interned_values = []
+_intern_ids = {}
+_intern_lock = threading.Lock()
+
+def get_intern_id(value):
+    intern_id = _intern_ids.get(value)
+    if intern_id is None:
+        with _intern_lock:
+            intern_id = _intern_ids.get(value)
+            if intern_id is None:
+                intern_id = len(_interned_values)
+                _interned_values.append(value)
+                _intern_ids[value] = intern_id
+    return intern_id
+
+def get_interned_value(intern_id):
+    return _interned_values[intern_id]
+
+_WALK_MODE_ID = get_intern_id(otp_config.OTP_WALK_MODE)
+
+# OTP itinerary fields whose values each TripItinerary holds, and the slot
+# each is held in.
+_HELD_ITIN_ATTRS = {
+    'waitingTime': '_waiting_s',
+    'walkTime': '_walk_s',
+    'transitTime': '_transit_s',
+    'walkDistance': '_walk_dist_m',
+    'transfers': '_transfers',
+    }
+# Held in place of a leg's distance or duration, if OTP didn't give it.
+# Such legs are left out of the itinerary's totals.
+_MISSING_LEG_VALUE = float('nan')
+
+def _is_missing(leg_value):
+    return math.isnan(leg_value)
+
+def _get_leg_route(leg):
+    return (leg.get('routeId'), leg.get('routeShortName'),
+        leg.get('routeLongName'))
+
+class TripItinerary(object):
     """This is really a lightweight wrapper class around OTP's 'itinerary'
     JSON data structure returned from calls to the OTP Planner API. See:-
     http://docs.opentripplanner.org/apidoc/0.10.0/el_ns0_response.html
-    """
 
-    def __init__(self, json_data):
-        self.json = json_data
-        # Initialise to empty various results to be cached later.
-        self._dist_travelled = None
-    
+    To keep the memory held per itinerary small, the values the getters
+    use are extracted when it's made:- times as epoch seconds, and per-leg
+    arrays of the leg values (with modes, agencies and routes as intern
+    IDs). Fields OTP doesn't always give (or that a
+    plan_projection.PlanProjection may have dropped) are held as None (or
+    NaN, for leg distances and durations) if missing:- legs missing a
+    distance or duration are left out of the totals by trip and by mode
+    (see get_n_legs_missing_dist()). If given a
+    json_loader (a function returning the itinerary's JSON data, e.g. by
+    re-reading its result file), the JSON data itself isn't kept, and the
+    json attribute re-loads it each time it's used."""
+
+    __slots__ = ['_json', '_json_loader', '_start_s', '_end_s',
+        '_waiting_s', '_walk_s', '_transit_s', '_walk_dist_m', '_transfers',
+        '_dist_travelled', '_leg_modes', '_leg_start_s', '_leg_end_s',
+        '_leg_dist_m', '_leg_duration_s', '_leg_agencies', '_leg_routes']
+
+    def __init__(self, json_data, json_loader=None):
+        self._set_values_from_json(json_data)
+        if json_loader is None:
+            self._json = json_data
+        else:
+            self._json = None
+        self._json_loader = json_loader
+
+    def _set_values_from_json(self, json_data):
+        self._start_s = json_data['startTime'] / 1000.0
+        self._end_s = json_data['endTime'] / 1000.0
+        for itin_attr, slot in _HELD_ITIN_ATTRS.iteritems():
+            setattr(self, slot, json_data.get(itin_attr))
+        legs = json_data['legs']
+        self._leg_modes = array.array('i',
+            [get_intern_id(leg['mode']) for leg in legs])
+        self._leg_start_s = array.array('d',
+            [leg['startTime'] / 1000.0 for leg in legs])
+        self._leg_end_s = array.array('d',
+            [leg['endTime'] / 1000.0 for leg in legs])
+        self._leg_dist_m = array.array('d',
+            [leg.get('distance', _MISSING_LEG_VALUE) for leg in legs])
+        self._leg_duration_s = array.array('d',
+            [leg['duration'] / 1000.0 if 'duration' in leg \
+                else _MISSING_LEG_VALUE for leg in legs])
+        self._leg_agencies = array.array('i',
+            [get_intern_id(leg.get('agencyName')) for leg in legs])
+        self._leg_routes = array.array('i',
+            [get_intern_id(_get_leg_route(leg)) for leg in legs])
+        self._dist_travelled = sum(dist for dist in self._leg_dist_m \
+            if not _is_missing(dist))
+
+    @property
+    def json(self):
+        """The itinerary's JSON data:- re-loaded each time if it has a
+        json_loader, so prefer the getters (or get_itin_attr()) for values
+        they give."""
+        if self._json is not None:
+            return self._json
+        return self._json_loader()
+
+    def get_itin_attr(self, itin_attr):
+        """Returns the value of OTP itinerary field itin_attr (e.g.
+        'walkTime'):- without loading the JSON, if it's one of the values
+        held."""
+        slot = _HELD_ITIN_ATTRS.get(itin_attr)
+        if slot is not None:
+            return getattr(self, slot)
+        return self.json[itin_attr]
+
+    def __getstate__(self):
+        # Intern IDs are only valid in this process, so pickle the values.
+        leg_values = zip(self.get_mode_sequence(),
+            map(get_interned_value, self._leg_agencies),
+            map(get_interned_value, self._leg_routes))
+        return (self._json, self._json_loader, self._start_s, self._end_s,
+            self._waiting_s, self._walk_s, self._transit_s,
+            self._walk_dist_m, self._transfers, self._dist_travelled,
+            self._leg_start_s.tolist(), self._leg_end_s.tolist(),
+            self._leg_dist_m.tolist(), self._leg_duration_s.tolist(),
+            leg_values)
+
+    def __setstate__(self, state):
+        (self._json, self._json_loader, self._start_s, self._end_s,
+            self._waiting_s, self._walk_s, self._transit_s,
+            self._walk_dist_m, self._transfers, self._dist_travelled,
+            leg_start_s, leg_end_s, leg_dist_m, leg_duration_s,
+            leg_values) = state
+        self._leg_start_s = array.array('d', leg_start_s)
+        self._leg_end_s = array.array('d', leg_end_s)
+        self._leg_dist_m = array.array('d', leg_dist_m)
+        self._leg_duration_s = array.array('d', leg_duration_s)
+        self._leg_modes = array.array('i',
+            [get_intern_id(mode) for mode, agency, route in leg_values])
+        self._leg_agencies = array.array('i',
+            [get_intern_id(agency) for mode, agency, route in leg_values])
+        self._leg_routes = array.array('i',
+            [get_intern_id(route) for mode, agency, route in leg_values])
+
     def get_start_dt(self):
-        st_raw = self.json['startTime']
-        return datetime.fromtimestamp(st_raw / 1000.0) 
+        return datetime.fromtimestamp(self._start_s)
 
     def get_end_dt(self):
-        et_raw = self.json['endTime']
-        return datetime.fromtimestamp(et_raw / 1000.0)
+        return datetime.fromtimestamp(self._end_s)
 
     def get_total_trip_td(self, trip_req_start_dt):
         return self.get_end_dt() - trip_req_start_dt
@@ -33,59 +169,59 @@ class TripItinerary:
         return self.get_start_dt() - trip_req_start_dt
 
     def get_transfer_wait_before_leg(self, leg_i, trip_req_start_dt):
-        if leg_i >= len(self.json['legs']):
+        if leg_i >= len(self._leg_modes):
             raise ValueError("value of leg_i passed was too high.")
         if leg_i == 0:
             return self.get_init_wait_td(trip_req_start_dt)
         else:
             wait_before = self.get_wait_before_leg(leg_i, trip_req_start_dt)
-            legs = self.json['legs']
             proc_leg_i = leg_i - 1
-            while proc_leg_i >= 0 and legs[proc_leg_i]['mode'] == \
-                    otp_config.OTP_WALK_MODE:
+            while proc_leg_i >= 0 \
+                    and self._leg_modes[proc_leg_i] == _WALK_MODE_ID:
                 wait_before += self.get_wait_before_leg(proc_leg_i,
                     trip_req_start_dt)
                 proc_leg_i -= 1
         return wait_before
 
     def get_wait_before_leg(self, leg_i, trip_req_start_dt):
-        if leg_i >= len(self.json['legs']):
+        if leg_i >= len(self._leg_modes):
             raise ValueError("value of leg_i passed was too high.")
         if leg_i == 0:
             return self.get_init_wait_td(trip_req_start_dt)
         else:
-            prev_leg = self.json['legs'][leg_i - 1]
-            prev_leg_end = datetime.fromtimestamp(
-                prev_leg['endTime'] / 1000.0)
-            curr_leg = self.json['legs'][leg_i]    
-            curr_leg_start = datetime.fromtimestamp(
-                curr_leg['startTime'] / 1000.0)
-            return curr_leg_start - prev_leg_end    
+            return timedelta(seconds=self._leg_start_s[leg_i] \
+                - self._leg_end_s[leg_i - 1])
 
     def get_tfer_wait_td(self):
         """I am calling this 'transfer wait' since OTP records in the
         waitingTime value just time waiting for transfers, not the initial
         wait."""
-        return timedelta(seconds=self.json['waitingTime'])
+        return timedelta(seconds=self._waiting_s)
 
     def get_total_wait_td(self, trip_req_start_dt):
         return self.get_init_wait_td(trip_req_start_dt) \
             + self.get_tfer_wait_td()
 
     def get_transit_td(self):
-        return timedelta(seconds=self.json['transitTime'])
+        return timedelta(seconds=self._transit_s)
 
     def get_walk_td(self):
-        return timedelta(seconds=self.json['walkTime'])
+        return timedelta(seconds=self._walk_s)
+
+    def get_walk_dist_m(self):
+        return self._walk_dist_m
+
+    def get_transfers(self):
+        """As given by OTP:- so -1 for walk-only trips."""
+        return self._transfers
 
     def get_dist_travelled(self):
-        """Returns the total trip distance, in m."""
-        if not self._dist_travelled:
-            dist_travelled = 0
-            for leg in self.json['legs']:
-                dist_travelled += leg['distance']
-            self._dist_travelled = dist_travelled
+        """Returns the total trip distance, in m (of the legs OTP gave a
+        distance for)."""
         return self._dist_travelled
+
+    def get_n_legs_missing_dist(self):
+        return len([dist for dist in self._leg_dist_m if _is_missing(dist)])
  
     def get_trip_speed_along_route(self, trip_req_start_dt):
         """Returns the trip speed along route, in km/h"""
@@ -97,84 +233,113 @@ class TripItinerary:
 
     def get_longest_walk_leg_dist_m(self):
         longest_walk_leg_m = 0.0
-        for leg in self.json['legs']:
-            if leg['mode'] == otp_config.OTP_WALK_MODE:
-                walk_len = leg['distance']
+        for mode_id, walk_len in zip(self._leg_modes, self._leg_dist_m):
+            if mode_id == _WALK_MODE_ID:
                 if walk_len > longest_walk_leg_m:
                     longest_walk_leg_m = walk_len
         return longest_walk_leg_m
 
+    def get_n_legs(self):
+        return len(self._leg_modes)
+
+    def get_leg_mode(self, leg_i):
+        return get_interned_value(self._leg_modes[leg_i])
+
+    def get_leg_agency(self, leg_i):
+        return get_interned_value(self._leg_agencies[leg_i])
+
+    def get_leg_route(self, leg_i):
+        """Returns the leg's route, as a (route ID, short name, long name)
+        tuple."""
+        return get_interned_value(self._leg_routes[leg_i])
+
+    def get_leg_dist_m(self, leg_i):
+        return self._leg_dist_m[leg_i]
+
+    def get_leg_duration_sec(self, leg_i):
+        return self._leg_duration_s[leg_i]
+
     def get_set_of_modes_used(self):
         """Returns the Set of modes used in this trip (as strings)."""
-        modes_used = set()
-        for leg in self.json['legs']:
-            modes_used.add(leg['mode'])
-        return modes_used
+        return set(map(get_interned_value, set(self._leg_modes)))
 
     def get_mode_sequence(self):
         """Returns the modes used in this trip, in the order they were
         used."""
-        modes_used_seq = []
-        for leg in self.json['legs']:
-            modes_used_seq.append(leg['mode'])
-        return modes_used_seq
+        return map(get_interned_value, self._leg_modes)
 
     def get_first_non_walk_mode(self):
         """Returns as a string, the first mode used in the trip other than
         WALK. If the trip only contained a single walk leg, returns None."""
         first_non_walk_mode = None
-        if len(self.json['legs']) > 1 \
-                or self.json['legs'][0]['mode'] != otp_config.OTP_WALK_MODE:
-            for leg in self.json['legs']:
-                if leg['mode'] != otp_config.OTP_WALK_MODE:
-                    first_non_walk_mode = leg['mode']
+        if len(self._leg_modes) > 1 \
+                or self._leg_modes[0] != _WALK_MODE_ID:
+            for mode_id in self._leg_modes:
+                if mode_id != _WALK_MODE_ID:
+                    first_non_walk_mode = get_interned_value(mode_id)
                     break
             assert first_non_walk_mode
         return first_non_walk_mode        
 
     def get_dist_m_by_mode(self):
         dist_m_by_mode = {}
-        for leg in self.json['legs']:
-            mode = leg['mode']
+        for mode_id, dist in zip(self._leg_modes, self._leg_dist_m):
+            mode = get_interned_value(mode_id)
+            if _is_missing(dist):
+                dist = 0.0
             if mode not in dist_m_by_mode:
-                dist_m_by_mode[mode] = leg['distance']
+                dist_m_by_mode[mode] = dist
             else:    
-                dist_m_by_mode[mode] += leg['distance']
+                dist_m_by_mode[mode] += dist
         return dist_m_by_mode
 
     def get_set_of_agencies_used(self):
         """Returns all the agencies used in this trip, as a Set of strings."""
         agencies_set = set()
-        for leg in self.json['legs']:
-            mode = leg['mode']
-            if mode == otp_config.OTP_WALK_MODE: continue
-            agency = leg['agencyName']
-            agencies_set.add(agency)
+        for mode_id, agency_id in zip(self._leg_modes, self._leg_agencies):
+            if mode_id == _WALK_MODE_ID: continue
+            agencies_set.add(get_interned_value(agency_id))
         return agencies_set
 
     def get_time_sec_by_mode(self):
         time_s_by_mode = {}
-        for leg in self.json['legs']:
-            mode = leg['mode']
-            time_sec = leg['duration'] / 1000.0
+        for mode_id, time_sec in zip(self._leg_modes, self._leg_duration_s):
+            mode = get_interned_value(mode_id)
+            if _is_missing(time_sec):
+                time_sec = 0.0
             if mode not in time_s_by_mode:
                 time_s_by_mode[mode] = time_sec
             else:    
                 time_s_by_mode[mode] += time_sec
         return time_s_by_mode
 
-    def save_to_file(self, output_fname):
-        f = open(output_fname, 'w')
-        f.write(json.dumps(self.json))
-        f.close()
+    def save_to_file(self, output_fname, compress=False, zdict=None):
+        """If compress, the JSON is saved zlib-compressed (using zdict, an
+        itin_codec.ZDict, if given). The file is written atomically, so is
+        never left partly written."""
+        result_files.write_file_atomic(output_fname,
+            itin_codec.encode_itin_json_str(json.dumps(self.json),
+                compress, zdict))
         return
 
-def read_trip_itin_from_file(input_fname):
-    f = open(input_fname, 'r')
-    itin_str = f.read()
+def read_trip_itin_json_from_file(input_fname):
+    """Reads files saved either compressed or not."""
+    f = open(input_fname, 'rb')
+    # Any compression dictionary is in the graph's dir, not a hashed subdir.
+    itin_str = itin_codec.decode_itin_json_str(f.read(),
+        result_files.get_graph_dir(input_fname))
     f.close()
-    itin_json = json.loads(itin_str)
-    itin = TripItinerary(itin_json)
+    return json.loads(itin_str)
+
+def read_trip_itin_from_file(input_fname, keep_json=True):
+    """If not keep_json, the itinerary doesn't keep its JSON data, but
+    re-reads it from the file when it's used."""
+    itin_json = read_trip_itin_json_from_file(input_fname)
+    if keep_json:
+        itin = TripItinerary(itin_json)
+    else:
+        itin = TripItinerary(itin_json, functools.partial(
+            read_trip_itin_json_from_file, input_fname))
     return itin
 
 def print_single_trip_stats(origin_lon_lat, dest_lon_lat, trip_req_start_dt,
@@ -209,9 +374,9 @@ def print_single_trip_stats(origin_lon_lat, dest_lon_lat, trip_req_start_dt,
     print "  %s (%.2f%%) waiting (%s initial, %s transfers)" \
         % (total_wait_td, wait_pct, init_wait_td, tfer_wait_td)
     print "  %s (%.2f%%) walking (for %.2fm)" \
-        % (walk_td, walk_pct, ti.json['walkDistance'])
+        % (walk_td, walk_pct, ti.get_walk_dist_m())
     print "  %s (%.2f%%) on transit vehicles (%d transfers)" \
-        % (transit_td, transit_pct, ti.json['transfers'])
+        % (transit_td, transit_pct, ti.get_transfers())
     print "Total trip distance (as crow flies): %.2fm." % dist_direct
     print "Total trip distance (travelled): %.2fm." \
         % dist_travelled_km * 1000.0
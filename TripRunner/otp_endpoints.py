@@ -0,0 +1,177 @@
+"""Spreading routing requests across several OTP servers.
+
+Where several OTP server instances have the same graphs loaded, an
+EndpointBalancer can be passed to the otp_router functions in place of a
+single server URL. Each request is then sent to one of the servers able to
+route on the requested graph (router ID), chosen by one of:
+ * LEAST_OUTSTANDING:- the server with the fewest requests in progress.
+ * LOWEST_LATENCY:- the server with the lowest recent response time,
+   weighted by its requests in progress.
+Servers that fail several requests in a row are ejected for a while.
+"""
+
+import json
+import threading
+import time
+import urllib2
+
+from pyOTPA import http_pool
+
+LEAST_OUTSTANDING = "least_outstanding"
+LOWEST_LATENCY = "lowest_latency"
+BALANCE_STRATEGIES = [LEAST_OUTSTANDING, LOWEST_LATENCY]
+
+DEFAULT_EJECT_AFTER_FAILURES = 3
+DEFAULT_EJECT_SECONDS = 30
+# Weighting of the newest response time, in each endpoint's moving average.
+LATENCY_EWMA_ALPHA = 0.2
+
+ROUTERS_API_PATH = "/opentripplanner-api-webapp/ws/routers"
+
+class NoEndpointAvailableError(urllib2.URLError):
+    """Raised when no healthy endpoint has the requested router ID loaded.
+    Subclasses urllib2.URLError, so is handled as a transport failure (and
+    so retried) by the router."""
+    pass
+
+class OTPEndpoint:
+    """An OTP server, and statistics about requests made to it.
+
+    router_ids is the set of router IDs (graphs) the server has loaded, or
+    None if unknown (in which case it's assumed to have them all)."""
+
+    def __init__(self, url, router_ids=None):
+        self.url = url
+        self.router_ids = router_ids
+        self.outstanding = 0
+        self.latency_ewma = None
+        self.n_requests = 0
+        self.n_failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = None
+
+    def has_router(self, otp_router_id):
+        return self.router_ids is None or otp_router_id is None \
+            or otp_router_id in self.router_ids
+
+    def is_ejected(self, now):
+        return self.ejected_until is not None and now < self.ejected_until
+
+    def __str__(self):
+        return self.url
+
+class EndpointBalancer:
+    """Chooses which of a set of OTPEndpoints to send each request to.
+    Safe to share between threads."""
+
+    def __init__(self, endpoints, strategy=LEAST_OUTSTANDING,
+            eject_after_failures=DEFAULT_EJECT_AFTER_FAILURES,
+            eject_seconds=DEFAULT_EJECT_SECONDS):
+        if not endpoints:
+            raise ValueError("At least one endpoint must be given.")
+        if strategy not in BALANCE_STRATEGIES:
+            raise ValueError("Unknown balancing strategy '%s': must be one "\
+                "of %s." % (strategy, BALANCE_STRATEGIES))
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.eject_after_failures = eject_after_failures
+        self.eject_seconds = eject_seconds
+        self._next_start_ii = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_urls(cls, server_urls, **kwargs):
+        return cls([OTPEndpoint(url) for url in server_urls], **kwargs)
+
+    def discover_router_ids(self, conn_pool=None):
+        """Query each endpoint's routers API, to find out which router IDs
+        it has loaded. Endpoints that can't be queried are left as is."""
+        if conn_pool is None:
+            conn_pool = http_pool.get_default_pool()
+        for endpoint in self.endpoints:
+            try:
+                res_str = conn_pool.get(endpoint.url + ROUTERS_API_PATH)
+                res = json.loads(res_str)
+                endpoint.router_ids = set(router_info['routerId'] \
+                    for router_info in res['routerInfo'])
+            except (urllib2.URLError, ValueError, KeyError, TypeError), e:
+                print "Warning:- couldn't get list of routers loaded on OTP "\
+                    "server at URL %s (%s):- assuming it has all of them." \
+                    % (endpoint.url, e)
+        return
+
+    def choose(self, otp_router_id):
+        """Returns the endpoint to send a request on otp_router_id to, and
+        counts the request as outstanding on it. Callers must call release()
+        once the request is done. Raises NoEndpointAvailableError if no
+        endpoint with this router ID is currently healthy."""
+        now = time.time()
+        with self._lock:
+            n_endpoints = len(self.endpoints)
+            # Rotate the starting point, so ties are shared round-robin.
+            start_ii = self._next_start_ii
+            self._next_start_ii = (start_ii + 1) % n_endpoints
+            best = None
+            best_score = None
+            for offset in range(n_endpoints):
+                endpoint = self.endpoints[(start_ii + offset) % n_endpoints]
+                if not endpoint.has_router(otp_router_id) \
+                        or endpoint.is_ejected(now):
+                    continue
+                score = self._score(endpoint)
+                if best is None or score < best_score:
+                    best = endpoint
+                    best_score = score
+            if best is None:
+                raise NoEndpointAvailableError("No healthy OTP server "\
+                    "available with router ID '%s' loaded." % otp_router_id)
+            best.outstanding += 1
+            best.n_requests += 1
+        return best
+
+    def _score(self, endpoint):
+        if self.strategy == LOWEST_LATENCY:
+            # Endpoints without a latency measure yet get tried first.
+            latency = endpoint.latency_ewma or 0.0
+            return latency * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def release(self, endpoint, latency=None, success=True):
+        """Record a request to endpoint as completed, taking latency
+        seconds. Endpoints with too many consecutive failures are ejected
+        for eject_seconds."""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success:
+                endpoint.consecutive_failures = 0
+                endpoint.ejected_until = None
+                if latency is not None:
+                    if endpoint.latency_ewma is None:
+                        endpoint.latency_ewma = latency
+                    else:
+                        endpoint.latency_ewma = LATENCY_EWMA_ALPHA * latency \
+                            + (1 - LATENCY_EWMA_ALPHA) * endpoint.latency_ewma
+            else:
+                endpoint.n_failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.eject_after_failures:
+                    endpoint.ejected_until = time.time() + self.eject_seconds
+                    print "\tWarning:- OTP server at URL %s failed %d "\
+                        "requests in a row:- ejecting it for %d seconds." \
+                        % (endpoint.url, endpoint.consecutive_failures,
+                           self.eject_seconds)
+        return
+
+    def print_stats(self):
+        print "Requests by OTP server:"
+        for endpoint in self.endpoints:
+            if endpoint.latency_ewma is not None:
+                latency_str = "%.3fs" % endpoint.latency_ewma
+            else:
+                latency_str = "n/a"
+            print "  %s: %d requests, %d failed, recent latency %s" \
+                % (endpoint.url, endpoint.n_requests, endpoint.n_failures,
+                   latency_str)
+
+    def __str__(self):
+        return ", ".join(endpoint.url for endpoint in self.endpoints)
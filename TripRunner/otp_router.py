@@ -2,7 +2,6 @@
 
 import urllib
 import urllib2
-import socket
 import os.path
 import json
 import copy
@@ -10,29 +9,40 @@ import time
 from datetime import datetime
 
 from pyOTPA import otp_config
+from pyOTPA import http_pool
+from pyOTPA import itin_store
+from pyOTPA import itin_codec
+from pyOTPA import url_templates
 from pyOTPA import Trip
 from pyOTPA import TripItinerary
+from pyOTPA.TripRunner import routing_pool
+from pyOTPA.TripRunner import routing_retries
+from pyOTPA.TripRunner import otp_endpoints
+from pyOTPA.TripRunner import run_manifest
+from pyOTPA.TripRunner import result_writer
+from pyOTPA.TripRunner import request_planning
+from pyOTPA.TripRunner import plan_projection
+from pyOTPA.TripRunner import routing_telemetry
+from pyOTPA.TripRunner.routing_telemetry import timed_phase
 
 PROGRESS_PRINT_PERCENTAGE = 1
 
 MAX_SECONDS_TO_WAIT_FOR_RESULT = 30
-ROUTE_RETRIES = 2
-SECONDS_TO_WAIT_BEFORE_RETRY = 10
 MAX_ALLOWED_FAIL_TO_GET_RESULT = 10
+DEFAULT_MAX_IN_FLIGHT = 1
+
+DEFAULT_RETRY_POLICY = routing_retries.RetryPolicy()
+
+# Status of an attempt to route a single trip.
+RESULT_OK = "ok"
+RESULT_NO_ITIN = "no_itin"
+RESULT_FAILED = "failed"
 
 def build_trip_spec_url_section(routing_params, trip_date,
         trip_time, origin_lon_lat, dest_lon_lat):
-    tripReqStr = ""
-    date_str = trip_date.strftime(otp_config.OTP_DATE_FMT)
-    time_str = trip_time.strftime(otp_config.OTP_TIME_FMT)
-    # General OTP routing request stuff
-    tripReqStr += "&".join([name+'='+urllib2.quote(str(val)) for name, val \
-        in routing_params.iteritems()])
-    tripReqStr += '&'+'fromPlace'+'='+str(origin_lon_lat[1]) \
-        + ','+str(origin_lon_lat[0])
-    tripReqStr += '&'+'toPlace'+'='+str(dest_lon_lat[1])+','+str(dest_lon_lat[0])
-    tripReqStr += '&'+'time'+'='+date_str+'T'+urllib2.quote(time_str)
-    return tripReqStr
+    template = url_templates.get_trip_plan_template(routing_params)
+    return template.build_spec_section(trip_date, trip_time, origin_lon_lat,
+        dest_lon_lat)
 
 def build_trip_web_planner_app_url(base_web_app_url, routing_params, trip_date,
         trip_time, origin_lon_lat, dest_lon_lat, otp_router_id=None):
@@ -56,39 +66,104 @@ def build_trip_web_planner_app_url(base_web_app_url, routing_params, trip_date,
 
 def build_trip_request_url(server_url, routing_params, trip_date, trip_time,
         origin_lon_lat, dest_lon_lat, otp_router_id=None):
-    date_str = trip_date.strftime(otp_config.OTP_DATE_FMT)
-    time_str = trip_time.strftime(otp_config.OTP_TIME_FMT)
-
-    reqStr = "/opentripplanner-api-webapp/ws" + "/plan" + '?'
-    reqStr += build_trip_spec_url_section(routing_params, trip_date,
-        trip_time, origin_lon_lat, dest_lon_lat) 
-    if otp_router_id is not None:
-        reqStr += '&'+'routerId'+'='+otp_router_id
-    # Add server URL
-    url = server_url + reqStr
-    return url
+    """Only the per-trip fields are formatted for each call:- the rest of
+    the URL is encoded once per routing_params dict and router ID (see
+    url_templates)."""
+    template = url_templates.get_trip_plan_template(routing_params,
+        otp_router_id)
+    return template.build_url(server_url, trip_date, trip_time,
+        origin_lon_lat, dest_lon_lat)
 
-def route_trip(server_url, routing_params, trip_req_start_date,
+def request_trip_plan(server_url, routing_params, trip_req_start_date,
         trip_req_start_time, origin_lon_lat, dest_lon_lat, otp_router_id,
-        server_timeout=MAX_SECONDS_TO_WAIT_FOR_RESULT):
+        server_timeout=MAX_SECONDS_TO_WAIT_FOR_RESULT, conn_pool=None,
+        graph_telemetry=None):
+    """Requests the OTP server to route a trip, returning the raw response
+    string. Raises a urllib2.URLError (usually http_pool.HTTPRequestError)
+    if no response could be obtained.
 
-    url = build_trip_request_url(server_url, routing_params,
-        trip_req_start_date, 
-        trip_req_start_time, origin_lon_lat, dest_lon_lat,
-        otp_router_id)
+    server_url can also be an otp_endpoints.EndpointBalancer, in which case
+    the request is sent to whichever of its servers it chooses.
+
+    Requests are made over the keep-alive connections of conn_pool, or
+    if this isn't given, the shared default http_pool.
+
+    If a graph_telemetry (routing_telemetry.GraphTelemetry) is given, the
+    time taken to build the URL and wait on the server are added to it."""
+
+    if conn_pool is None:
+        conn_pool = http_pool.get_default_pool()
+
+    if isinstance(server_url, otp_endpoints.EndpointBalancer):
+        balancer = server_url
+        endpoint = balancer.choose(otp_router_id)
+        start_time = time.time()
+        latency = None
+        try:
+            data = request_trip_plan(endpoint.url, routing_params,
+                trip_req_start_date, trip_req_start_time, origin_lon_lat,
+                dest_lon_lat, otp_router_id, server_timeout, conn_pool,
+                graph_telemetry)
+            latency = time.time() - start_time
+        finally:
+            # Always release the endpoint, or its outstanding count would
+            # stay raised. Any error (including an interrupt) counts as a
+            # failed request.
+            balancer.release(endpoint, latency, success=latency is not None)
+        return data
+
+    with timed_phase(graph_telemetry, routing_telemetry.PHASE_URL_BUILD):
+        url = build_trip_request_url(server_url, routing_params,
+            trip_req_start_date, 
+            trip_req_start_time, origin_lon_lat, dest_lon_lat,
+            otp_router_id)
     #print url
+    start_time = time.time()
+    try:
+        return conn_pool.get(url, timeout=server_timeout)
+    finally:
+        if graph_telemetry:
+            latency = time.time() - start_time
+            graph_telemetry.add_phase_time(routing_telemetry.PHASE_NETWORK,
+                latency)
+            graph_telemetry.record_request(latency)
 
+def route_trip(server_url, routing_params, trip_req_start_date,
+        trip_req_start_time, origin_lon_lat, dest_lon_lat, otp_router_id,
+        server_timeout=MAX_SECONDS_TO_WAIT_FOR_RESULT, conn_pool=None,
+        result_cache=None):
+    """As for request_trip_plan(), but returns None if no response could be
+    obtained. If a result_cache is given, it's checked first, and only if
+    the request isn't cached is the server asked:- valid responses are then
+    added to it."""
+    cache_key = None
+    if result_cache:
+        cache_key = result_cache.make_key(otp_router_id, routing_params,
+            origin_lon_lat, dest_lon_lat,
+            datetime.combine(trip_req_start_date, trip_req_start_time))
+        data = result_cache.get(cache_key)
+        if data is not None:
+            return data
     data = None
     try:
-        response = urllib2.urlopen(url, timeout=server_timeout)
-        data = response.read()
+        data = request_trip_plan(server_url, routing_params,
+            trip_req_start_date, trip_req_start_time, origin_lon_lat,
+            dest_lon_lat, otp_router_id, server_timeout, conn_pool)
     except urllib2.URLError:
         # In case of timeouts etc:- just return no data.
         data = None
-    except socket.timeout:
-        # In some cases this different exception is how timeouts raised
-        # see http://heyman.info/2010/apr/22/python-urllib2-timeout-issue/
-        data = None
+    if data is not None and result_cache:
+        # As in route_trip_and_get_itin(), don't cache garbled responses,
+        # or planner errors that might not recur.
+        try:
+            res = json.loads(data)
+        except ValueError:
+            return data
+        error = res.get('error') or {}
+        retryable_error = DEFAULT_RETRY_POLICY.is_retryable_planner_error(
+            error.get('id'))
+        if res.get('plan') or not retryable_error:
+            result_cache.put(cache_key, data)
     return data
 
 def route_single_trip_multi_graphs_print_stats(server_url, routing_params,
@@ -121,14 +196,470 @@ def route_single_trip_multi_graphs_print_stats(server_url, routing_params,
                     % (origin_lon_at, dest_lon_lat, trip_req_start_dt)
     return
 
+class TripRouteResult:
+    """The outcome of routing a single trip on one graph.
+
+    status is one of RESULT_OK, RESULT_NO_ITIN or RESULT_FAILED. For
+    failures, fail_cause is one of the routing_retries.CAUSE_* values.
+    latency is the time in seconds the last request made took. Results
+    found in a result cache have from_cache set, and no attempts."""
+
+    def __init__(self, status, itin=None, err_msg=None, fail_cause=None,
+            n_attempts=0, latency=None, from_cache=False):
+        self.status = status
+        self.itin = itin
+        self.err_msg = err_msg
+        self.fail_cause = fail_cause
+        self.n_attempts = n_attempts
+        self.latency = latency
+        self.from_cache = from_cache
+
+def _get_result_from_plan(res, n_attempts, latency, from_cache=False,
+        itin_projection=None, graph_telemetry=None):
+    """Make a TripRouteResult from a parsed plan response, that is either a
+    valid plan or a non-retryable planner error. The itinerary is reduced
+    to the fields in itin_projection, if given."""
+    if not res['plan']:
+        # The planner worked correctly, but found no itinerary.
+        error = res.get('error') or {}
+        return TripRouteResult(RESULT_NO_ITIN, err_msg=error.get('msg'),
+            n_attempts=n_attempts, latency=latency, from_cache=from_cache)
+    try:
+        with timed_phase(graph_telemetry,
+                routing_telemetry.PHASE_ITIN_CONSTRUCT):
+            itin_json = plan_projection.get_first_itinerary(res,
+                itin_projection)
+            ti = TripItinerary.TripItinerary(itin_json)
+    except (TypeError, IndexError, KeyError):
+        return TripRouteResult(RESULT_NO_ITIN,
+            err_msg="Unexpected failure to get trip itinerary from "\
+                "received result.",
+            n_attempts=n_attempts, latency=latency, from_cache=from_cache)
+    return TripRouteResult(RESULT_OK, itin=ti, n_attempts=n_attempts,
+        latency=latency, from_cache=from_cache)
+
+def route_trip_and_get_itin(server_url, routing_params, trip, otp_router_id,
+        retry_policy=None, circuit_breaker=None, result_cache=None,
+        itin_projection=None, graph_telemetry=None):
+    """Route a single trip on the given graph, retrying failed requests
+    according to retry_policy (a routing_retries.RetryPolicy). If a
+    circuit_breaker is given, requests wait on it before being sent, and
+    record their success or failure with it.
+
+    If a result_cache (a result_cache.RoutingResultCache) is given, it's
+    checked before making any request, and valid responses are added to it.
+    (The cache keeps full responses, whatever itin_projection is used.)
+
+    If an itin_projection (plan_projection.PlanProjection) is given, the
+    resulting itinerary only keeps the fields it specifies.
+
+    If a graph_telemetry (routing_telemetry.GraphTelemetry) is given, the
+    time spent in each phase of routing the trip is added to it.
+
+    Returns a TripRouteResult."""
+    if retry_policy is None:
+        retry_policy = DEFAULT_RETRY_POLICY
+    trip_req_start_dt = trip[Trip.START_DTIME]
+    trip_req_start_date = trip_req_start_dt.date()
+    trip_req_start_time = trip_req_start_dt.time()
+
+    cache_key = None
+    if result_cache:
+        cache_key = result_cache.make_key(otp_router_id, routing_params,
+            trip[Trip.ORIGIN], trip[Trip.DEST], trip_req_start_dt)
+        res_str = result_cache.get(cache_key)
+        if res_str is not None:
+            with timed_phase(graph_telemetry,
+                    routing_telemetry.PHASE_JSON_PARSE):
+                res = json.loads(res_str)
+            return _get_result_from_plan(res, 0, None, from_cache=True,
+                itin_projection=itin_projection,
+                graph_telemetry=graph_telemetry)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        if circuit_breaker:
+            circuit_breaker.wait_until_allowed()
+        try:
+            res = None
+            request_start_time = time.time()
+            try:
+                res_str = request_trip_plan(server_url, routing_params,
+                    trip_req_start_date, trip_req_start_time,
+                    trip[Trip.ORIGIN],
+                    trip[Trip.DEST],
+                    otp_router_id=otp_router_id,
+                    graph_telemetry=graph_telemetry)
+                with timed_phase(graph_telemetry,
+                        routing_telemetry.PHASE_JSON_PARSE):
+                    res = json.loads(res_str)
+            except urllib2.URLError, e:
+                fail_cause = routing_retries.classify_transport_error(e)
+                err_msg = str(e)
+            except ValueError, e:
+                # A truncated or otherwise garbled response.
+                fail_cause = routing_retries.CAUSE_BAD_RESPONSE
+                err_msg = str(e)
+            latency = time.time() - request_start_time
+
+            if res is not None and not res['plan']:
+                error = res.get('error') or {}
+                if retry_policy.is_retryable_planner_error(error.get('id')):
+                    fail_cause = routing_retries.CAUSE_PLANNER_ERROR
+                    err_msg = error.get('msg')
+                    res = None
+
+            if res is None:
+                if circuit_breaker:
+                    circuit_breaker.record_failure()
+            elif circuit_breaker:
+                circuit_breaker.record_success()
+        finally:
+            if circuit_breaker:
+                # In case this was the half-open probe, and it failed
+                # with an unexpected error.
+                circuit_breaker.release_probe()
+
+        if res is None:
+            if retry_policy.should_retry(attempt):
+                time.sleep(retry_policy.get_backoff_seconds(attempt))
+                continue
+            return TripRouteResult(RESULT_FAILED, err_msg=err_msg,
+                fail_cause=fail_cause, n_attempts=attempt, latency=latency)
+
+        if result_cache:
+            result_cache.put(cache_key, res_str)
+        return _get_result_from_plan(res, attempt, latency,
+            itin_projection=itin_projection, graph_telemetry=graph_telemetry)
+
+def _route_and_save_trip(server_url, routing_params, otp_router_id,
+        trip, trip_ids, retry_policy, circuit_breaker, result_cache,
+        itin_projection, graph_telemetry=None, result_writer=None):
+    """Worker function for route_trip_set_on_graphs(): routes one trip, and
+    if a result_writer (result_writer.BatchedResultWriter) is given, queues
+    any resulting itinerary to be saved for each of trip_ids (the IDs of
+    all trips with this request)."""
+    route_result = route_trip_and_get_itin(server_url, routing_params, trip,
+        otp_router_id, retry_policy, circuit_breaker, result_cache,
+        itin_projection, graph_telemetry)
+    if route_result.itin and result_writer:
+        with timed_phase(graph_telemetry, routing_telemetry.PHASE_FILE_WRITE):
+            result_writer.add_result(trip_ids,
+                json.dumps(route_result.itin.json))
+    return route_result
+
+class _GraphRoutingRun:
+    """The state of routing a set of trips on one graph (with one set of
+    routing params), within route_trip_set_on_graphs()."""
+
+    def __init__(self, graph_name, graph_full, routing_params, output_subdir,
+            n_trips, save_incrementally, resume_existing, retry_failed,
+            retry_policy, telemetry, max_in_flight, manifest_fname,
+            use_itin_store, compress_itins, hashed_result_dirs):
+        self.graph_name = graph_name
+        self.graph_full = graph_full
+        self.routing_params = routing_params
+        self.n_trips = n_trips
+        self.resume_existing = resume_existing
+        self.retry_failed = retry_failed
+        if save_incrementally:
+            if not os.path.exists(output_subdir):
+                os.makedirs(output_subdir)
+
+        print "\nRouting the %d requested trips on the %s network/timetable " \
+            "(max %d requests in flight): " \
+            % (n_trips, graph_name, max_in_flight)
+        self.trip_results = {}
+        self.trips_routed = 0
+        self.trips_processed = 0
+        self.trips_failed_to_get_result = 0
+        self.trips_failed_in_a_row = 0
+        self.print_increment = n_trips * (PROGRESS_PRINT_PERCENTAGE / 100.0)
+        self.next_print_total = self.print_increment
+        self.circuit_breaker = retry_policy.new_circuit_breaker()
+        self.graph_telemetry = telemetry.new_graph(graph_name, n_trips)
+        # Number of trips handed out to route, but whose results aren't
+        # back yet.
+        self.n_pending = 0
+        self.all_queued = False
+        self.finished = False
+        self.given_up = False
+        self.give_up_msg = None
+        self.give_up_reported = False
+
+        self.manifest_entries = {}
+        self.result_writer = None
+        if save_incrementally:
+            if resume_existing or retry_failed:
+                if not run_manifest.has_manifest(output_subdir):
+                    n_existing = run_manifest.bootstrap_manifest_from_results(
+                        output_subdir, RESULT_OK)
+                    if n_existing:
+                        print "(Created run manifest in %s from %d existing "\
+                            "result files.)" % (output_subdir, n_existing)
+                self.manifest_entries = run_manifest.read_manifest(
+                    output_subdir)
+            manifest_writer = run_manifest.RunManifestWriter(
+                output_subdir, manifest_fname)
+            itin_zdict = None
+            if compress_itins:
+                itin_zdict = itin_codec.get_writing_zdict(output_subdir)
+            itin_writer = None
+            if use_itin_store:
+                itin_writer = itin_store.ItinStoreWriter(output_subdir,
+                    compress=compress_itins, zdict=itin_zdict)
+            self.result_writer = result_writer.BatchedResultWriter(
+                output_subdir, itin_writer, compress_itins, itin_zdict,
+                hashed_result_dirs, manifest_writer)
+
+    def is_trip_to_skip(self, trip_id):
+        if self.retry_failed:
+            entry = self.manifest_entries.get(trip_id)
+            return entry is None or entry.status != RESULT_FAILED
+        elif self.resume_existing:
+            return trip_id in self.manifest_entries
+        return False
+
+    def get_route_args(self, trip, trip_ids):
+        """Returns the args for a task to route trip on this graph, on
+        behalf of all trip_ids not already routed."""
+        route_ids = []
+        skipped_ids = []
+        for trip_id in trip_ids:
+            if self.is_trip_to_skip(trip_id):
+                skipped_ids.append(trip_id)
+            else:
+                route_ids.append(trip_id)
+        self.n_pending += 1
+        return self, trip, route_ids, skipped_ids
+
+    def give_up(self, msg):
+        if not self.given_up:
+            self.give_up_msg = msg
+            self.given_up = True
+
+    def record_result(self, trip, route_ids, skipped_ids, result,
+            server_url):
+        """Record the result of a task from get_route_args() (None if
+        there were no trips to route, or the graph was given up on)."""
+        self.n_pending -= 1
+        # Skipped trips were already routed in a previous run.
+        self.trips_processed += len(skipped_ids)
+        if skipped_ids:
+            self.graph_telemetry.record_skipped(len(skipped_ids))
+        if result is not None:
+            self.graph_telemetry.record_result(result.status,
+                result.fail_cause, len(route_ids))
+            trip_id = route_ids[0]
+            if len(route_ids) > 1:
+                trip_id_str = "%s (and %d identical trips)" \
+                    % (trip_id, len(route_ids) - 1)
+            else:
+                trip_id_str = str(trip_id)
+            if self.result_writer:
+                for route_id in route_ids:
+                    self.result_writer.record_outcome(route_id,
+                        result.status, result.n_attempts, result.latency,
+                        result.fail_cause)
+            if result.status == RESULT_FAILED:
+                print "\tWarning:- requested trip ID %s from %s to %s at "\
+                    "%s time on graph %s failed to route, after %d "\
+                    "attempts (%s: %s). "\
+                    % (trip_id_str, trip[Trip.ORIGIN], trip[Trip.DEST],
+                       trip[Trip.START_DTIME], self.graph_name,
+                       result.n_attempts, result.fail_cause,
+                       result.err_msg)
+                self.trips_processed += len(route_ids)
+                self.trips_failed_to_get_result += 1
+                self.trips_failed_in_a_row += 1
+            else:
+                if not result.from_cache:
+                    self.trips_failed_in_a_row = 0
+                if result.status == RESULT_NO_ITIN:
+                    print "\tWarning:- requested trip ID %s from %s to "\
+                        "%s at %s time on graph %s failed to generate "\
+                        "valid itererary. "\
+                        "Error msg returned by OTP router was:\n\t\t%s"\
+                        % (trip_id_str, trip[Trip.ORIGIN], trip[Trip.DEST],
+                           trip[Trip.START_DTIME],
+                           self.graph_name, result.err_msg)
+                for route_id in route_ids:
+                    self.trip_results[route_id] = result.itin
+                self.trips_routed += len(route_ids)
+                self.trips_processed += len(route_ids)
+
+        if self.trips_processed >= self.next_print_total:
+            while self.trips_processed >= self.next_print_total:
+                self.next_print_total += self.print_increment
+            percent_done = self.trips_processed / float(self.n_trips) * 100.0
+            print "...processed %d trips on graph %s (%.1f%% of total, %s.)" \
+                % (self.trips_processed, self.graph_name, percent_done,
+                   self.graph_telemetry.get_progress_str())
+        if self.circuit_breaker:
+            # The breaker pauses routing through server outages, so only
+            # give up once trips keep failing regardless.
+            n_failed = self.trips_failed_in_a_row
+            failed_desc = "trips in a row"
+        else:
+            n_failed = self.trips_failed_to_get_result
+            failed_desc = "trips"
+        if n_failed >= MAX_ALLOWED_FAIL_TO_GET_RESULT:
+            self.give_up("%d %s on graph %s failed to get a routing "\
+                "result back from server at URL %s" \
+                % (n_failed, failed_desc, self.graph_name, server_url))
+        if self.given_up and not self.give_up_reported:
+            print "Error:- %s:- giving up." % self.give_up_msg
+            self.give_up_reported = True
+
+    def close_result_writer(self):
+        """Saves all results still queued to be saved."""
+        if self.result_writer:
+            self.result_writer.close()
+            self.result_writer = None
+
+    def finish(self, telemetry, metrics_extra=None):
+        if self.finished:
+            return
+        self.close_result_writer()
+        telemetry.write(self.graph_telemetry, "graph_done", metrics_extra)
+        self.graph_telemetry.print_summary()
+        self.finished = True
+
 def route_trip_set_on_graphs(server_url, routing_params,
         graph_specs, trips, trips_by_id, output_base_dir,
         trip_req_start_date=None, 
-        save_incrementally=True, resume_existing=False):
+        save_incrementally=True, resume_existing=False,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT, retry_policy=None,
+        retry_failed=False, result_cache=None, dedupe_requests=False,
+        dedupe_coord_decimal_places=None, itin_projection=None,
+        rate_controller=None, telemetry=None, interleave_graphs=False,
+        manifest_fname=run_manifest.MANIFEST_FNAME,
+        request_order=request_planning.ORDER_BY_ID,
+        departure_bucket_minutes=\
+            request_planning.DEFAULT_DEPARTURE_BUCKET_MINUTES,
+        use_itin_store=False, compress_itins=False,
+        hashed_result_dirs=False):
     """Note:- by default trips should have a datetime specified now. But if
-    not and trip_req_start_date is set, will use this date."""
+    not and trip_req_start_date is set, will use this date.
+
+    server_url can be either a single OTP server's URL, or an
+    otp_endpoints.EndpointBalancer to spread requests over several servers.
+
+    max_in_flight sets how many routing requests to send to the server at
+    once, per graph. With the default of 1, trips are routed one at a time.
+    Higher values route trips concurrently using a pool of worker threads:
+    results are still saved incrementally to a file named after each trip ID,
+    but trips may finish in a different order to the order requested.
+    With use_itin_store, results are instead saved incrementally to an
+    itin_store in each graph's output dir. With compress_itins, saved
+    results are zlib-compressed (see itin_codec), using the compression
+    dictionary most recently saved in each output dir, if any. With
+    hashed_result_dirs, result files are saved in the result_files hashed
+    layout, fanned out into subdirs of each graph's output dir, so no one
+    dir holds too many files.
+
+    By default, all trips are routed on one graph before moving on to the
+    next. With interleave_graphs, each trip is instead routed on all the
+    graphs together:- so results for all graphs build up in step (and any
+    part of a run gives paired results to compare), and with max_in_flight
+    above 1, the graphs' routers are all kept busy at once.
+
+    Failed requests are retried according to retry_policy (a
+    routing_retries.RetryPolicy, DEFAULT_RETRY_POLICY if not given). If
+    the policy creates a circuit breaker, each graph gets its own, and
+    routing on a graph is paused while the server seems to be struggling:-
+    only giving up on the graph if the breaker stays open too long, or
+    MAX_ALLOWED_FAIL_TO_GET_RESULT trips in a row still fail to get a
+    result (e.g. the server is up, but failing every request). Otherwise,
+    routing on a graph gives up after MAX_ALLOWED_FAIL_TO_GET_RESULT trips
+    failed to get a result in all.
+
+    When saving incrementally, the outcome of each trip is also appended to
+    a run_manifest in each graph's output dir. With resume_existing, trips
+    already in the manifest are skipped - or with retry_failed, only the
+    trips the manifest records as having failed are routed again. Several
+    processes routing into the same output dir should each be given their
+    own manifest_fname (matching run_manifest.MANIFEST_GLOB):- all
+    manifests in the dir are read when resuming.
+
+    Results (and manifest entries) are saved in batches, by a
+    result_writer.BatchedResultWriter per graph:- written so a crash never
+    leaves a partly-saved result, and a trip is only in the manifest once
+    its result is saved. If routing is interrupted (e.g. by Ctrl-C), the
+    results routed so far are saved before the KeyboardInterrupt is
+    re-raised.
+
+    If a result_cache (result_cache.RoutingResultCache) is given, trips
+    whose request is already in the cache are taken from there rather than
+    requested from the server.
+
+    With dedupe_requests, trips with the same origin, destination and
+    departure minute are routed with just one request per graph, and the
+    result saved for all of them. If dedupe_coord_decimal_places is given,
+    origins and destinations are first rounded to this many decimal places
+    when deciding if trips are the same.
 
-    trip_results_by_graph = {}
+    Requests are sent in order of trip ID by default. With request_order
+    set to request_planning.ORDER_BY_LOCALITY, they're instead sorted by
+    departure time (in buckets of departure_bucket_minutes), then by
+    location of their origin along a space-filling curve:- so consecutive
+    requests are for trips near each other in space and time.
+
+    If an itin_projection (plan_projection.PlanProjection) is given, only
+    the itinerary fields it specifies are kept in the results returned and
+    saved. By default, the whole itinerary is kept.
+
+    If a rate_controller (rate_control.AIMDConcurrencyController) is given,
+    it's fed the latency of each request, and sets how many requests are in
+    flight at once as the server speeds up or slows down:- up to its
+    max_limit, which is then used in place of max_in_flight (and is the
+    limit across all graphs, if interleaving them).
+
+    Progress (including throughput and ETA) and a summary of where time was
+    spent on each graph are recorded with telemetry (a
+    routing_telemetry.RoutingTelemetry), which can also save metrics to a
+    file as routing goes. If not given, metrics are only printed."""
+
+    run_specs = [(graph_name, graph_full, routing_params,
+        os.path.join(output_base_dir, graph_name)) \
+        for graph_name, graph_full in graph_specs.iteritems()]
+    if rate_controller is None and interleave_graphs:
+        pool_size = max_in_flight * len(run_specs)
+    else:
+        pool_size = max_in_flight
+    return route_trip_set_runs(server_url, run_specs, trips_by_id,
+        pool_size, trip_req_start_date, save_incrementally, resume_existing,
+        retry_policy, retry_failed, result_cache, dedupe_requests,
+        dedupe_coord_decimal_places, itin_projection, rate_controller,
+        telemetry, interleave_graphs, manifest_fname, request_order,
+        departure_bucket_minutes, use_itin_store, compress_itins,
+        hashed_result_dirs)
+
+def route_trip_set_runs(server_url, run_specs, trips_by_id, max_in_flight,
+        trip_req_start_date=None, save_incrementally=True,
+        resume_existing=False, retry_policy=None, retry_failed=False,
+        result_cache=None, dedupe_requests=False,
+        dedupe_coord_decimal_places=None, itin_projection=None,
+        rate_controller=None, telemetry=None, interleave_runs=False,
+        manifest_fname=run_manifest.MANIFEST_FNAME,
+        request_order=request_planning.ORDER_BY_ID,
+        departure_bucket_minutes=\
+            request_planning.DEFAULT_DEPARTURE_BUCKET_MINUTES,
+        use_itin_store=False, compress_itins=False,
+        hashed_result_dirs=False):
+    """Routes trips_by_id for each of run_specs, a list of (run name, graph
+    (i.e. OTP router ID), routing params, output subdir) tuples, all through
+    one pool of max_in_flight concurrent requests (or the rate_controller's
+    max_limit, if given). With interleave_runs, each trip is routed for all
+    the runs together, otherwise run by run. Returns a dict of results by
+    run name.
+
+    This is the engine of route_trip_set_on_graphs() (where there's a run
+    per graph, all with the same routing params), which documents the other
+    args."""
+
+    trip_results_by_run = {}
     trips_to_route = None
     if not trip_req_start_date:
         trips_to_route = copy.copy(trips_by_id)
@@ -143,103 +674,132 @@ def route_trip_set_on_graphs(server_url, routing_params,
             else:
                 trips_to_route[trip_id] = trip
 
-    for graph_name, graph_full in graph_specs.iteritems():
-        output_subdir = os.path.join(output_base_dir, graph_name)
-        if save_incrementally:
-            if not os.path.exists(output_subdir):
-                os.makedirs(output_subdir)
+    if retry_policy is None:
+        retry_policy = DEFAULT_RETRY_POLICY
+    if telemetry is None:
+        telemetry = routing_telemetry.RoutingTelemetry()
+    if rate_controller:
+        max_in_flight = rate_controller.max_limit
+    worker_pool = routing_pool.BoundedWorkerPool(max_in_flight,
+        rate_controller)
 
-        print "\nRouting the %d requested trips on the %s network/timetable: " \
-            % (len(trips_to_route), graph_name)
-        trip_results = {}
-        trips_routed = 0
-        trips_processed = 0
-        trips_failed_to_get_result = 0
-        print_increment = len(trips_to_route) * (PROGRESS_PRINT_PERCENTAGE / 100.0)
-        next_print_total = print_increment
-        sorted_trips_to_route = sorted(trips_to_route.iteritems())
-        for trip_ii, trip_tuple in enumerate(sorted_trips_to_route):
-            trip_id, trip = trip_tuple
-            output_fname = os.path.join(output_subdir, "%s.json" % trip_id)
-            output_fname_next = None
-            if trip_ii < len(sorted_trips_to_route) - 1:
-                next_id = sorted_trips_to_route[trip_ii+1][0]
-                output_fname_next = os.path.join(output_subdir,
-                    "%s.json" % next_id)
-
-            if resume_existing and os.path.exists(output_fname):
-                trips_processed += 1
-            elif resume_existing and output_fname_next \
-                    and os.path.exists(output_fname_next):
-                trips_processed += 1    
-            else:
-                trip_req_start_dt = trip[Trip.START_DTIME]
-                trip_req_start_date = trip_req_start_dt.date()
-                trip_req_start_time = trip_req_start_dt.time()
-                res_str = None
-                retries_remain = ROUTE_RETRIES
-                while not res_str and retries_remain > 0:
-                    res_str = route_trip(server_url, routing_params,
-                        trip_req_start_date, trip_req_start_time,
-                        trip[Trip.ORIGIN],
-                        trip[Trip.DEST],
-                        otp_router_id=graph_full)
-                    if not res_str:
-                        retries_remain -= 1
-                        time.sleep(SECONDS_TO_WAIT_BEFORE_RETRY)
-                if not res_str:
-                    print "\tWarning:- requested trip ID %s from %s to %s at "\
-                        "%s time on graph %s failed to route, after %d "\
-                        "retries. "\
-                        % (str(trip_id), trip[Trip.ORIGIN], trip[Trip.DEST],
-                           trip[Trip.START_DTIME], graph_name,
-                           ROUTE_RETRIES)
-                    trips_processed += 1           
-                    trips_failed_to_get_result += 1
-                else:
-                    res = json.loads(res_str)
-                    if not res['plan']:
-                        print "\tWarning:- requested trip ID %s from %s to "\
-                            "%s at %s time on graph %s failed to generate "\
-                            "valid itererary. "\
-                            "Error msg returned by OTP router was:\n\t\t%s"\
-                            % (str(trip_id), trip[Trip.ORIGIN], trip[Trip.DEST],
-                               trip[Trip.START_DTIME],
-                               graph_name, res['error']['msg'])
-                        ti = None
-                    else:    
-                        try:
-                            itin_json = res['plan']['itineraries'][0]
-                            ti = TripItinerary.TripItinerary(itin_json)
-                        except TypeError, IndexError:
-                            print "Unexpected failure to get trip itinerary "\
-                                "from received result."
-                            ti = None
-                    trip_results[trip_id] = ti    
-                    if ti and save_incrementally:
-                        ti.save_to_file(output_fname)
-                    #print "\nTrip from %s to %s, leaving at %s:" \
-                    #   % (trip[Trip.ORIGIN], trip[Trip.DEST],
-                    #      trip_req_start_dt)
-                    #TripItinerary.print_single_trip_stats(
-                    #    trip[Trip.ORIGIN], trip[Trip.DEST],
-                    #    trip_req_start_dt, ti)
-                    trips_routed += 1
-                    trips_processed += 1
-
-            if trips_processed >= next_print_total:
-                while trips_processed >= next_print_total:
-                    next_print_total += print_increment
-                percent_done = trips_processed / \
-                    float(len(trips_to_route)) * 100.0
-                print "...processed %d trips (%.1f%% of total.)" \
-                    % (trips_processed, percent_done)
-            if trips_failed_to_get_result >= MAX_ALLOWED_FAIL_TO_GET_RESULT:
-                print "Error:- %d trips on graph %s failed to get a routing "\
-                    "result back from server at URL %s:- giving up." \
-                    % (trips_failed_to_get_result, graph_name, server_url)
-                break
-        trip_results_by_graph[graph_name] = trip_results
-    return trip_results_by_graph
-    
+    sorted_trips_to_route = sorted(trips_to_route.iteritems())
+    if dedupe_requests:
+        request_groups = request_planning.group_identical_requests(
+            sorted_trips_to_route, dedupe_coord_decimal_places)
+        request_planning.print_dedupe_summary(len(sorted_trips_to_route),
+            len(request_groups))
+    else:
+        request_groups = [(trip, [trip_id]) for trip_id, trip \
+            in sorted_trips_to_route]
+    request_groups = request_planning.order_requests(request_groups,
+        request_order, departure_bucket_minutes)
+
+    graph_runs = []
+    def start_graph_run(run_name, graph_full, routing_params, output_subdir):
+        graph_run = _GraphRoutingRun(run_name, graph_full, routing_params,
+            output_subdir, len(trips_to_route), save_incrementally,
+            resume_existing, retry_failed, retry_policy, telemetry,
+            max_in_flight, manifest_fname, use_itin_store, compress_itins,
+            hashed_result_dirs)
+        graph_runs.append(graph_run)
+        return graph_run
+
+    def trip_route_args():
+        # Generator, so that trips are handed out lazily as the worker
+        # pool is ready for more of them. Graph runs are also started
+        # lazily, so each graph's stats only cover the time it's routed.
+        if interleave_runs:
+            interleaved_runs = [start_graph_run(*run_spec) \
+                for run_spec in run_specs]
+            for trip, trip_ids in request_groups:
+                for graph_run in interleaved_runs:
+                    if not graph_run.given_up:
+                        yield graph_run.get_route_args(trip, trip_ids)
+            for graph_run in interleaved_runs:
+                graph_run.all_queued = True
+        else:
+            for run_spec in run_specs:
+                graph_run = start_graph_run(*run_spec)
+                for trip, trip_ids in request_groups:
+                    if graph_run.given_up:
+                        break
+                    yield graph_run.get_route_args(trip, trip_ids)
+                graph_run.all_queued = True
+
+    def route_trip_task(graph_run, trip, route_ids, skipped_ids):
+        if not route_ids or graph_run.given_up:
+            return None
+        try:
+            return _route_and_save_trip(server_url, graph_run.routing_params,
+                graph_run.graph_full, trip, route_ids, retry_policy,
+                graph_run.circuit_breaker, result_cache, itin_projection,
+                graph_run.graph_telemetry, graph_run.result_writer)
+        except routing_retries.CircuitOpenError, e:
+            graph_run.give_up("routing on graph %s paused for too long, "\
+                "since server at URL %s kept failing (%s)" \
+                % (graph_run.graph_name, server_url, e))
+            return None
+
+    def get_metrics_extra():
+        if rate_controller:
+            return {'concurrency_limit': rate_controller.get_limit()}
+        return None
+
+    def close_result_writers():
+        for graph_run in graph_runs:
+            graph_run.close_result_writer()
+
+    # Kept in a variable (rather than just used in the for loop), so that if
+    # an exception stops the loop, the handlers below choose whether it's
+    # closed (waiting on requests in flight) before or after saving results.
+    routed_trips = worker_pool.imap_unordered(route_trip_task,
+        trip_route_args())
+    try:
+        for args, result in routed_trips:
+            graph_run, trip, route_ids, skipped_ids = args
+            if result is not None and rate_controller \
+                    and not result.from_cache:
+                if result.fail_cause == routing_retries.CAUSE_TIMEOUT:
+                    rate_controller.record_overload()
+                elif result.latency is not None:
+                    rate_controller.record_latency(result.latency)
+            last_print_total = graph_run.next_print_total
+            graph_run.record_result(trip, route_ids, skipped_ids, result,
+                server_url)
+            if rate_controller \
+                    and graph_run.next_print_total != last_print_total:
+                print "...(%s)" % rate_controller.get_status_str()
+            telemetry.maybe_write(graph_run.graph_telemetry,
+                get_metrics_extra())
+            if graph_run.all_queued and graph_run.n_pending == 0:
+                graph_run.finish(telemetry, get_metrics_extra())
+    except KeyboardInterrupt:
+        # Save the results routed so far (so a resumed run carries on from
+        # here) before stopping:- without waiting on requests still in
+        # flight, whose results are discarded.
+        print "\nRouting interrupted:- saving the results routed so far..."
+        close_result_writers()
+        print "...saved."
+        worker_pool.abandon_in_flight()
+        routed_trips.close()
+        raise
+    except:
+        # Let requests in flight finish and save their results first.
+        routed_trips.close()
+        close_result_writers()
+        raise
 
+    for graph_run in graph_runs:
+        graph_run.finish(telemetry, get_metrics_extra())
+        trip_results_by_run[graph_run.graph_name] = graph_run.trip_results
+    http_pool.get_default_pool().print_stats()
+    if isinstance(server_url, otp_endpoints.EndpointBalancer):
+        server_url.print_stats()
+    if result_cache:
+        result_cache.print_stats()
+    if rate_controller:
+        print "Rate controller finished at %s, after %d increases and %d "\
+            "decreases." % (rate_controller.get_status_str(),
+                rate_controller.n_increases, rate_controller.n_decreases)
+    return trip_results_by_run
@@ -0,0 +1,222 @@
+"""Routing the same trips over a grid of routing parameter values (e.g.
+several maxWalkDistance and waitReluctance values), as one job.
+
+Each combination of values in the grid is a sweep point. All the (sweep
+point, graph) runs are routed together, interleaved through one shared pool
+of concurrent requests - so a sweep of many points keeps the server(s) as
+busy as a single run, rather than being run one after another.
+
+Where a parameter makes no difference to routing given the others (e.g.
+bikeBoardCost when not cycling - see DEFAULT_PARAM_RELEVANCE), it's reset
+to its base value. Sweep points that then make identical requests are only
+routed once, and their results linked into each point's output dirs.
+
+Results go to <output_base_dir>/<point name>/<graph name>/, where each
+point's name is made from its parameter values, and an index of the points
+is saved in SWEEP_INDEX_FNAME in the output base dir.
+"""
+
+import os, os.path
+import sys
+import csv
+import shutil
+import itertools
+
+from pyOTPA import otp_config
+from pyOTPA import itin_store
+from pyOTPA import itin_codec
+from pyOTPA import result_files
+from pyOTPA.TripRunner import otp_router
+from pyOTPA.TripRunner import run_manifest
+
+SWEEP_INDEX_FNAME = "sweep_points.csv"
+
+def _uses_transit(routing_params):
+    modes = str(routing_params.get('mode', "TRANSIT,WALK")).split(',')
+    return modes != [otp_config.OTP_WALK_MODE]
+
+def _uses_bike(routing_params):
+    return 'BICYCLE' in str(routing_params.get('mode', "")).split(',')
+
+def _uses_triangle(routing_params):
+    return routing_params.get('optimize') == 'TRIANGLE'
+
+# For routing params that only affect routing in some cases, a function
+# returning whether they do, given all the routing params.
+DEFAULT_PARAM_RELEVANCE = {
+    'maxTransfers': _uses_transit,
+    'transferPenalty': _uses_transit,
+    'walkBoardCost': _uses_transit,
+    'waitReluctance': _uses_transit,
+    'bikeBoardCost': _uses_bike,
+    'bikeSpeed': _uses_bike,
+    'triangleSafetyFactor': _uses_triangle,
+    'triangleSlopeFactor': _uses_triangle,
+    'triangleTimeFactor': _uses_triangle,
+    }
+
+class SweepPoint:
+    """One combination of swept parameter values. routing_params are the
+    params actually requested (with irrelevant params reset). If another
+    point makes the same requests, shares_results_of is its name."""
+
+    def __init__(self, name, swept_values, routing_params):
+        self.name = name
+        self.swept_values = swept_values
+        self.routing_params = routing_params
+        self.shares_results_of = None
+
+def make_point_name(swept_values):
+    """E.g. "maxWalkDistance-1000_waitReluctance-0.95"."""
+    return "_".join("%s-%s" % (name, str(val).replace(',', '+')) \
+        for name, val in sorted(swept_values.iteritems()))
+
+def get_effective_params(base_routing_params, routing_params,
+        param_relevance):
+    """Returns routing_params, with any params that don't affect routing
+    given the others reset to their base value (or removed, if there's
+    none)."""
+    effective_params = dict(routing_params)
+    for name, is_relevant in param_relevance.iteritems():
+        if name in effective_params and not is_relevant(routing_params):
+            if name in base_routing_params:
+                effective_params[name] = base_routing_params[name]
+            else:
+                del effective_params[name]
+    return effective_params
+
+def make_sweep_points(base_routing_params, param_grid,
+        param_relevance=None):
+    """Returns a SweepPoint for each combination of the values in
+    param_grid (a dict of param name to a list of values), applied on top
+    of base_routing_params."""
+    if param_relevance is None:
+        param_relevance = DEFAULT_PARAM_RELEVANCE
+    param_names = sorted(param_grid.keys())
+    points = []
+    points_by_params = {}
+    for values in itertools.product(*[param_grid[name] \
+            for name in param_names]):
+        swept_values = dict(zip(param_names, values))
+        routing_params = dict(base_routing_params)
+        routing_params.update(swept_values)
+        effective_params = get_effective_params(base_routing_params,
+            routing_params, param_relevance)
+        point = SweepPoint(make_point_name(swept_values), swept_values,
+            effective_params)
+        params_key = tuple(sorted(effective_params.iteritems()))
+        if params_key in points_by_params:
+            point.shares_results_of = points_by_params[params_key].name
+        else:
+            points_by_params[params_key] = point
+        points.append(point)
+    return points
+
+def _open_csv_for_write(fname):
+    if sys.version_info >= (3,0,0):
+        return open(fname, 'w', newline='')
+    else:
+        return open(fname, 'wb')
+
+def save_sweep_index(output_base_dir, points):
+    param_names = sorted(points[0].swept_values.keys()) if points else []
+    csv_file = _open_csv_for_write(os.path.join(output_base_dir,
+        SWEEP_INDEX_FNAME))
+    writer = csv.writer(csv_file, delimiter=',')
+    writer.writerow(['point', 'shares_results_of'] + param_names)
+    for point in points:
+        writer.writerow([point.name, point.shares_results_of or ""] \
+            + [point.swept_values[name] for name in param_names])
+    csv_file.close()
+
+def read_sweep_index(output_base_dir):
+    """Returns a list of (point name, name of point whose results it
+    shares or None, dict of swept param values as strings)."""
+    csv_file = open(os.path.join(output_base_dir, SWEEP_INDEX_FNAME), 'r')
+    reader = csv.reader(csv_file, delimiter=',')
+    headers = reader.next()
+    param_names = headers[2:]
+    points = []
+    for row in reader:
+        points.append((row[0], row[1] or None,
+            dict(zip(param_names, row[2:]))))
+    csv_file.close()
+    return points
+
+def link_shared_results(src_subdir, dest_subdir):
+    """Links (or if not possible, copies) the result files (in the same
+    result_files layout, and any itin_store segments and compression
+    dictionaries) in src_subdir into dest_subdir, skipping any already
+    there. Manifests and store indexes are copied, so they can be appended
+    to separately. Returns the number of result files linked."""
+    if not os.path.exists(dest_subdir):
+        os.makedirs(dest_subdir)
+    n_linked = result_files.link_result_files(src_subdir, dest_subdir)
+    for src_fname in itin_store.get_segment_fnames(src_subdir) \
+            + itin_codec.get_zdict_fnames(src_subdir):
+        if result_files.link_file(src_fname, os.path.join(dest_subdir,
+                os.path.basename(src_fname))):
+            n_linked += 1
+    for src_fname in run_manifest.get_manifest_fnames(src_subdir) \
+            + itin_store.get_index_fnames(src_subdir):
+        shutil.copyfile(src_fname, os.path.join(dest_subdir,
+            os.path.basename(src_fname)))
+    return n_linked
+
+def route_param_sweep(server_url, base_routing_params, param_grid,
+        graph_specs, trips_by_id, output_base_dir, max_in_flight,
+        param_relevance=None, **route_kwargs):
+    """Routes trips_by_id on each graph in graph_specs, for each point in
+    the grid of param_grid values (see make_sweep_points()).
+
+    max_in_flight is the total number of requests kept in flight, over all
+    points and graphs. Other keyword args are passed on to
+    otp_router.route_trip_set_runs() (see route_trip_set_on_graphs() for
+    what they do).
+
+    Returns a dict mapping each point name to its dict of results by graph
+    (points sharing results share the same result dicts)."""
+    points = make_sweep_points(base_routing_params, param_grid,
+        param_relevance)
+    if not os.path.exists(output_base_dir):
+        os.makedirs(output_base_dir)
+    save_sweep_index(output_base_dir, points)
+
+    points_to_route = [point for point in points \
+        if point.shares_results_of is None]
+    print "\nSweeping %d points of routing params %s, over %d graphs "\
+        "(%d points make distinct requests, so %d routing runs in total)." \
+        % (len(points), ", ".join(sorted(param_grid.keys())),
+           len(graph_specs), len(points_to_route),
+           len(points_to_route) * len(graph_specs))
+
+    run_specs = []
+    for point in points_to_route:
+        for graph_name, graph_full in sorted(graph_specs.iteritems()):
+            run_specs.append(("%s/%s" % (point.name, graph_name), graph_full,
+                point.routing_params,
+                os.path.join(output_base_dir, point.name, graph_name)))
+    route_kwargs['interleave_runs'] = True
+    trip_results_by_run = otp_router.route_trip_set_runs(server_url,
+        run_specs, trips_by_id, max_in_flight, **route_kwargs)
+
+    results_by_point = {}
+    for point in points_to_route:
+        results_by_point[point.name] = dict((graph_name,
+            trip_results_by_run["%s/%s" % (point.name, graph_name)]) \
+            for graph_name in graph_specs.iterkeys())
+    for point in points:
+        if point.shares_results_of is None:
+            continue
+        results_by_point[point.name] = \
+            results_by_point[point.shares_results_of]
+        if route_kwargs.get('save_incrementally', True):
+            for graph_name in graph_specs.iterkeys():
+                link_shared_results(
+                    os.path.join(output_base_dir, point.shares_results_of,
+                        graph_name),
+                    os.path.join(output_base_dir, point.name, graph_name))
+            print "Linked results of point %s into the output dirs of "\
+                "point %s, which makes the same requests." \
+                % (point.shares_results_of, point.name)
+    return results_by_point
@@ -0,0 +1,57 @@
+"""Projecting OTP plan responses down to just the fields pyOTPA uses.
+
+A full OTP plan response includes every itinerary found, each leg's
+geometry, and detailed walk steps and stop info. But TripItinerary and the
+trip_analysis functions only read a handful of per-itinerary and per-leg
+fields. Keeping only these (and optionally, leg geometries) greatly cuts
+the memory held per trip result and the size of saved result files.
+"""
+
+# Fields of an itinerary read by TripItinerary and the analysis modules.
+ITIN_FIELDS = ['startTime', 'endTime', 'duration', 'walkTime',
+    'transitTime', 'waitingTime', 'walkDistance', 'transfers']
+# Fields of each leg read by TripItinerary and the analysis modules.
+LEG_FIELDS = ['mode', 'startTime', 'endTime', 'duration', 'distance',
+    'agencyName', 'agencyId', 'routeId', 'routeShortName', 'routeLongName']
+LEG_GEOMETRY_FIELD = 'legGeometry'
+
+class PlanProjection:
+    """Specifies which fields of an OTP itinerary to keep.
+
+    keep_geometry keeps each leg's encoded polyline geometry. Extra fields
+    to keep beyond the defaults can be given in extra_itin_fields and
+    extra_leg_fields."""
+
+    def __init__(self, keep_geometry=False, extra_itin_fields=None,
+            extra_leg_fields=None):
+        self.keep_geometry = keep_geometry
+        self.itin_fields = ITIN_FIELDS + list(extra_itin_fields or [])
+        self.leg_fields = LEG_FIELDS + list(extra_leg_fields or [])
+        if keep_geometry:
+            self.leg_fields.append(LEG_GEOMETRY_FIELD)
+
+    def project_itinerary(self, itin_json):
+        """Returns a new itinerary dict with only the projected fields.
+        Fields not present in the input are left out."""
+        proj_itin = {}
+        for field in self.itin_fields:
+            if field in itin_json:
+                proj_itin[field] = itin_json[field]
+        proj_legs = []
+        for leg in itin_json['legs']:
+            proj_leg = {}
+            for field in self.leg_fields:
+                if field in leg:
+                    proj_leg[field] = leg[field]
+            proj_legs.append(proj_leg)
+        proj_itin['legs'] = proj_legs
+        return proj_itin
+
+def get_first_itinerary(plan_response, projection=None):
+    """Returns the first (best) itinerary of a parsed OTP plan response,
+    projected if a PlanProjection is given. Raises TypeError or IndexError
+    if the response doesn't contain an itinerary."""
+    itin_json = plan_response['plan']['itineraries'][0]
+    if projection is not None:
+        itin_json = projection.project_itinerary(itin_json)
+    return itin_json
@@ -0,0 +1,143 @@
+"""Closed-loop control of how hard to drive the OTP server.
+
+An AIMDConcurrencyController keeps a rolling window of recent response
+latencies, and adjusts the number of routing requests allowed in flight to
+hold the 95th percentile latency near a target:- in the style of TCP's
+congestion control, it adds to the limit while latency is under target
+(additive increase), and cuts it by a factor once latency goes over
+(multiplicative decrease). Timeouts also count as a sign of overload.
+
+So long unattended runs settle at about the rate the server can sustain,
+backing off when it gets slower (e.g. other users sharing it), without
+going over a fixed hard ceiling.
+"""
+
+import collections
+import math
+import threading
+import time
+
+DEFAULT_WINDOW_SIZE = 100
+# Re-evaluate the limit after this many new latency samples.
+DEFAULT_ADJUST_EVERY = 20
+DEFAULT_ADDITIVE_INCREASE = 1
+DEFAULT_DECREASE_FACTOR = 0.7
+
+def percentile(values, pct):
+    """Returns the pct'th percentile (0-100) of values, using the nearest
+    rank method. Values needn't be sorted."""
+    if not values:
+        return None
+    sorted_vals = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(sorted_vals)))
+    return sorted_vals[max(0, rank - 1)]
+
+class AIMDConcurrencyController:
+    """Adjusts a concurrency limit between min_limit and max_limit (the
+    hard ceiling), to hold the p95 latency of the last window_size
+    requests at or below target_p95_latency seconds. Safe to share between
+    threads."""
+
+    def __init__(self, target_p95_latency, max_limit, min_limit=1,
+            initial_limit=None, window_size=DEFAULT_WINDOW_SIZE,
+            adjust_every=DEFAULT_ADJUST_EVERY,
+            additive_increase=DEFAULT_ADDITIVE_INCREASE,
+            decrease_factor=DEFAULT_DECREASE_FACTOR):
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError("Need 1 <= min_limit <= max_limit (got %d, %d)." \
+                % (min_limit, max_limit))
+        self.target_p95_latency = target_p95_latency
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        if initial_limit is None:
+            initial_limit = min_limit
+        self.limit = max(min_limit, min(max_limit, initial_limit))
+        self.adjust_every = adjust_every
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+        self.n_increases = 0
+        self.n_decreases = 0
+        self._latencies = collections.deque(maxlen=window_size)
+        self._completion_times = collections.deque(maxlen=window_size)
+        # Samples (latencies and overloads) since the limit was last
+        # adjusted, and whether an overload has decreased it since the last
+        # full window of samples.
+        self._samples_since_adjust = 0
+        self._overload_decreased = False
+        self._lock = threading.Lock()
+
+    def get_limit(self):
+        return self.limit
+
+    def record_latency(self, latency):
+        """Record a completed request that took latency seconds."""
+        with self._lock:
+            self._latencies.append(latency)
+            self._completion_times.append(time.time())
+            self._samples_since_adjust += 1
+            if self._samples_since_adjust >= self.adjust_every:
+                self._adjust()
+
+    def record_overload(self):
+        """Record a sign of server overload (e.g. a request timing out):-
+        the first since the last adjustment decreases the limit straight
+        away. Overloads count as samples too, so while the server keeps
+        overloading, the limit keeps being decreased, once per adjust_every
+        samples."""
+        with self._lock:
+            self._completion_times.append(time.time())
+            self._samples_since_adjust += 1
+            if not self._overload_decreased \
+                    or self._samples_since_adjust >= self.adjust_every:
+                self._decrease()
+                self._overload_decreased = True
+
+    def _adjust(self):
+        p95 = percentile(self._latencies, 95)
+        if p95 > self.target_p95_latency:
+            self._decrease()
+        else:
+            self._increase()
+        self._overload_decreased = False
+
+    def _increase(self):
+        new_limit = min(self.max_limit, self.limit + self.additive_increase)
+        if new_limit != self.limit:
+            self.n_increases += 1
+        self.limit = new_limit
+        self._samples_since_adjust = 0
+
+    def _decrease(self):
+        new_limit = max(self.min_limit,
+            int(math.floor(self.limit * self.decrease_factor)))
+        if new_limit != self.limit:
+            self.n_decreases += 1
+        self.limit = new_limit
+        # Start a fresh window, so the decrease isn't immediately repeated
+        # based on latencies from before it.
+        self._latencies.clear()
+        self._samples_since_adjust = 0
+
+    def get_p95_latency(self):
+        with self._lock:
+            return percentile(self._latencies, 95)
+
+    def get_request_rate(self):
+        """Returns recent completed requests per second."""
+        with self._lock:
+            if len(self._completion_times) < 2:
+                return 0.0
+            span = self._completion_times[-1] - self._completion_times[0]
+            if span <= 0:
+                return 0.0
+            return (len(self._completion_times) - 1) / span
+
+    def get_status_str(self):
+        p95 = self.get_p95_latency()
+        if p95 is None:
+            p95_str = "n/a"
+        else:
+            p95_str = "%.2fs" % p95
+        return "concurrency limit %d (max %d), %.1f req/s, p95 latency %s "\
+            "(target %.2fs)" % (self.limit, self.max_limit,
+                self.get_request_rate(), p95_str, self.target_p95_latency)
@@ -0,0 +1,104 @@
+"""Planning which routing requests to actually send to the OTP server, for
+a set of trips.
+
+Generated trip sets (e.g. from Trips_Generator's OD_Based_TripGenerator
+with coarse zones, or repeated VISTA records) can contain many trips with
+the same origin, destination and departure minute. These would all get the
+same route back, so only one request needs to be made for each group of
+identical trips, with the result then shared by all trips in the group.
+
+The order requests are sent in also matters:- OTP's internal caches, and
+the OS page cache on the server, work best when consecutive requests are
+for nearby places at similar times. So requests can be ordered by
+departure time bucket, then position of their origin along a space-filling
+curve, rather than by trip ID (which for generated trips is effectively
+random in space and time).
+"""
+
+from pyOTPA import Trip
+from pyOTPA import geom_utils
+
+ORDER_BY_ID = "id"
+ORDER_BY_LOCALITY = "locality"
+REQUEST_ORDERS = [ORDER_BY_ID, ORDER_BY_LOCALITY]
+
+DEFAULT_DEPARTURE_BUCKET_MINUTES = 30
+LOCALITY_CURVE_ORDER = 16
+
+def get_request_key(trip, coord_decimal_places=None):
+    """Returns a key that is the same for any trips that would result in
+    the same routing request:- i.e. same origin and destination (rounded to
+    coord_decimal_places, if given), and departure time to the minute."""
+    origin = trip[Trip.ORIGIN]
+    dest = trip[Trip.DEST]
+    if coord_decimal_places is not None:
+        origin = tuple(round(c, coord_decimal_places) for c in origin)
+        dest = tuple(round(c, coord_decimal_places) for c in dest)
+    else:
+        origin = tuple(origin)
+        dest = tuple(dest)
+    dep_minute = trip[Trip.START_DTIME].replace(second=0, microsecond=0)
+    return origin, dest, dep_minute
+
+def group_identical_requests(sorted_trips, coord_decimal_places=None):
+    """Groups trips that would result in identical routing requests.
+
+    sorted_trips is a list of (trip_id, trip) tuples. Returns a list of
+    (trip, trip_ids) tuples, one per unique request:- where trip is the
+    first trip in that group (whose details will be used for the request),
+    and trip_ids the IDs of all trips in the group. Groups are ordered by
+    the position of their first trip in sorted_trips."""
+    groups = []
+    group_index_by_key = {}
+    for trip_id, trip in sorted_trips:
+        key = get_request_key(trip, coord_decimal_places)
+        try:
+            groups[group_index_by_key[key]][1].append(trip_id)
+        except KeyError:
+            group_index_by_key[key] = len(groups)
+            groups.append((trip, [trip_id]))
+    return groups
+
+def get_departure_bucket(trip, bucket_minutes):
+    start_dt = trip[Trip.START_DTIME]
+    day_minutes = start_dt.hour * 60 + start_dt.minute
+    return start_dt.date(), day_minutes // bucket_minutes
+
+def order_requests_by_locality(request_groups,
+        bucket_minutes=DEFAULT_DEPARTURE_BUCKET_MINUTES):
+    """Returns request_groups (a list of (trip, trip_ids) tuples, as from
+    group_identical_requests()) sorted by departure time bucket of
+    bucket_minutes, then by position of each trip's origin along a Hilbert
+    curve covering all the origins. Ties keep their existing order."""
+    if not request_groups:
+        return []
+    xs = [trip[Trip.ORIGIN][0] for trip, trip_ids in request_groups]
+    ys = [trip[Trip.ORIGIN][1] for trip, trip_ids in request_groups]
+    origins_bbox = (min(xs), max(xs), min(ys), max(ys))
+    def locality_key(request_group):
+        trip = request_group[0]
+        return get_departure_bucket(trip, bucket_minutes), \
+            geom_utils.hilbert_curve_index(trip[Trip.ORIGIN], origins_bbox,
+                LOCALITY_CURVE_ORDER)
+    return sorted(request_groups, key=locality_key)
+
+def order_requests(request_groups, request_order,
+        bucket_minutes=DEFAULT_DEPARTURE_BUCKET_MINUTES):
+    """Returns request_groups in the given order (one of REQUEST_ORDERS).
+    request_groups are assumed to already be in trip ID order."""
+    if request_order == ORDER_BY_ID:
+        return request_groups
+    elif request_order == ORDER_BY_LOCALITY:
+        return order_requests_by_locality(request_groups, bucket_minutes)
+    raise ValueError("Unknown request order '%s' (should be one of %s)." \
+        % (request_order, REQUEST_ORDERS))
+
+def print_dedupe_summary(n_trips, n_requests):
+    n_saved = n_trips - n_requests
+    if n_trips:
+        saved_pct = n_saved / float(n_trips) * 100.0
+    else:
+        saved_pct = 0.0
+    print "Collapsed %d trips into %d unique routing requests per graph "\
+        "(saving %d requests, %.1f%%)." \
+        % (n_trips, n_requests, n_saved, saved_pct)
@@ -0,0 +1,169 @@
+"""A local, on-disk cache of OTP routing responses, shared across runs.
+
+Responses are stored under a hash of the normalised request:- router ID,
+routing params (sorted by name), origin, destination and departure
+date-time. So re-running the same trips with the same params (or a sweep
+where only some params change) only needs to request the routes that
+aren't already cached.
+
+Each response is a separate file, at <cache_dir>/<2 hex chars>/<hash>.json.
+When the total size of the cache goes over its maximum, the least recently
+used responses are removed.
+"""
+
+import os, os.path
+import hashlib
+import threading
+
+from pyOTPA import otp_config
+
+DEFAULT_MAX_SIZE_BYTES = 2 * 1024**3
+# When evicting, remove entries until the cache is this fraction of its max
+# size - so evictions (which need a scan of the cache) aren't too frequent.
+EVICT_TO_FRACTION = 0.9
+# Decimal places of lon/lat kept in cache keys (6 places is ~0.1m)
+KEY_COORD_DECIMAL_PLACES = 6
+
+CACHE_FILE_EXT = ".json"
+
+def normalise_request(otp_router_id, routing_params, origin_lon_lat,
+        dest_lon_lat, trip_req_start_dt):
+    """Returns a canonical string representation of a routing request."""
+    coord_fmt = "%%.%df" % KEY_COORD_DECIMAL_PLACES
+    parts = ["routerId=%s" % otp_router_id]
+    for name, val in sorted(routing_params.iteritems()):
+        parts.append("%s=%s" % (name, val))
+    parts.append("from=" + ",".join(coord_fmt % c for c in origin_lon_lat))
+    parts.append("to=" + ",".join(coord_fmt % c for c in dest_lon_lat))
+    parts.append("time=%sT%s" % (
+        trip_req_start_dt.strftime(otp_config.OTP_DATE_FMT),
+        trip_req_start_dt.strftime(otp_config.OTP_TIME_FMT)))
+    return "&".join(parts)
+
+class RoutingResultCache:
+    """Cache of raw OTP plan responses, keyed by request. Safe to share
+    between threads (and between processes, though then the size limit is
+    only approximate)."""
+
+    def __init__(self, cache_dir, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._total_size = sum(size for mtime, size, fname \
+            in self._list_entries())
+
+    def make_key(self, otp_router_id, routing_params, origin_lon_lat,
+            dest_lon_lat, trip_req_start_dt):
+        req_str = normalise_request(otp_router_id, routing_params,
+            origin_lon_lat, dest_lon_lat, trip_req_start_dt)
+        return hashlib.sha1(req_str).hexdigest()
+
+    def _key_fname(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_FILE_EXT)
+
+    def get(self, key):
+        """Returns the cached response string for key, or None if it isn't
+        cached."""
+        fname = self._key_fname(key)
+        try:
+            f = open(fname, 'r')
+            data = f.read()
+            f.close()
+            # Update modification time, to track least-recently used.
+            os.utime(fname, None)
+        except (IOError, OSError):
+            data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data):
+        fname = self._key_fname(key)
+        subdir = os.path.dirname(fname)
+        if not os.path.exists(subdir):
+            try:
+                os.makedirs(subdir)
+            except OSError:
+                # Another thread may have just created it.
+                if not os.path.isdir(subdir):
+                    raise
+        # Write to a temp file first, then rename:- so concurrent readers
+        # never see a partially-written entry.
+        tmp_fname = "%s.%d.%d.tmp" % (fname, os.getpid(),
+            threading.current_thread().ident)
+        f = open(tmp_fname, 'w')
+        f.write(data)
+        f.close()
+        with self._lock:
+            # If the key is already cached, the old entry's size no longer
+            # counts. (Renaming under the lock, so this stays right if
+            # threads put the same key at once.)
+            try:
+                old_size = os.path.getsize(fname)
+            except OSError:
+                old_size = 0
+            os.rename(tmp_fname, fname)
+            self._total_size += len(data) - old_size
+            if self._total_size > self.max_size_bytes:
+                self._evict()
+
+    def _list_entries(self):
+        entries = []
+        for dirpath, dirnames, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                if not fname.endswith(CACHE_FILE_EXT):
+                    continue
+                full_fname = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(full_fname)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, full_fname))
+        return entries
+
+    def _evict(self):
+        """Remove least recently used entries. Must hold self._lock."""
+        entries = sorted(self._list_entries())
+        total_size = sum(size for mtime, size, fname in entries)
+        target_size = self.max_size_bytes * EVICT_TO_FRACTION
+        for mtime, size, fname in entries:
+            if total_size <= target_size:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            total_size -= size
+            self.evictions += 1
+        self._total_size = total_size
+
+    def get_stats(self):
+        with self._lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size (bytes)': self._total_size,
+                }
+        n_lookups = stats['hits'] + stats['misses']
+        if n_lookups:
+            stats['hit pct'] = stats['hits'] / float(n_lookups) * 100.0
+        else:
+            stats['hit pct'] = 0.0
+        return stats
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print "Routing result cache at %s: %d hits, %d misses (%.1f%% hit "\
+            "rate), %d evictions, %.1f MB used." \
+            % (self.cache_dir, stats['hits'], stats['misses'],
+               stats['hit pct'], stats['evictions'],
+               stats['size (bytes)'] / float(1024**2))
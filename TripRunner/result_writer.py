@@ -0,0 +1,203 @@
+"""Batched, crash-safe saving of routing results, for otp_router.
+
+Rather than each routed trip's itinerary (and its run_manifest entry) being
+written out as soon as it's routed, a BatchedResultWriter queues them, and
+a background thread writes them out in batches:- once max_batch_size are
+queued, or the oldest has been queued for max_batch_seconds. So the
+per-trip cost of flushing (and fsyncing) files is shared by the batch.
+
+Each batch is written so that a crash at any point leaves only whole
+results:-
+ * To an itin_store, the batch's records are appended to the segment, and
+   flushed, before their index lines are.
+ * As result files, each is written to a temp file, which is flushed
+   before being renamed to its result file name.
+Then the batch's manifest entries are appended. So a trip is only recorded
+in the manifest once its result is saved:- and a resumed run routes again
+any trip whose result was still queued when the run crashed.
+
+close() writes out anything still queued:- the router calls it when a
+graph is finished, and also if routing is interrupted (e.g. by Ctrl-C), so
+that nothing already routed is lost.
+"""
+
+import os, os.path
+import sys
+import time
+import threading
+
+from pyOTPA import itin_codec
+from pyOTPA import result_files
+
+DEFAULT_MAX_BATCH_SIZE = 200
+DEFAULT_MAX_BATCH_SECONDS = 2.0
+# How long close() blocks on the writer thread at once, before checking
+# again. Keeps the main thread responsive to Ctrl-C under Python 2.
+CLOSE_POLL_SECONDS = 0.5
+
+class BatchedResultWriter:
+    """Saves routing results to itin_writer (an itin_store.ItinStoreWriter)
+    if given, otherwise to a result file per trip in output_subdir
+    (compressed with zdict if compress, and in the result_files hashed
+    layout if hashed_dirs). Trips' outcomes are recorded with
+    manifest_writer (a run_manifest.RunManifestWriter), if given. Safe to
+    share between threads.
+
+    With fsync, each batch is also fsynced as it's written, so that saved
+    results survive the machine (not just the process) crashing."""
+
+    def __init__(self, output_subdir, itin_writer=None, compress=False,
+            zdict=None, hashed_dirs=False, manifest_writer=None,
+            max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+            max_batch_seconds=DEFAULT_MAX_BATCH_SECONDS, fsync=True):
+        self.output_subdir = output_subdir
+        self.itin_writer = itin_writer
+        self.compress = compress
+        self.zdict = zdict
+        self.hashed_dirs = hashed_dirs
+        self.manifest_writer = manifest_writer
+        self.max_batch_size = max_batch_size
+        self.max_batch_seconds = max_batch_seconds
+        self.fsync = fsync
+        self.n_results_written = 0
+        self.n_batches_written = 0
+        # Queued (trip ID, itinerary JSON string) results, and args for
+        # manifest_writer.record().
+        self._results = []
+        self._outcomes = []
+        self._first_queued_time = None
+        self._closed = False
+        self._exc_info = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._write_loop,
+            name="result-writer")
+        # A daemon thread, so a failure elsewhere can't leave the process
+        # hanging on it:- close() is what makes sure everything's written.
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check_error(self):
+        if self._exc_info:
+            exc_info = self._exc_info
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _queued(self):
+        n_queued = len(self._results) + len(self._outcomes)
+        if self._first_queued_time is None:
+            # Start the writer thread's max_batch_seconds timer.
+            self._first_queued_time = time.time()
+            self._cond.notify()
+        elif n_queued >= self.max_batch_size:
+            self._cond.notify()
+
+    def add_result(self, trip_ids, itin_json_str):
+        """Queues itin_json_str to be saved as the result of each of
+        trip_ids. Returns False (and doesn't queue it) if the writer is
+        already closed:- e.g. when routing was interrupted, and this trip
+        was still being routed."""
+        with self._cond:
+            self._check_error()
+            if self._closed:
+                return False
+            for trip_id in trip_ids:
+                self._results.append((trip_id, itin_json_str))
+            self._queued()
+        return True
+
+    def record_outcome(self, trip_id, status, attempts=0, latency_s=None,
+            cause=None):
+        """Queues a manifest entry for trip_id:- written after any result
+        already queued for it."""
+        if self.manifest_writer is None:
+            return False
+        with self._cond:
+            self._check_error()
+            if self._closed:
+                return False
+            self._outcomes.append((trip_id, status, attempts, latency_s,
+                cause))
+            self._queued()
+        return True
+
+    def _get_batch(self):
+        """Waits until a batch is due, and returns it (or None once the
+        writer is closed, and there's nothing left to write)."""
+        with self._cond:
+            while True:
+                n_queued = len(self._results) + len(self._outcomes)
+                if n_queued and (self._closed \
+                        or n_queued >= self.max_batch_size \
+                        or time.time() - self._first_queued_time \
+                            >= self.max_batch_seconds):
+                    break
+                if self._closed:
+                    return None
+                if n_queued:
+                    self._cond.wait(max(0.0, self._first_queued_time \
+                        + self.max_batch_seconds - time.time()))
+                else:
+                    self._cond.wait()
+            batch = self._results, self._outcomes
+            self._results = []
+            self._outcomes = []
+            self._first_queued_time = None
+            return batch
+
+    def _write_loop(self):
+        while True:
+            batch = self._get_batch()
+            if batch is None:
+                break
+            try:
+                self._write_batch(*batch)
+            except Exception:
+                with self._cond:
+                    self._exc_info = sys.exc_info()
+                    # Nothing more can be saved safely.
+                    self._closed = True
+                break
+
+    def _write_batch(self, results, outcomes):
+        if results:
+            if self.itin_writer:
+                self.itin_writer.append_json_strs(results, self.fsync)
+            else:
+                self._write_result_files(results)
+        if outcomes:
+            for outcome in outcomes:
+                self.manifest_writer.record(*outcome, flush=False)
+            self.manifest_writer.flush(self.fsync)
+        self.n_results_written += len(results)
+        self.n_batches_written += 1
+
+    def _write_result_files(self, results):
+        tmp_and_result_fnames = []
+        for trip_id, itin_json_str in results:
+            fname = result_files.make_result_fname(self.output_subdir,
+                trip_id, self.hashed_dirs)
+            tmp_fname = result_files.write_temp_file(fname,
+                itin_codec.encode_itin_json_str(itin_json_str,
+                    self.compress, self.zdict), self.fsync)
+            tmp_and_result_fnames.append((tmp_fname, fname))
+        for tmp_fname, fname in tmp_and_result_fnames:
+            os.rename(tmp_fname, fname)
+        if self.fsync:
+            for dir_name in set(os.path.dirname(fname) \
+                    for tmp_fname, fname in tmp_and_result_fnames):
+                result_files.fsync_dir(dir_name)
+
+    def close(self):
+        """Writes out everything queued, then closes itin_writer and
+        manifest_writer. Raises any error there was writing results."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        while self._thread.is_alive():
+            self._thread.join(CLOSE_POLL_SECONDS)
+        if self.itin_writer:
+            self.itin_writer.close()
+            self.itin_writer = None
+        if self.manifest_writer:
+            self.manifest_writer.close()
+            self.manifest_writer = None
+        self._check_error()
@@ -0,0 +1,141 @@
+"""A small thread-based pool for running routing requests concurrently.
+
+The OTP server is able to process many routing requests in parallel, but
+the Python side spends nearly all its time just waiting on the network. So
+threads (rather than processes) are sufficient here to keep the server busy.
+"""
+
+import sys
+import threading
+import Queue
+
+# How long the main thread blocks on the results queue at once, before
+# checking again. Keeps the main thread responsive to Ctrl-C (KeyboardInterrupt)
+# under Python 2, where an un-timed Queue.get() can't be interrupted.
+RESULT_POLL_SECONDS = 0.5
+
+class BoundedWorkerPool:
+    """Runs a function over a sequence of argument tuples using a set of
+    worker threads, keeping at most max_in_flight calls running at once.
+
+    If max_in_flight is 1, no threads are created at all and each call is
+    just run in the calling thread - so behaviour is identical to a plain
+    serial loop.
+
+    If a limit_controller is given (e.g. a
+    rate_control.AIMDConcurrencyController), its get_limit() is checked
+    before starting each call, and the number of calls in flight is kept
+    within it as it changes. max_in_flight is then a hard ceiling.
+    """
+
+    def __init__(self, max_in_flight, limit_controller=None):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1 (was %s)." \
+                % max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.limit_controller = limit_controller
+        self._task_q = None
+        self._result_q = None
+        self._workers = []
+        self._abandoned = False
+
+    def _start_workers(self):
+        self._task_q = Queue.Queue()
+        self._result_q = Queue.Queue()
+        self._workers = []
+        for ii in range(self.max_in_flight):
+            worker = threading.Thread(target=self._worker_loop,
+                name="routing-worker-%d" % ii)
+            # Daemon threads, so a Ctrl-C in the main thread isn't blocked
+            # waiting for outstanding HTTP requests to finish.
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def abandon_in_flight(self):
+        """Makes a running imap_unordered() return as soon as it's stopped,
+        without waiting on the calls still in flight:- e.g. on Ctrl-C, when
+        they could be waiting out long timeouts or backoffs. They're left
+        to finish in their (daemon) worker threads, and their results
+        discarded."""
+        self._abandoned = True
+
+    def _stop_workers(self):
+        for worker in self._workers:
+            self._task_q.put(None)
+        self._workers = []
+
+    def _worker_loop(self):
+        while True:
+            task = self._task_q.get()
+            if task is None:
+                break
+            func, args = task
+            try:
+                result = func(*args)
+                self._result_q.put((args, result, None))
+            except Exception:
+                self._result_q.put((args, None, sys.exc_info()))
+
+    def get_current_limit(self):
+        if self.limit_controller is None:
+            return self.max_in_flight
+        return max(1, min(self.max_in_flight,
+            self.limit_controller.get_limit()))
+
+    def _get_result(self):
+        while True:
+            try:
+                return self._result_q.get(True, RESULT_POLL_SECONDS)
+            except Queue.Empty:
+                continue
+
+    def imap_unordered(self, func, args_iter):
+        """Generator calling func(*args) for each args tuple in args_iter,
+        yielding (args, result) pairs in order of completion.
+
+        The consumer can stop early (e.g. with a break): no further calls
+        will be started, and calls already in flight are waited on, their
+        results discarded. Exceptions raised in func are re-raised in the
+        consumer's thread.
+
+        If interrupted by Ctrl-C (KeyboardInterrupt) while waiting on
+        results, or after abandon_in_flight() was called, calls in flight
+        aren't waited on (see abandon_in_flight())."""
+        if self.max_in_flight == 1:
+            for args in args_iter:
+                yield args, func(*args)
+            return
+
+        self._start_workers()
+        self._abandoned = False
+        args_iter = iter(args_iter)
+        in_flight = 0
+        try:
+            for args in args_iter:
+                self._task_q.put((func, args))
+                in_flight += 1
+                # The limit may have been lowered meanwhile, so wait on as
+                # many results as needed to get back under it.
+                while in_flight >= self.get_current_limit():
+                    args_done, result, exc_info = self._get_result()
+                    in_flight -= 1
+                    if exc_info:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    yield args_done, result
+            while in_flight > 0:
+                args_done, result, exc_info = self._get_result()
+                in_flight -= 1
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield args_done, result
+        except KeyboardInterrupt:
+            self.abandon_in_flight()
+            raise
+        finally:
+            # Drain calls still in flight (e.g. consumer stopped early),
+            # so that no worker is left writing results after we return.
+            while in_flight > 0 and not self._abandoned:
+                self._get_result()
+                in_flight -= 1
+            self._stop_workers()
@@ -0,0 +1,230 @@
+"""Policies for retrying failed routing requests, and a circuit breaker to
+back off from an OTP server that is struggling.
+
+Failed requests are split into two kinds:
+ * Transport errors:- timeouts, refused or reset connections, and non-200
+   HTTP responses. These say nothing about the trip itself, so are retried.
+ * Planner errors:- the server responded, but OTP's planner returned an
+   error instead of a plan (e.g. no path found). Most of these will just
+   fail again if retried, so only the ones signalling a server-side problem
+   (see RETRYABLE_PLANNER_ERROR_IDS) are retried.
+"""
+
+import errno
+import random
+import socket
+import threading
+import time
+
+from pyOTPA import http_pool
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_INITIAL_BACKOFF_SECONDS = 0.5
+DEFAULT_MAX_BACKOFF_SECONDS = 30
+
+DEFAULT_BREAKER_FAILURE_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN_SECONDS = 10
+DEFAULT_BREAKER_MAX_COOLDOWN_SECONDS = 300
+# Total time a graph's breaker may stay open before giving up on that graph.
+DEFAULT_BREAKER_MAX_OPEN_SECONDS = 60 * 60
+
+# OTP planner error IDs (see OTP's Message.java) where the planner itself
+# failed, rather than there being no valid trip.
+OTP_ERROR_REQUEST_TIMEOUT = 408
+OTP_ERROR_SYSTEM_ERROR = 500
+RETRYABLE_PLANNER_ERROR_IDS = frozenset([OTP_ERROR_REQUEST_TIMEOUT,
+    OTP_ERROR_SYSTEM_ERROR])
+
+# Causes of transport failures
+CAUSE_TIMEOUT = "timeout"
+CAUSE_CONN_REFUSED = "connection refused"
+CAUSE_CONN_ERROR = "connection error"
+CAUSE_HTTP_STATUS = "http status"
+CAUSE_BAD_RESPONSE = "bad response"
+CAUSE_PLANNER_ERROR = "planner error"
+
+def classify_transport_error(url_error):
+    """Returns which of the CAUSE_* categories a urllib2.URLError (such as
+    http_pool.HTTPRequestError) falls in."""
+    if isinstance(url_error, http_pool.HTTPRequestError) \
+            and url_error.status is not None:
+        return CAUSE_HTTP_STATUS
+    reason = url_error.reason
+    if isinstance(reason, socket.timeout):
+        return CAUSE_TIMEOUT
+    if isinstance(reason, socket.error) \
+            and reason.errno == errno.ECONNREFUSED:
+        return CAUSE_CONN_REFUSED
+    return CAUSE_CONN_ERROR
+
+class CircuitOpenError(Exception):
+    """Raised when a circuit breaker has stayed open for longer than its
+    allowed maximum, meaning the server is considered unavailable."""
+    pass
+
+class CircuitBreaker:
+    """Circuit breaker shared by all requests on one graph.
+
+    After failure_threshold consecutive failures, the breaker 'opens', and
+    all requests wait (pausing that graph's queue) for a cooldown period.
+    Then a single 'probe' request is allowed through: if it succeeds, the
+    breaker closes and requests resume as normal, otherwise it re-opens with
+    double the cooldown (up to max_cooldown). Each request should call
+    release_probe() once finished with (whatever its outcome), so that a
+    probe that fails unexpectedly doesn't hold up the others. If the
+    breaker has been open for more than max_open_seconds in total,
+    CircuitOpenError is raised to callers waiting on it (max_open_seconds
+    of None means wait forever)."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=DEFAULT_BREAKER_FAILURE_THRESHOLD,
+            cooldown=DEFAULT_BREAKER_COOLDOWN_SECONDS,
+            max_cooldown=DEFAULT_BREAKER_MAX_COOLDOWN_SECONDS,
+            max_open_seconds=DEFAULT_BREAKER_MAX_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.initial_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_open_seconds = max_open_seconds
+        self.state = self.CLOSED
+        self.n_times_opened = 0
+        self._cooldown = cooldown
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._cooldown_start = None
+        self._total_open_seconds = 0.0
+        # The thread sending the half-open probe request, if any.
+        self._probe_thread = None
+        self._cond = threading.Condition()
+
+    def wait_until_allowed(self):
+        """Blocks until a request may be sent to the server."""
+        with self._cond:
+            while True:
+                if self.state == self.CLOSED:
+                    return
+                if self.max_open_seconds is not None \
+                        and self._open_seconds() > self.max_open_seconds:
+                    raise CircuitOpenError("Circuit breaker has been open "\
+                        "for %.0f seconds in total (max allowed %d)." \
+                        % (self._open_seconds(), self.max_open_seconds))
+                if self.state == self.OPEN:
+                    wait_s = self._cooldown_start + self._cooldown \
+                        - time.time()
+                    if wait_s <= 0:
+                        self.state = self.HALF_OPEN
+                        continue
+                    self._cond.wait(wait_s)
+                elif self._probe_thread is None:
+                    # Half-open: let this request through as the probe.
+                    self._probe_thread = threading.current_thread()
+                    return
+                else:
+                    self._cond.wait(self._cooldown)
+
+    def record_success(self):
+        with self._cond:
+            if self.state != self.CLOSED:
+                print "\tServer responding again:- resuming requests."
+                self._total_open_seconds += time.time() - self._opened_at
+                self._opened_at = None
+                self.state = self.CLOSED
+                self._cooldown = self.initial_cooldown
+                self._probe_thread = None
+                self._cond.notify_all()
+            self._consecutive_failures = 0
+
+    def record_failure(self):
+        with self._cond:
+            self._consecutive_failures += 1
+            if self.state == self.HALF_OPEN:
+                # Only the probe's failure counts:- not that of a request
+                # sent before the breaker opened, finishing late.
+                if self._probe_thread is threading.current_thread():
+                    self._probe_thread = None
+                    self._cooldown = min(self._cooldown * 2,
+                        self.max_cooldown)
+                    self._reopen("probe request failed")
+            elif self.state == self.CLOSED \
+                    and self._consecutive_failures >= self.failure_threshold:
+                self._opened_at = time.time()
+                self._reopen("%d consecutive routing failures" \
+                    % self._consecutive_failures)
+
+    def release_probe(self):
+        """If this thread sent the half-open probe, but it recorded neither
+        success nor failure (e.g. it raised an unexpected error), lets
+        another request be the probe."""
+        with self._cond:
+            if self._probe_thread is threading.current_thread():
+                self._probe_thread = None
+                self._cond.notify_all()
+
+    def _reopen(self, reason):
+        # Note:- _opened_at is kept from when the breaker first opened,
+        # so open time accumulates over repeated failed probes.
+        self.state = self.OPEN
+        self.n_times_opened += 1
+        print "\tWarning:- %s:- pausing requests on this graph for %.1f "\
+            "seconds." % (reason, self._cooldown)
+        self._cooldown_start = time.time()
+        # Count failures afresh from here:- until the breaker closes
+        # again, they're not what decides when it re-opens.
+        self._consecutive_failures = 0
+        self._cond.notify_all()
+
+    def _open_seconds(self):
+        if self._opened_at is None:
+            return self._total_open_seconds
+        return self._total_open_seconds + time.time() - self._opened_at
+
+class RetryPolicy:
+    """How, and how many times, to retry a failed routing request.
+
+    Backoff between attempts is exponential with 'full jitter':- i.e. a
+    random delay between 0 and initial_backoff * 2^(attempt - 1), after
+    the attempt'th attempt (counting from 1) failed, capped at max_backoff.
+    So concurrent workers don't all retry in step.
+
+    If breaker_failure_threshold is set, new_circuit_breaker() gives a
+    CircuitBreaker to use for each graph. If it is None, no circuit breaker
+    is used."""
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS,
+            initial_backoff=DEFAULT_INITIAL_BACKOFF_SECONDS,
+            max_backoff=DEFAULT_MAX_BACKOFF_SECONDS,
+            retryable_planner_error_ids=RETRYABLE_PLANNER_ERROR_IDS,
+            breaker_failure_threshold=DEFAULT_BREAKER_FAILURE_THRESHOLD,
+            breaker_cooldown=DEFAULT_BREAKER_COOLDOWN_SECONDS,
+            breaker_max_cooldown=DEFAULT_BREAKER_MAX_COOLDOWN_SECONDS,
+            breaker_max_open_seconds=DEFAULT_BREAKER_MAX_OPEN_SECONDS):
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.retryable_planner_error_ids = retryable_planner_error_ids
+        self.breaker_failure_threshold = breaker_failure_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_max_cooldown = breaker_max_cooldown
+        self.breaker_max_open_seconds = breaker_max_open_seconds
+
+    def get_backoff_seconds(self, attempt):
+        """Delay before re-trying, after the attempt'th attempt (counting
+        from 1) failed."""
+        max_delay = min(self.max_backoff,
+            self.initial_backoff * (2 ** (attempt - 1)))
+        return random.uniform(0, max_delay)
+
+    def should_retry(self, attempt):
+        return attempt < self.max_attempts
+
+    def is_retryable_planner_error(self, otp_error_id):
+        return otp_error_id in self.retryable_planner_error_ids
+
+    def new_circuit_breaker(self):
+        if self.breaker_failure_threshold is None:
+            return None
+        return CircuitBreaker(self.breaker_failure_threshold,
+            self.breaker_cooldown, self.breaker_max_cooldown,
+            self.breaker_max_open_seconds)
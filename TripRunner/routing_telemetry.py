@@ -0,0 +1,236 @@
+"""Telemetry for routing runs:- where the time goes, how fast trips are
+being routed, and how long until a graph is finished.
+
+For each graph, a GraphTelemetry collects:-
+ * The total time spent in each phase of routing a trip (see PHASES), so a
+   slow run can be put down to the server, the network or JSON handling.
+ * A histogram of request latencies, and recent latency percentiles.
+ * Counts of trip results by status, and of failures by cause.
+ * Throughput in trips and requests per second, and an ETA for the graph.
+
+A RoutingTelemetry hands out a GraphTelemetry per graph, and if given a
+metrics file name, periodically appends a snapshot of the current graph's
+metrics to it as a line of JSON - so progress of a long run can be followed
+(e.g. with tail -f, or a dashboard) without parsing the printed output.
+"""
+
+import json
+import time
+import threading
+import collections
+import contextlib
+from datetime import datetime, timedelta
+
+from pyOTPA.TripRunner import rate_control
+
+PHASE_URL_BUILD = "url_build"
+PHASE_NETWORK = "network_wait"
+PHASE_JSON_PARSE = "json_parse"
+PHASE_ITIN_CONSTRUCT = "itin_construct"
+PHASE_FILE_WRITE = "file_write"
+PHASES = [PHASE_URL_BUILD, PHASE_NETWORK, PHASE_JSON_PARSE,
+    PHASE_ITIN_CONSTRUCT, PHASE_FILE_WRITE]
+
+# Upper bounds (in seconds) of the request latency histogram's buckets. A
+# last bucket holds all latencies above the highest bound.
+LATENCY_BUCKET_BOUNDS = [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30]
+# Number of most recent latencies percentiles are calculated from.
+LATENCY_WINDOW_SIZE = 1000
+
+DEFAULT_METRICS_WRITE_INTERVAL_SECONDS = 10
+
+def _bucket_label(bucket_i):
+    if bucket_i < len(LATENCY_BUCKET_BOUNDS):
+        return "<=%gs" % LATENCY_BUCKET_BOUNDS[bucket_i]
+    return ">%gs" % LATENCY_BUCKET_BOUNDS[-1]
+
+@contextlib.contextmanager
+def timed_phase(graph_telemetry, phase):
+    """Context manager adding the time its block takes to the given phase
+    of graph_telemetry. Does nothing if graph_telemetry is None."""
+    if graph_telemetry is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        graph_telemetry.add_phase_time(phase, time.time() - start_time)
+
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    return str(timedelta(seconds=int(round(seconds))))
+
+class GraphTelemetry:
+    """Metrics of routing trips on one graph. Safe to update from several
+    worker threads at once."""
+
+    def __init__(self, graph_name, n_trips_total):
+        self.graph_name = graph_name
+        self.n_trips_total = n_trips_total
+        self.start_time = time.time()
+        self.phase_seconds = dict((phase, 0.0) for phase in PHASES)
+        self.latency_hist = [0] * (len(LATENCY_BUCKET_BOUNDS) + 1)
+        self.n_requests = 0
+        self.n_trips_processed = 0
+        self.n_trips_skipped = 0
+        self.trips_by_status = collections.defaultdict(int)
+        self.failures_by_cause = collections.defaultdict(int)
+        self._recent_latencies = collections.deque(maxlen=LATENCY_WINDOW_SIZE)
+        self._lock = threading.Lock()
+
+    def add_phase_time(self, phase, seconds):
+        with self._lock:
+            self.phase_seconds[phase] += seconds
+
+    def record_request(self, latency):
+        """Record a single request to the server (including retries)."""
+        bucket_i = 0
+        while bucket_i < len(LATENCY_BUCKET_BOUNDS) \
+                and latency > LATENCY_BUCKET_BOUNDS[bucket_i]:
+            bucket_i += 1
+        with self._lock:
+            self.n_requests += 1
+            self.latency_hist[bucket_i] += 1
+            self._recent_latencies.append(latency)
+
+    def record_result(self, status, fail_cause, n_trips=1):
+        """Record the outcome of routing n_trips (identical) trips."""
+        with self._lock:
+            self.n_trips_processed += n_trips
+            self.trips_by_status[status] += n_trips
+            if fail_cause:
+                self.failures_by_cause[fail_cause] += 1
+
+    def record_skipped(self, n_trips):
+        """Record trips skipped, as already routed in a previous run."""
+        with self._lock:
+            self.n_trips_processed += n_trips
+            self.n_trips_skipped += n_trips
+
+    def get_elapsed_seconds(self):
+        return time.time() - self.start_time
+
+    def get_trips_per_second(self):
+        """Rate of trips routed in this run (not counting skipped trips)."""
+        elapsed = self.get_elapsed_seconds()
+        if elapsed <= 0:
+            return 0.0
+        return (self.n_trips_processed - self.n_trips_skipped) / elapsed
+
+    def get_eta_seconds(self):
+        rate = self.get_trips_per_second()
+        if rate <= 0:
+            return None
+        return max(0, self.n_trips_total - self.n_trips_processed) / rate
+
+    def get_latency_percentile(self, pct):
+        with self._lock:
+            return rate_control.percentile(self._recent_latencies, pct)
+
+    def get_progress_str(self):
+        return "%.1f trips/s, ETA %s" % (self.get_trips_per_second(),
+            format_duration(self.get_eta_seconds()))
+
+    def to_dict(self):
+        """Returns a snapshot of all metrics, as a JSON-serialisable dict."""
+        elapsed = self.get_elapsed_seconds()
+        with self._lock:
+            metrics = {
+                'graph': self.graph_name,
+                'elapsed_s': round(elapsed, 3),
+                'trips_total': self.n_trips_total,
+                'trips_processed': self.n_trips_processed,
+                'trips_skipped': self.n_trips_skipped,
+                'trips_by_status': dict(self.trips_by_status),
+                'failures_by_cause': dict(self.failures_by_cause),
+                'requests': self.n_requests,
+                'phase_s': dict((phase, round(secs, 3)) for phase, secs \
+                    in self.phase_seconds.iteritems()),
+                'latency_hist': dict((_bucket_label(ii), count) for ii, count \
+                    in enumerate(self.latency_hist)),
+                }
+        if elapsed > 0:
+            metrics['requests_per_s'] = round(metrics['requests'] / elapsed, 3)
+        else:
+            metrics['requests_per_s'] = 0.0
+        metrics['trips_per_s'] = round(self.get_trips_per_second(), 3)
+        metrics['eta_s'] = self.get_eta_seconds()
+        for pct in [50, 95, 99]:
+            metrics['latency_p%d_s' % pct] = self.get_latency_percentile(pct)
+        return metrics
+
+    def print_summary(self):
+        metrics = self.to_dict()
+        print "Routing telemetry for graph %s: %d requests in %s (%.1f "\
+            "req/s, %.1f trips/s)." \
+            % (self.graph_name, metrics['requests'],
+               format_duration(metrics['elapsed_s']),
+               metrics['requests_per_s'], metrics['trips_per_s'])
+        total_phase_s = sum(metrics['phase_s'].itervalues())
+        if total_phase_s > 0:
+            print "  Time by phase (summed over all workers):"
+            for phase in PHASES:
+                phase_s = metrics['phase_s'][phase]
+                print "    %-15s %9.2fs (%5.1f%%)" % (phase, phase_s,
+                    phase_s / total_phase_s * 100.0)
+        if metrics['requests']:
+            print "  Request latencies (p50 %.3fs, p95 %.3fs, p99 %.3fs):" \
+                % (metrics['latency_p50_s'], metrics['latency_p95_s'],
+                   metrics['latency_p99_s'])
+            for ii, count in enumerate(self.latency_hist):
+                print "    %-8s %8d" % (_bucket_label(ii), count)
+        if metrics['failures_by_cause']:
+            print "  Failures by cause:"
+            for cause, count in sorted(
+                    metrics['failures_by_cause'].iteritems()):
+                print "    %-20s %8d" % (cause, count)
+
+class RoutingTelemetry:
+    """Creates a GraphTelemetry for each graph routed. If metrics_fname is
+    given, a snapshot of each graph's metrics is appended to it as a JSON
+    line at most every write_interval seconds, and at the end of each
+    graph."""
+
+    def __init__(self, metrics_fname=None,
+            write_interval=DEFAULT_METRICS_WRITE_INTERVAL_SECONDS):
+        self.metrics_fname = metrics_fname
+        self.write_interval = write_interval
+        self.graphs = {}
+        self._last_write_times = {}
+        self._metrics_file = None
+        if metrics_fname:
+            self._metrics_file = open(metrics_fname, 'a')
+
+    def new_graph(self, graph_name, n_trips_total):
+        graph_telemetry = GraphTelemetry(graph_name, n_trips_total)
+        self.graphs[graph_name] = graph_telemetry
+        self._last_write_times[graph_name] = time.time()
+        return graph_telemetry
+
+    def maybe_write(self, graph_telemetry, extra=None):
+        """Writes a snapshot of metrics if write_interval has passed since
+        the last one. Call regularly (from one thread) while routing."""
+        if self._metrics_file is None:
+            return
+        last_write_time = self._last_write_times[graph_telemetry.graph_name]
+        if time.time() - last_write_time >= self.write_interval:
+            self.write(graph_telemetry, "progress", extra)
+
+    def write(self, graph_telemetry, event, extra=None):
+        if self._metrics_file is None:
+            return
+        metrics = graph_telemetry.to_dict()
+        metrics['time'] = datetime.now().isoformat()
+        metrics['event'] = event
+        if extra:
+            metrics.update(extra)
+        self._metrics_file.write(json.dumps(metrics, sort_keys=True) + "\n")
+        self._metrics_file.flush()
+        self._last_write_times[graph_telemetry.graph_name] = time.time()
+
+    def close(self):
+        if self._metrics_file is not None:
+            self._metrics_file.close()
+            self._metrics_file = None
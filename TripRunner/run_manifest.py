@@ -0,0 +1,168 @@
+"""An append-only manifest of the trips routed in a graph's output dir.
+
+Each line records one attempt to route a trip:- its ID, the result status
+(see otp_router.RESULT_*), the number of requests it took, the time the
+last request took, the cause if it failed, and when it was recorded (in
+seconds since the epoch). This lets a later run
+resume by reading just the manifest, rather than checking for every trip's
+result file - and tell apart trips that were routed but had no itinerary,
+from those that failed, from those never attempted.
+
+If a trip appears more than once (e.g. it failed, then was re-routed in a
+later run, maybe by another worker with its own manifest), its most
+recently recorded entry across all the manifests in the dir is the current
+one. (So workers sharing a dir should have roughly synced clocks.)
+Entries in manifests written before entries were timestamped are taken as
+recorded when their file was last modified.
+"""
+
+import os, os.path
+import sys
+import time
+import csv
+import glob
+
+from pyOTPA import itin_store
+from pyOTPA import result_files
+
+MANIFEST_FNAME = "routing_manifest.csv"
+# Pattern all manifests in a dir match (there can be several, e.g. one per
+# worker process).
+MANIFEST_GLOB = "routing_manifest*.csv"
+
+MANIFEST_HEADERS = ['trip_id', 'status', 'attempts', 'latency_s', 'cause',
+    'recorded_at']
+# Headers of manifests written before entries were timestamped.
+_UNTIMED_MANIFEST_HEADERS = MANIFEST_HEADERS[:-1]
+
+class ManifestEntry:
+    def __init__(self, trip_id, status, attempts, latency_s, cause,
+            recorded_at=None):
+        self.trip_id = trip_id
+        self.status = status
+        self.attempts = attempts
+        self.latency_s = latency_s
+        self.cause = cause
+        self.recorded_at = recorded_at
+
+def _open_csv_for_append(fname):
+    if sys.version_info >= (3,0,0):
+        return open(fname, 'a', newline='')
+    else:
+        return open(fname, 'ab')
+
+class RunManifestWriter:
+    """Appends entries to a manifest file. Each entry is flushed to disk
+    as written, so the manifest is up to date if the run is interrupted."""
+
+    def __init__(self, output_subdir, manifest_fname=MANIFEST_FNAME):
+        self.fname = os.path.join(output_subdir, manifest_fname)
+        new_file = not os.path.exists(self.fname) \
+            or os.path.getsize(self.fname) == 0
+        self._csv_file = _open_csv_for_append(self.fname)
+        self._writer = csv.writer(self._csv_file, delimiter=',')
+        if new_file:
+            self._writer.writerow(MANIFEST_HEADERS)
+            self._csv_file.flush()
+
+    def record(self, trip_id, status, attempts=0, latency_s=None,
+            cause=None, flush=True, recorded_at=None):
+        """Appends an entry, recorded now unless recorded_at (seconds since
+        the epoch) is given."""
+        if latency_s is None:
+            latency_str = ""
+        else:
+            latency_str = "%.3f" % latency_s
+        if recorded_at is None:
+            recorded_at = time.time()
+        self._writer.writerow([trip_id, status, attempts, latency_str,
+            cause or "", "%.6f" % recorded_at])
+        if flush:
+            self._csv_file.flush()
+
+    def flush(self, fsync=False):
+        self._csv_file.flush()
+        if fsync:
+            os.fsync(self._csv_file.fileno())
+
+    def close(self):
+        self._csv_file.close()
+
+def read_manifest_file(fname, entries=None):
+    """Reads a single manifest file, returning a dict mapping each trip ID
+    to its latest ManifestEntry. If entries is given, it's updated with
+    each trip's entry from this file that was recorded no earlier than the
+    one already in entries. Incomplete lines (e.g. from a run that crashed
+    mid-write) are skipped."""
+    if entries is None:
+        entries = {}
+    file_mtime = os.path.getmtime(fname)
+    untimed = False
+    file_entries = {}
+    csv_file = open(fname, 'r')
+    reader = csv.reader(csv_file, delimiter=',')
+    for row in reader:
+        if row == MANIFEST_HEADERS:
+            continue
+        elif row == _UNTIMED_MANIFEST_HEADERS:
+            untimed = True
+            continue
+        if len(row) == len(MANIFEST_HEADERS):
+            recorded_str = row.pop()
+        elif untimed and len(row) == len(_UNTIMED_MANIFEST_HEADERS):
+            recorded_str = ""
+        else:
+            continue
+        trip_id, status, attempts, latency_str, cause = row
+        try:
+            attempts = int(attempts)
+            latency_s = float(latency_str) if latency_str else None
+            if recorded_str:
+                recorded_at = float(recorded_str)
+            else:
+                recorded_at = file_mtime
+        except ValueError:
+            continue
+        # Within a file, the last entry for a trip is the latest.
+        file_entries[trip_id] = ManifestEntry(trip_id, status, attempts,
+            latency_s, cause or None, recorded_at)
+    csv_file.close()
+    for trip_id, entry in file_entries.iteritems():
+        current_entry = entries.get(trip_id)
+        if current_entry is None \
+                or entry.recorded_at >= current_entry.recorded_at:
+            entries[trip_id] = entry
+    return entries
+
+def get_manifest_fnames(output_subdir):
+    return sorted(glob.glob(os.path.join(output_subdir, MANIFEST_GLOB)))
+
+def read_manifest(output_subdir):
+    """Reads all manifests in output_subdir, returning a dict mapping each
+    trip ID to its most recently recorded ManifestEntry, whichever
+    manifest it's in."""
+    entries = {}
+    for fname in get_manifest_fnames(output_subdir):
+        read_manifest_file(fname, entries)
+    return entries
+
+def has_manifest(output_subdir):
+    return len(get_manifest_fnames(output_subdir)) > 0
+
+def bootstrap_manifest_from_results(output_subdir, ok_status):
+    """For output dirs from runs made before manifests were kept:- creates
+    a manifest listing every trip with an existing result (a file, or an
+    entry in an itin_store) as routed OK (with unknown attempts and
+    latency). Trips that previously got no itinerary can't be detected this
+    way, so will be routed again.
+
+    Returns the number of trips recorded."""
+    trip_ids = set(result_files.get_result_file_trip_ids(output_subdir))
+    trip_ids.update(itin_store.read_index(output_subdir).iterkeys())
+    if not trip_ids:
+        return 0
+    writer = RunManifestWriter(output_subdir)
+    for trip_id in sorted(trip_ids):
+        writer.record(trip_id, ok_status, flush=False)
+    writer.close()
+    return len(trip_ids)
@@ -0,0 +1,355 @@
+"""Splitting one routing job across several processes or machines that
+share a filesystem.
+
+Two mechanisms are provided, which can be used separately or together:-
+ * Static shards:- with a shard index and count, a worker only routes trips
+   whose stable hash of trip ID falls in its shard. Needs no coordination,
+   but each shard must be run to completion by someone.
+ * Leased blocks:- trips are split (again by hash of trip ID) into blocks,
+   and workers claim blocks to route by atomically creating a lease file in
+   the output dir. Workers keep their lease fresh while routing; a lease
+   left stale (e.g. by a worker that crashed or was stopped) can be taken
+   over by another worker. So workers can join or leave mid-run. Claims
+   only rely on atomic file creation and rename, rather than any locking.
+
+Each worker appends to its own run manifest in each graph's output dir, and
+verify_routing_run() checks the combined manifests cover every trip exactly
+once (and can merge them into a single manifest).
+"""
+
+import os, os.path
+import errno
+import hashlib
+import threading
+import time
+
+from pyOTPA import misc_utils
+from pyOTPA.TripRunner import otp_router
+from pyOTPA.TripRunner import run_manifest
+
+# Starts with a '_', so trip_itins_io.read_graph_names() doesn't take it for
+# a graph's results.
+LEASE_DIR_NAME = "_leases"
+LEASE_EXT = ".lease"
+DONE_EXT = ".done"
+DEFAULT_N_BLOCKS = 100
+DEFAULT_LEASE_SECONDS = 10 * 60
+# How often a held lease is refreshed, as a fraction of the lease time.
+LEASE_RENEW_FRACTION = 1 / 3.0
+# How long to wait before checking again for blocks to claim, when all the
+# remaining ones are leased by other workers.
+CLAIM_POLL_SECONDS = 30
+
+def stable_trip_hash(trip_id):
+    """Returns an int hash of trip_id that is the same in every process and
+    on every machine (unlike Python's hash())."""
+    return int(hashlib.md5(str(trip_id)).hexdigest()[:8], 16)
+
+def get_trip_shard(trip_id, shard_count):
+    return stable_trip_hash(trip_id) % shard_count
+
+def get_trip_block(trip_id, n_blocks, shard_count=1):
+    # Uses different bits of the hash to the shard, so each shard's trips
+    # are still spread over all blocks.
+    return (stable_trip_hash(trip_id) // shard_count) % n_blocks
+
+def select_shard(trips_by_id, shard_index, shard_count):
+    """Returns the subset of trips_by_id in the given shard (0-based)."""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("Shard index %d not in range for %d shards." \
+            % (shard_index, shard_count))
+    return dict((trip_id, trip) for trip_id, trip in trips_by_id.iteritems() \
+        if get_trip_shard(trip_id, shard_count) == shard_index)
+
+def get_worker_manifest_fname(worker_id):
+    """Name of a worker's own manifest (matching
+    run_manifest.MANIFEST_GLOB)."""
+    return "routing_manifest-%s.csv" % worker_id
+
+class BlockLeases:
+    """Claims of workers on blocks of trips, kept as files in lease_dir:- a
+    <block>.lease file while a worker is routing a block, and a <block>.done
+    file once it's finished."""
+
+    def __init__(self, lease_dir, worker_id,
+            lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.lease_dir = lease_dir
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        if not os.path.exists(lease_dir):
+            try:
+                os.makedirs(lease_dir)
+            except OSError:
+                # Another worker may have just created it.
+                if not os.path.isdir(lease_dir):
+                    raise
+
+    def _lease_fname(self, block_i):
+        return os.path.join(self.lease_dir, "block_%05d%s" % (block_i,
+            LEASE_EXT))
+
+    def _done_fname(self, block_i):
+        return os.path.join(self.lease_dir, "block_%05d%s" % (block_i,
+            DONE_EXT))
+
+    def is_done(self, block_i):
+        return os.path.exists(self._done_fname(block_i))
+
+    def _create_exclusive(self, fname):
+        """Atomically create fname, returning False if it already exists."""
+        try:
+            fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd, "%s %s\n" % (self.worker_id, time.time()))
+        os.close(fd)
+        return True
+
+    def _is_stale(self, fname):
+        try:
+            return time.time() - os.path.getmtime(fname) > self.lease_seconds
+        except OSError:
+            return False
+
+    def try_claim(self, block_i):
+        """Try to claim block_i, returning True if now held by this worker.
+        A stale lease is taken over:- by first renaming it aside, which
+        only one worker can succeed at."""
+        if self.is_done(block_i):
+            return False
+        lease_fname = self._lease_fname(block_i)
+        if self._create_exclusive(lease_fname):
+            return True
+        if not self._is_stale(lease_fname):
+            return False
+        stale_fname = "%s.stale-%s" % (lease_fname, self.worker_id)
+        try:
+            os.rename(lease_fname, stale_fname)
+        except OSError:
+            # Another worker got to it first.
+            return False
+        if not self._is_stale(stale_fname):
+            # The lease was renewed or re-created just before we moved it:-
+            # so put it back (unless it's already been replaced again).
+            if not os.path.exists(lease_fname):
+                os.rename(stale_fname, lease_fname)
+                return False
+        os.remove(stale_fname)
+        print "Taking over stale lease on block %d in %s." \
+            % (block_i, self.lease_dir)
+        return self._create_exclusive(lease_fname)
+
+    def renew(self, block_i):
+        try:
+            os.utime(self._lease_fname(block_i), None)
+        except OSError:
+            print "Warning:- lease on block %d in %s was lost (it may be "\
+                "routed again by another worker)." % (block_i, self.lease_dir)
+
+    def mark_done(self, block_i):
+        self._create_exclusive(self._done_fname(block_i))
+        self.release(block_i)
+
+    def release(self, block_i):
+        try:
+            os.remove(self._lease_fname(block_i))
+        except OSError:
+            pass
+
+class _LeaseRenewer(threading.Thread):
+    """Background thread refreshing a lease while its block is routed."""
+
+    def __init__(self, leases, block_i):
+        threading.Thread.__init__(self, name="lease-renewer-%d" % block_i)
+        self.daemon = True
+        self.leases = leases
+        self.block_i = block_i
+        self._stop_event = threading.Event()
+
+    def run(self):
+        renew_interval = self.leases.lease_seconds * LEASE_RENEW_FRACTION
+        while not self._stop_event.wait(renew_interval):
+            self.leases.renew(self.block_i)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def iter_claimed_blocks(leases, block_ids):
+    """Generator yielding each block of block_ids as this worker claims
+    it, until all are done (by this worker or others). The caller should
+    call leases.mark_done() on each block once it's finished with it."""
+    remaining = list(block_ids)
+    while remaining:
+        claimed_any = False
+        still_remaining = []
+        for block_i in remaining:
+            if leases.is_done(block_i):
+                continue
+            if leases.try_claim(block_i):
+                claimed_any = True
+                yield block_i
+                if not leases.is_done(block_i):
+                    still_remaining.append(block_i)
+            else:
+                still_remaining.append(block_i)
+        remaining = still_remaining
+        if remaining and not claimed_any:
+            print "Waiting on %d blocks leased by other workers..." \
+                % len(remaining)
+            time.sleep(CLAIM_POLL_SECONDS)
+
+def get_lease_dir(output_base_dir, shard_index=None, shard_count=None):
+    if shard_count:
+        sub_name = "shard_%d_of_%d" % (shard_index, shard_count)
+    else:
+        sub_name = "all"
+    return os.path.join(output_base_dir, LEASE_DIR_NAME, sub_name)
+
+def route_trip_set_sharded(server_url, routing_params, graph_specs,
+        trips_by_id, output_base_dir, shard_index=None, shard_count=None,
+        use_leases=True, n_blocks=DEFAULT_N_BLOCKS,
+        lease_seconds=DEFAULT_LEASE_SECONDS, worker_id=None,
+        **route_kwargs):
+    """Route this worker's part of trips_by_id on each graph, using
+    otp_router.route_trip_set_on_graphs() (which route_kwargs are passed to).
+
+    If shard_count is given, only trips in shard shard_index are routed.
+    With use_leases, these trips are split into n_blocks blocks, which are
+    claimed and routed one at a time (resuming any a previous worker left
+    partly done), until all blocks are done. Otherwise, all of them are
+    routed at once.
+
+    Returns results by graph for the trips routed by this worker."""
+    if worker_id is None:
+        worker_id = misc_utils.make_process_id()
+    if shard_count:
+        trips_by_id = select_shard(trips_by_id, shard_index, shard_count)
+        print "Worker %s routing shard %d of %d (%d trips)." \
+            % (worker_id, shard_index, shard_count, len(trips_by_id))
+    else:
+        shard_count = None
+    manifest_fname = get_worker_manifest_fname(worker_id)
+
+    if not use_leases:
+        return otp_router.route_trip_set_on_graphs(server_url,
+            routing_params, graph_specs, None, trips_by_id, output_base_dir,
+            manifest_fname=manifest_fname, **route_kwargs)
+
+    trips_by_block = {}
+    for trip_id, trip in trips_by_id.iteritems():
+        block_i = get_trip_block(trip_id, n_blocks, shard_count or 1)
+        trips_by_block.setdefault(block_i, {})[trip_id] = trip
+
+    leases = BlockLeases(get_lease_dir(output_base_dir, shard_index,
+        shard_count), worker_id, lease_seconds)
+    # Always resume within a block:- it may have been started by a worker
+    # that then left.
+    route_kwargs['resume_existing'] = True
+    trip_results_by_graph = dict((graph_name, {}) for graph_name \
+        in graph_specs)
+    for block_i in iter_claimed_blocks(leases, sorted(trips_by_block)):
+        print "\nWorker %s routing block %d (%d trips)." \
+            % (worker_id, block_i, len(trips_by_block[block_i]))
+        renewer = _LeaseRenewer(leases, block_i)
+        renewer.start()
+        try:
+            block_results = otp_router.route_trip_set_on_graphs(server_url,
+                routing_params, graph_specs, None, trips_by_block[block_i],
+                output_base_dir, manifest_fname=manifest_fname,
+                **route_kwargs)
+        except:
+            # Leave the block to be claimed again straight away.
+            renewer.stop()
+            leases.release(block_i)
+            raise
+        renewer.stop()
+        leases.mark_done(block_i)
+        for graph_name, results in block_results.iteritems():
+            trip_results_by_graph[graph_name].update(results)
+    return trip_results_by_graph
+
+class RunVerifyReport:
+    """What verify_routing_run() found for one graph. Trips are counted as
+    covered if their latest manifest entry is a completed routing (i.e. not
+    failed)."""
+
+    def __init__(self, graph_name):
+        self.graph_name = graph_name
+        self.n_trips = 0
+        self.covered_ids = set()
+        self.missing_ids = set()
+        self.failed_ids = set()
+        # Trips completed by more than one worker (manifest file).
+        self.duplicate_ids = set()
+        self.unknown_ids = set()
+
+    def is_ok(self):
+        return not (self.missing_ids or self.failed_ids \
+            or self.duplicate_ids)
+
+    def print_report(self):
+        print "Graph %s: %d of %d trips covered, %d never routed, %d "\
+            "failed, %d routed more than once, %d not in the trip set." \
+            % (self.graph_name, len(self.covered_ids), self.n_trips,
+               len(self.missing_ids), len(self.failed_ids),
+               len(self.duplicate_ids), len(self.unknown_ids))
+
+def verify_routing_run(output_base_dir, graph_names, trip_ids, merge=False):
+    """Checks the manifests of every worker in each graph's output dir
+    together cover every trip in trip_ids exactly once. Returns a dict of
+    RunVerifyReport by graph name.
+
+    With merge, each graph's manifests are then combined into a single
+    run_manifest.MANIFEST_FNAME manifest holding each trip's latest entry,
+    and the per-worker manifests removed."""
+    trip_ids = set(str(trip_id) for trip_id in trip_ids)
+    reports = {}
+    for graph_name in graph_names:
+        output_subdir = os.path.join(output_base_dir, graph_name)
+        report = RunVerifyReport(graph_name)
+        report.n_trips = len(trip_ids)
+        completed_by = {}
+        manifest_fnames = run_manifest.get_manifest_fnames(output_subdir)
+        for fname in manifest_fnames:
+            for trip_id, entry in \
+                    run_manifest.read_manifest_file(fname).iteritems():
+                if entry.status != otp_router.RESULT_FAILED:
+                    completed_by.setdefault(trip_id, set()).add(fname)
+        latest_entries = run_manifest.read_manifest(output_subdir)
+        for trip_id in trip_ids:
+            entry = latest_entries.get(trip_id)
+            if entry is None:
+                report.missing_ids.add(trip_id)
+            elif entry.status == otp_router.RESULT_FAILED:
+                report.failed_ids.add(trip_id)
+            else:
+                report.covered_ids.add(trip_id)
+                if len(completed_by.get(trip_id, ())) > 1:
+                    report.duplicate_ids.add(trip_id)
+        report.unknown_ids = set(latest_entries) - trip_ids
+        report.print_report()
+        reports[graph_name] = report
+        if merge and manifest_fnames:
+            _merge_manifests(output_subdir, manifest_fnames, latest_entries)
+    return reports
+
+def _merge_manifests(output_subdir, manifest_fnames, latest_entries):
+    merged_fname = os.path.join(output_subdir, run_manifest.MANIFEST_FNAME)
+    tmp_fname = "routing_manifest_merged.tmp"
+    if os.path.exists(os.path.join(output_subdir, tmp_fname)):
+        os.remove(os.path.join(output_subdir, tmp_fname))
+    writer = run_manifest.RunManifestWriter(output_subdir, tmp_fname)
+    for trip_id in sorted(latest_entries):
+        entry = latest_entries[trip_id]
+        writer.record(trip_id, entry.status, entry.attempts, entry.latency_s,
+            entry.cause, flush=False, recorded_at=entry.recorded_at)
+    writer.close()
+    os.rename(os.path.join(output_subdir, tmp_fname), merged_fname)
+    for fname in manifest_fnames:
+        if os.path.abspath(fname) != os.path.abspath(merged_fname):
+            os.remove(fname)
+    print "Merged %d manifests in %s into %s." \
+        % (len(manifest_fnames), output_subdir, merged_fname)
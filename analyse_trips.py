@@ -11,6 +11,7 @@ from pyOTPA import Trip
 from pyOTPA import trips_io
 from pyOTPA import trip_itins_io
 from pyOTPA import trip_analysis
+from pyOTPA import trip_summary_table
 from pyOTPA import trip_filters
 from pyOTPA import trip_itin_filters
 from pyOTPA.Trips_Generator import abs_zone_io
@@ -19,9 +20,7 @@ ALL_TRIPS_DESC = "all_trips"
 BASE_FILTER_DESC = "filtered"
 NEAR_IMP_NW_DESC = "near_imp_nw"
 
-def exclude_slow_trips_long_walks(
-        trips_by_id, trip_req_start_dts, trip_results):
-    trip_ids_to_exclude = set()
+def exclude_slow_trips_long_walks(summary_table):
     longest_walk_len_km = trip_itin_filters.DEFAULT_LONGEST_WALK_LEN_KM
     longest_trip_time = timedelta(hours=4)
     filter_desc_long = "filtered to remove trips with > %.1fkm walk legs "\
@@ -32,20 +31,14 @@ def exclude_slow_trips_long_walks(
     # Filter out trips that involved a very long walk:-
     # OTP still sometimes returns these where there is no alternative 
     # option, even if well above your specified max walk distance.
-    trip_ids_long_walk = \
-        trip_itin_filters.get_trip_ids_with_walk_leg_gr_than_dist_km(
-            trip_results, longest_walk_len_km)
-    trip_ids_to_exclude.update(trip_ids_long_walk)
+    long_walk = summary_table.get_col('longest_walk_leg_m') / 1000.0 \
+        > longest_walk_len_km
     # Filter out trips that took a very long time - e.g. trips starting
     # on a Sunday where there is no service till the next day.
-    trip_ids_long_time = \
-        trip_itin_filters.get_trip_ids_with_total_time_gr_than(
-            trip_results, trip_req_start_dts, longest_trip_time)
-    trip_ids_to_exclude.update(trip_ids_long_time)
-
-    all_trip_ids_set = set(trip_results.iterkeys())
-    trip_ids_to_keep = sorted(list(
-        all_trip_ids_set.difference(trip_ids_to_exclude)))
+    long_time = summary_table.get_col('total_s') \
+        > longest_trip_time.total_seconds()
+    trip_ids_to_keep = sorted(
+        summary_table.trip_ids[~(long_walk | long_time)].tolist())
 
     return trip_ids_to_keep, filter_desc_short, filter_desc_long
 
@@ -66,7 +59,8 @@ def trips_near_upgraded_networks(
 
 def process_one_graph_results(trips_by_id, trip_req_start_dts,
         output_base_dir, graph_name, dep_time_cats, dep_time_order,
-        imp_network_stop_lyrs, ccds_index, ccds_srs, saved_trip_id_ccds_map):
+        imp_network_stop_lyrs, ccds_index, ccds_srs, saved_trip_id_ccds_map,
+        load_processes=1, lazy_load=False):
     """Split out into a separate function to save memory by processing each
     graph's results one at a time."""
 
@@ -76,17 +70,21 @@ def process_one_graph_results(trips_by_id, trip_req_start_dts,
     subset_descs = {}
     subset_descs_long = {}
 
+    # With lazy_load, results in an itinerary store are only read (and
+    # decoded) as they're looked up, each time they are.
     trip_results[ALL_TRIPS_DESC] = trip_itins_io.load_trip_itineraries(
-        output_base_dir, [graph_name])[graph_name]
+        output_base_dir, [graph_name], lazy=lazy_load,
+        n_processes=load_processes)[graph_name]
     subset_descs_long[ALL_TRIPS_DESC] = "all trips"
 
     print "Extracting trip summary results for graph %s:" \
         % graph_name
-    trip_summary_results['total_times'] = {}
-    for trip_id in trip_results[ALL_TRIPS_DESC]:
-        trip_summary_results['total_times'][trip_id] = \
-            trip_results[ALL_TRIPS_DESC][trip_id].get_total_trip_sec(
-                trip_req_start_dts[trip_id])
+    summary_table = trip_summary_table.get_summary_table(output_base_dir,
+        graph_name, trip_results[ALL_TRIPS_DESC], trips_by_id,
+        trip_req_start_dts)
+    trip_summary_results['total_times'] = dict(zip(
+        summary_table.trip_ids.tolist(),
+        summary_table.get_col('total_s').tolist()))
     print "...done."
 
     print "Calculating requested subsets of trip results for graph %s:" \
@@ -96,8 +94,7 @@ def process_one_graph_results(trips_by_id, trip_req_start_dts,
     print "  calc subset of trips excluding those with long walks and "\
         "very slow trips:"
     subset_ids_list, subset_desc, filter_desc_long = \
-        exclude_slow_trips_long_walks(
-            trips_by_id, trip_req_start_dts, trip_results[ALL_TRIPS_DESC])
+        exclude_slow_trips_long_walks(summary_table)
     subset_ids[subset_desc] = subset_ids_list 
     subset_descs_long[subset_desc] = filter_desc_long
     print "  calc subset of trips close to improved networks:"
@@ -126,21 +123,25 @@ def process_one_graph_results(trips_by_id, trip_req_start_dts,
     for desc in result_descs:
         if not trip_results[desc]: continue
 
-        means[desc]['overall'] = trip_analysis.calc_means(
-            trip_results[desc], trips_by_id, trip_req_start_dts)
+        if desc == ALL_TRIPS_DESC:
+            rows = None
+        else:
+            rows = summary_table.get_rows(subset_ids[desc])
+
+        means[desc]['overall'] = trip_summary_table.calc_means(
+            summary_table, rows)
 
         means[desc]['by_first_nonwalk_mode'] = \
-            trip_analysis.calc_means_by_first_non_walk_mode(
-                trip_results[desc], trips_by_id, trip_req_start_dts)
+            trip_summary_table.calc_means_by_first_non_walk_mode(
+                summary_table, rows)
 
         means[desc]['by_agencies_used'] = \
-            trip_analysis.calc_means_by_agencies_used(
-                trip_results[desc], trips_by_id, trip_req_start_dts)
+            trip_summary_table.calc_means_by_agencies_used(
+                summary_table, rows)
 
         means[desc]['by_deptime'] = \
-            trip_analysis.calc_means_by_dep_times(
-                trip_results[desc], trips_by_id, trip_req_start_dts,
-                dep_time_cats)
+            trip_summary_table.calc_means_by_dep_times(
+                summary_table, dep_time_cats, rows)
 
         means[desc]['by_OD_SLA'] = \
             trip_analysis.calc_trip_info_by_OD_SLA(
@@ -231,6 +232,15 @@ def main():
         dest='create_comparison_shpfile', 
         help="a pair of graph names you want to create a comparison "
             "shapefile, visualising travel times - separated by a , .")
+    parser.add_option('--load_processes', dest='load_processes', type='int',
+        default=1,
+        help="(optional) number of processes to load trip results with "\
+            "in parallel.")
+    parser.add_option('--lazy_load', dest='lazy_load', action='store_true',
+        default=False,
+        help="(optional) only read trip results from an itinerary store as "\
+            "they're needed, re-reading them on each pass over a graph:- "\
+            "slower, but uses less memory.")
     (options, args) = parser.parse_args()
     
     output_base_dir = options.results_base_dir
@@ -335,7 +345,8 @@ def main():
             process_one_graph_results(
                 trips_by_id, trip_req_start_dts, output_base_dir, gn,
                 dep_time_cats, dep_time_order, imp_network_stop_lyrs,
-                ccds_index, ccds_srs, saved_trip_id_ccds_map)
+                ccds_index, ccds_srs, saved_trip_id_ccds_map,
+                options.load_processes, options.lazy_load)
         trip_summary_results_by_graph[gn] = trip_summary_results
         means_by_graph[gn] = means
         usage_by_graph[gn] = usages
@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+
+"""Converts the trip results saved in a routing run's output dir, from a
+<trip_id>.json file per trip in each graph's subdir, to an itin_store in
+each graph's subdir. The store's itineraries can optionally be compressed,
+with a compression dictionary of the agency and route names used in each
+graph's results.
+
+Alternatively, with --files_layout, the result files are kept, but moved
+into the given result_files layout:- 'hashed' to fan them out into hashed
+subdirs of each graph's subdir, or 'flat' to move them back."""
+
+import os.path
+from optparse import OptionParser
+
+from pyOTPA import itin_store
+from pyOTPA import itin_codec
+from pyOTPA import result_files
+from pyOTPA import trip_itins_io
+from pyOTPA import TripItinerary
+
+FILES_LAYOUT_HASHED = 'hashed'
+FILES_LAYOUT_FLAT = 'flat'
+FILES_LAYOUTS = [FILES_LAYOUT_HASHED, FILES_LAYOUT_FLAT]
+
+def build_graph_names_zdict(graph_dir):
+    """Builds and saves a compression dictionary of the agency and route
+    names used in the result files in graph_dir."""
+    itin_jsons = (TripItinerary.read_trip_itin_json_from_file(fname) \
+        for fname in result_files.get_result_fnames(graph_dir).itervalues())
+    zdict = itin_codec.build_names_zdict(itin_jsons)
+    itin_codec.save_zdict(zdict, graph_dir)
+    return zdict
+
+def main():
+    parser = OptionParser(usage="%prog [options] results_base_dir")
+    parser.add_option('--graphs', dest='graphs',
+        help="Comma-separated names of the graphs to convert results of "\
+            "(defaults to all subdirs of the results dir).")
+    parser.add_option('--remove_files', action='store_true', default=False,
+        help="Delete the result files once they're in the store.")
+    parser.add_option('--compress', action='store_true', default=False,
+        help="Compress the itineraries in the store.")
+    parser.add_option('--names_zdict', action='store_true', default=False,
+        help="When compressing, first build a compression dictionary of "\
+            "the agency and route names in each graph's results (otherwise "\
+            "the last one saved in the graph's dir, if any, is used).")
+    parser.add_option('--files_layout', choices=FILES_LAYOUTS,
+        help="Instead of converting to a store, move the result files "\
+            "into this layout (one of: %s)." % ", ".join(FILES_LAYOUTS))
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        parser.error("no provided results base dir.")
+    output_base_dir = args[0]
+    if not os.path.isdir(output_base_dir):
+        parser.print_help()
+        parser.error("provided results base dir isn't a directory.")
+
+    if options.graphs:
+        graph_names = options.graphs.split(',')
+    else:
+        graph_names = trip_itins_io.read_graph_names(output_base_dir)
+    for graph_name in graph_names:
+        graph_dir = os.path.join(output_base_dir, graph_name)
+        if options.files_layout:
+            n_moved = result_files.move_result_files(graph_dir,
+                options.files_layout == FILES_LAYOUT_HASHED)
+            print "Moved %d result files on graph %s into the %s layout in "\
+                "%s." % (n_moved, graph_name, options.files_layout,
+                    graph_dir)
+            continue
+        zdict = None
+        if options.compress and options.names_zdict:
+            zdict = build_graph_names_zdict(graph_dir)
+            print "Built compression dictionary %s of graph %s's agency "\
+                "and route names." % (zdict.zdict_id, graph_name)
+        elif options.compress:
+            zdict = itin_codec.get_writing_zdict(graph_dir)
+        n_added = itin_store.convert_dir_to_store(graph_dir,
+            options.remove_files, compress=options.compress, zdict=zdict)
+        print "Added %d results on graph %s to the itinerary store in %s%s." \
+            % (n_added, graph_name, graph_dir,
+               " (and removed the result files)" \
+                   if options.remove_files else "")
+    return
+
+if __name__ == "__main__":
+    main()
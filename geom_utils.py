@@ -365,3 +365,30 @@ def get_shp_geom_is_within_using_index(gridded_index, geom):
                 % (geom.ExportToWkt(), len(found_indexes), found_bboxes,
                    len(cand_shapes), cand_shape_bboxes)#, cand_shape_ccds)
     return shp_within
+
+def hilbert_curve_index(pt_coord, bbox, order=16):
+    """Returns the index of pt_coord along a Hilbert space-filling curve
+    covering bbox (of form (minx, maxx, miny, maxy)), with 2**order cells
+    along each side. Points close along the curve are always close in
+    space, so sorting by this index groups nearby points together."""
+    n_cells = 2 ** order
+    x_range = float(bbox[1] - bbox[0]) or 1.0
+    y_range = float(bbox[3] - bbox[2]) or 1.0
+    x = int((pt_coord[0] - bbox[0]) / x_range * n_cells)
+    y = int((pt_coord[1] - bbox[2]) / y_range * n_cells)
+    x = min(max(x, 0), n_cells - 1)
+    y = min(max(y, 0), n_cells - 1)
+    index = 0
+    side = n_cells // 2
+    while side > 0:
+        rx = 1 if (x & side) else 0
+        ry = 1 if (y & side) else 0
+        index += side * side * ((3 * rx) ^ ry)
+        # Rotate the quadrant, so the curve stays continuous.
+        if ry == 0:
+            if rx == 1:
+                x = n_cells - 1 - x
+                y = n_cells - 1 - y
+            x, y = y, x
+        side //= 2
+    return index
@@ -0,0 +1,188 @@
+"""A simple keep-alive HTTP client, pooling connections per host.
+
+urllib2.urlopen() opens (and tears down) a new TCP connection for every
+request, which for many small requests to the same OTP server is a large
+part of the total latency. This module instead keeps a set of idle
+connections to each host open, and re-uses them for later requests.
+"""
+
+import socket
+import threading
+import time
+import httplib
+import urllib2
+import urlparse
+
+DEFAULT_MAX_IDLE_CONNS_PER_HOST = 8
+DEFAULT_IDLE_TIMEOUT_SECONDS = 30
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 30
+
+class HTTPRequestError(urllib2.URLError):
+    """Raised when a request fails - either at the transport level (in which
+    case status is None, and reason is the underlying exception), or because
+    the server returned a non-200 HTTP status.
+
+    Subclasses urllib2.URLError, so code written to handle errors from
+    urllib2.urlopen() also handles these."""
+
+    def __init__(self, reason, status=None):
+        urllib2.URLError.__init__(self, reason)
+        self.status = status
+
+    def __str__(self):
+        if self.status is not None:
+            return "<HTTPRequestError: status %d: %s>" \
+                % (self.status, self.reason)
+        return "<HTTPRequestError: %s>" % self.reason
+
+class HTTPConnectionPool:
+    """Pool of keep-alive HTTP connections, keyed by (scheme, host, port).
+
+    Up to max_idle_conns_per_host idle connections are kept for each host.
+    If more requests than this are made concurrently to one host, extra
+    connections are opened as needed, and closed after use. Idle connections
+    not used for more than idle_timeout seconds are closed rather than
+    re-used. Safe to share between threads."""
+
+    def __init__(self, max_idle_conns_per_host=DEFAULT_MAX_IDLE_CONNS_PER_HOST,
+            idle_timeout=DEFAULT_IDLE_TIMEOUT_SECONDS):
+        self.max_idle_conns_per_host = max_idle_conns_per_host
+        self.idle_timeout = idle_timeout
+        self._idle_conns = {}
+        self._lock = threading.Lock()
+        self.n_requests = 0
+        self.n_conns_created = 0
+        self.n_conns_reused = 0
+        self.n_stale_conns_retried = 0
+
+    def _checkout_conn(self, host_key, timeout):
+        now = time.time()
+        conn = None
+        with self._lock:
+            self.n_requests += 1
+            idle_list = self._idle_conns.get(host_key, [])
+            while idle_list:
+                idle_conn, last_used = idle_list.pop()
+                if now - last_used <= self.idle_timeout:
+                    conn = idle_conn
+                    break
+                idle_conn.close()
+            if conn:
+                self.n_conns_reused += 1
+            else:
+                self.n_conns_created += 1
+        if conn:
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        scheme, host, port = host_key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=timeout)
+        return conn, False
+
+    def _return_conn(self, host_key, conn):
+        with self._lock:
+            idle_list = self._idle_conns.setdefault(host_key, [])
+            if len(idle_list) < self.max_idle_conns_per_host:
+                idle_list.append((conn, time.time()))
+                return
+        conn.close()
+
+    def get(self, url, timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS):
+        """Make a GET request to url, returning the response body as a
+        string. Raises HTTPRequestError on failure."""
+        parsed = urlparse.urlsplit(url)
+        host_key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        conn, reused = self._checkout_conn(host_key, timeout)
+        try:
+            response = self._do_get(conn, path)
+        except (socket.error, httplib.HTTPException), e:
+            conn.close()
+            if not reused or isinstance(e, socket.timeout):
+                raise HTTPRequestError(e)
+            # A re-used connection may have been closed by the server
+            # while idle:- so retry once on a fresh connection.
+            with self._lock:
+                self.n_stale_conns_retried += 1
+            conn, reused = self._checkout_conn(host_key, timeout)
+            try:
+                response = self._do_get(conn, path)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                raise HTTPRequestError(e)
+        status, data, will_close = response
+        if will_close:
+            conn.close()
+        else:
+            self._return_conn(host_key, conn)
+        if status != httplib.OK:
+            raise HTTPRequestError(data, status=status)
+        return data
+
+    def _do_get(self, conn, path):
+        conn.request('GET', path, headers={'Connection': 'keep-alive'})
+        response = conn.getresponse()
+        # Need to always read the full body, to be able to re-use the
+        # connection for the next request.
+        data = response.read()
+        return response.status, data, response.will_close
+
+    def get_stats(self):
+        """Returns a dict of counters of how connections were used."""
+        with self._lock:
+            n_idle = sum(map(len, self._idle_conns.itervalues()))
+            stats = {
+                'requests': self.n_requests,
+                'conns created': self.n_conns_created,
+                'conns reused': self.n_conns_reused,
+                'stale conns retried': self.n_stale_conns_retried,
+                'idle conns': n_idle,
+                }
+        if self.n_requests:
+            stats['reuse pct'] = self.n_conns_reused \
+                / float(self.n_requests) * 100.0
+        else:
+            stats['reuse pct'] = 0.0
+        return stats
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print "HTTP connection pool: %d requests, %d connections created, "\
+            "%d re-used (%.1f%%)." \
+            % (stats['requests'], stats['conns created'],
+               stats['conns reused'], stats['reuse pct'])
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            for idle_list in self._idle_conns.itervalues():
+                for conn, last_used in idle_list:
+                    conn.close()
+            self._idle_conns = {}
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def get_default_pool():
+    """Returns the shared connection pool used by default by pyOTPA's
+    routing and isochrone download tools, creating it if needed."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = HTTPConnectionPool()
+        return _default_pool
+
+def set_default_pool(conn_pool):
+    """Replace the shared default pool (e.g. to change its pool size or
+    idle timeout)."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is not None and _default_pool is not conn_pool:
+            _default_pool.close()
+        _default_pool = conn_pool
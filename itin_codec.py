@@ -0,0 +1,191 @@
+"""Optional zlib compression of saved itineraries (in result files or an
+itin_store).
+
+Itinerary JSON is very repetitive:- every itinerary repeats the same field
+names, modes, and agency and route names. Compressing each one on its own
+only removes repeats within it, so compression can also use a shared
+dictionary (a ZDict):- a string of the common fragments, which the
+compressor is primed with (by compressing it first, and dropping that
+output), so every itinerary can refer back to it. (Python 2's zlib doesn't
+support zlib's own preset dictionaries.) BASE_ZDICT holds the field names
+and modes. build_names_zdict() makes one that also holds the agency and
+route names used in a set of results; these are saved in the results dir,
+to be found when reading.
+
+Saved records are one of:-
+ * Plain JSON (starting with '{').
+ * ZLIB_MARKER, then the zlib-compressed JSON.
+ * ZDICT_MARKER, then the 8 hex digit ID of the ZDict, then the JSON
+   compressed with that dictionary.
+decode_itin_json_str() tells these apart, so readers handle all of them.
+"""
+
+import os, os.path
+import glob
+import json
+import zlib
+import threading
+
+ZLIB_MARKER = 'z'
+ZDICT_MARKER = 'Z'
+ZDICT_ID_LEN = 8
+ZDICT_FNAME_PREFIX = "itins-zdict-"
+ZDICT_FNAME_EXT = ".txt"
+COMPRESS_LEVEL = 6
+# Deflate can only refer back 32KB, so leave room after the dictionary
+# for the itinerary itself.
+MAX_ZDICT_BYTES = 24 * 1024
+
+# Fragments of itinerary JSON (as written by json.dumps()) common to all
+# itineraries. Later ones are closer to the data, so cheaper to refer to.
+BASE_ZDICT_FRAGMENTS = [
+    '"legGeometry": {"points": "', '"length": ', '"agencyId": "',
+    '"routeLongName": "', '"routeShortName": "', '"routeId": "',
+    '"agencyName": "', '"duration": ', '"waitingTime": ',
+    '"transitTime": ', '"walkTime": ', '"walkDistance": ',
+    '"transfers": ', '"legs": [{', '"mode": "SUBWAY", ',
+    '"mode": "TRAM", ', '"mode": "BUS", ', '"mode": "WALK", ',
+    '"distance": ', '"startTime": ', '"endTime": ',
+    ]
+
+class ZDict:
+    """A shared compression dictionary. Its ID is the CRC32 of its
+    contents. Safe to share between threads."""
+
+    def __init__(self, dict_str):
+        self.dict_str = dict_str
+        self.zdict_id = "%08x" % (zlib.crc32(dict_str) & 0xffffffff)
+        self._compressor = None
+        self._decompressor = None
+        self._lock = threading.Lock()
+
+    def _prime(self):
+        with self._lock:
+            if self._compressor is not None:
+                return
+            compressor = zlib.compressobj(COMPRESS_LEVEL)
+            primed_prefix = compressor.compress(self.dict_str) \
+                + compressor.flush(zlib.Z_SYNC_FLUSH)
+            decompressor = zlib.decompressobj()
+            decompressor.decompress(primed_prefix)
+            self._decompressor = decompressor
+            self._compressor = compressor
+
+    def compress(self, data):
+        if self._compressor is None:
+            self._prime()
+        compressor = self._compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        if self._compressor is None:
+            self._prime()
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+BASE_ZDICT = ZDict("".join(BASE_ZDICT_FRAGMENTS))
+
+_zdicts_by_id = {BASE_ZDICT.zdict_id: BASE_ZDICT}
+_zdicts_lock = threading.Lock()
+
+def encode_itin_json_str(itin_json_str, compress=False, zdict=None):
+    """Returns the record to save for itin_json_str:- compressed if
+    compress, using zdict if given."""
+    if not compress:
+        return itin_json_str
+    if zdict is None:
+        return ZLIB_MARKER + zlib.compress(itin_json_str, COMPRESS_LEVEL)
+    return ZDICT_MARKER + zdict.zdict_id + zdict.compress(itin_json_str)
+
+def decode_itin_json_str(record, zdict_dir=None):
+    """Returns the itinerary JSON string of a saved record, in any of the
+    formats. Dictionaries other than BASE_ZDICT are looked for in
+    zdict_dir."""
+    marker = record[:1]
+    if marker == ZLIB_MARKER:
+        return zlib.decompress(record[1:])
+    elif marker == ZDICT_MARKER:
+        zdict_id = record[1:1+ZDICT_ID_LEN]
+        zdict = get_zdict(zdict_id, zdict_dir)
+        return zdict.decompress(record[1+ZDICT_ID_LEN:])
+    return record
+
+def get_zdict_fname(zdict_dir, zdict_id):
+    return os.path.join(zdict_dir, ZDICT_FNAME_PREFIX + zdict_id \
+        + ZDICT_FNAME_EXT)
+
+def get_zdict_fnames(zdict_dir):
+    return sorted(glob.glob(os.path.join(zdict_dir,
+        ZDICT_FNAME_PREFIX + "*" + ZDICT_FNAME_EXT)))
+
+def get_zdict(zdict_id, zdict_dir=None):
+    """Returns the ZDict with the given ID, loading it from its file in
+    zdict_dir if it's not loaded yet. Raises a ValueError if it can't be
+    found."""
+    zdict = _zdicts_by_id.get(zdict_id)
+    if zdict is not None:
+        return zdict
+    if zdict_dir is None \
+            or not os.path.exists(get_zdict_fname(zdict_dir, zdict_id)):
+        raise ValueError("compression dictionary %s used by a saved "\
+            "itinerary wasn't found in dir %s." % (zdict_id, zdict_dir))
+    zdict_file = open(get_zdict_fname(zdict_dir, zdict_id), 'rb')
+    zdict = ZDict(zdict_file.read())
+    zdict_file.close()
+    if zdict.zdict_id != zdict_id:
+        raise ValueError("compression dictionary file %s is corrupt." \
+            % get_zdict_fname(zdict_dir, zdict_id))
+    with _zdicts_lock:
+        _zdicts_by_id.setdefault(zdict_id, zdict)
+    return _zdicts_by_id[zdict_id]
+
+def save_zdict(zdict, zdict_dir):
+    zdict_fname = get_zdict_fname(zdict_dir, zdict.zdict_id)
+    if not os.path.exists(zdict_fname):
+        zdict_file = open(zdict_fname, 'wb')
+        zdict_file.write(zdict.dict_str)
+        zdict_file.close()
+    with _zdicts_lock:
+        _zdicts_by_id.setdefault(zdict.zdict_id, zdict)
+
+def get_dir_zdict(zdict_dir):
+    """Returns the ZDict most recently saved in zdict_dir, or None if
+    there's none."""
+    zdict_fnames = get_zdict_fnames(zdict_dir)
+    if not zdict_fnames:
+        return None
+    zdict_fname = max(zdict_fnames, key=os.path.getmtime)
+    zdict_id = os.path.basename(zdict_fname)[
+        len(ZDICT_FNAME_PREFIX):-len(ZDICT_FNAME_EXT)]
+    return get_zdict(zdict_id, zdict_dir)
+
+def get_writing_zdict(zdict_dir):
+    """Returns the ZDict to compress new itineraries saved in zdict_dir
+    with:- the one most recently saved there, otherwise BASE_ZDICT."""
+    return get_dir_zdict(zdict_dir) or BASE_ZDICT
+
+def build_names_zdict(itin_jsons):
+    """Returns a ZDict of BASE_ZDICT's fragments, plus the agency and route
+    names used in itin_jsons (an iterable of itinerary JSON data), most
+    used last, as many as fit in MAX_ZDICT_BYTES."""
+    name_counts = {}
+    for itin_json in itin_jsons:
+        for leg in itin_json['legs']:
+            for field in ['agencyName', 'agencyId', 'routeId',
+                    'routeShortName', 'routeLongName']:
+                if field not in leg:
+                    continue
+                fragment = json.dumps({field: leg[field]})[1:-1]
+                name_counts[fragment] = name_counts.get(fragment, 0) + 1
+    base_str = BASE_ZDICT.dict_str
+    fragments = []
+    dict_len = len(base_str)
+    for fragment, count in sorted(name_counts.iteritems(),
+            key=lambda item: item[1], reverse=True):
+        if dict_len + len(fragment) > MAX_ZDICT_BYTES:
+            break
+        fragments.append(fragment)
+        dict_len += len(fragment)
+    # The field names and modes are in every itinerary, so keep them
+    # nearest the data.
+    return ZDict("".join(reversed(fragments)) + base_str)
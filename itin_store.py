@@ -0,0 +1,371 @@
+"""A segmented, append-only store of the trip itineraries routed on one
+graph - an alternative to saving each itinerary in its own <trip_id>.json
+file, which for large runs means hundreds of thousands of tiny files in
+each graph's dir.
+
+The store lives in the graph's output dir, as:-
+ * Segment files (SEGMENT_PREFIX...SEGMENT_EXT), holding a record per
+   itinerary:- the trip ID, a tab, the itinerary's JSON (or if written
+   with compress, its itin_codec compressed form), then a newline. The
+   tab and newline only make uncompressed segments easier to look
+   through:- compressed records can contain both, so records are always
+   located by their offset and length in the index, never by splitting
+   segments into lines. A new segment is started when the current one
+   reaches segment_max_bytes.
+ * An index file (INDEX_PREFIX...INDEX_EXT) per writer, with a line per
+   record giving the trip ID, segment file name, and the offset and length
+   of the (JSON or compressed) itinerary within the segment.
+ * Any itin_codec dictionaries the records were compressed with.
+
+Each writer (e.g. each routing process) appends to its own segments and
+index, so several processes can write into one graph's store at once;
+within a process, a writer can be shared between threads. Records are
+written before their index line, and each is flushed as written, so after
+a crash the index only lists whole records. If a trip is written more than
+once, its last index entry is the current one.
+
+For analysis, a MappedItinStore gives read-only, dict-like access to the
+itineraries in a store:- it memory-maps the segments, and only decodes an
+itinerary when it's looked up, so just the itineraries actually used need
+to be read and held in memory.
+"""
+
+import os, os.path
+import glob
+import json
+import mmap
+import threading
+import functools
+import collections
+
+import TripItinerary
+import misc_utils
+import itin_codec
+import result_files
+
+SEGMENT_PREFIX = "itins-"
+SEGMENT_EXT = ".seg"
+INDEX_PREFIX = "itins-"
+INDEX_EXT = ".idx"
+DEFAULT_SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+CONVERTED_WRITER_ID = "converted"
+
+class IndexEntry(object):
+    # There's one of these per stored trip, so keep them small.
+    __slots__ = ['trip_id', 'segment_fname', 'offset', 'length']
+
+    def __init__(self, trip_id, segment_fname, offset, length):
+        self.trip_id = trip_id
+        self.segment_fname = segment_fname
+        self.offset = offset
+        self.length = length
+
+def get_index_fnames(graph_dir):
+    return sorted(glob.glob(os.path.join(graph_dir,
+        INDEX_PREFIX + "*" + INDEX_EXT)))
+
+def get_segment_fnames(graph_dir):
+    return sorted(glob.glob(os.path.join(graph_dir,
+        SEGMENT_PREFIX + "*" + SEGMENT_EXT)))
+
+def has_store(graph_dir):
+    return len(get_index_fnames(graph_dir)) > 0
+
+def read_index(graph_dir):
+    """Returns a dict mapping each trip ID in the store to its latest
+    IndexEntry. Incomplete lines (from a writer that crashed mid-write) are
+    skipped."""
+    entries = {}
+    for index_fname in get_index_fnames(graph_dir):
+        index_file = open(index_fname, 'r')
+        for line in index_file:
+            if not line.endswith("\n"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 4:
+                continue
+            trip_id, segment_fname, offset_str, length_str = fields
+            try:
+                offset = int(offset_str)
+                length = int(length_str)
+            except ValueError:
+                continue
+            entries[trip_id] = IndexEntry(trip_id, intern(segment_fname),
+                offset, length)
+        index_file.close()
+    return entries
+
+def read_record_json(graph_dir, segment_fname, offset, length):
+    """Reads and decodes the JSON of one stored itinerary."""
+    segment_file = open(os.path.join(graph_dir, segment_fname), 'rb')
+    segment_file.seek(offset)
+    itin_json = json.loads(itin_codec.decode_itin_json_str(
+        segment_file.read(length), graph_dir))
+    segment_file.close()
+    return itin_json
+
+def _flush_file(f, fsync=False):
+    f.flush()
+    if fsync:
+        os.fsync(f.fileno())
+
+def make_lazy_itin(graph_dir, entry, itin_json):
+    """Returns a TripItinerary of itin_json (the JSON of the index entry's
+    record), that re-reads its JSON from the store when it's used rather
+    than keeping it."""
+    return TripItinerary.TripItinerary(itin_json, functools.partial(
+        read_record_json, graph_dir, entry.segment_fname, entry.offset,
+        entry.length))
+
+class ItinStoreWriter:
+    """Appends itineraries to the store in graph_dir. Safe to share between
+    threads. writer_id must be unique among processes writing to the store
+    at once (it defaults to one made from the host name and process ID).
+
+    If compress, itineraries are saved zlib-compressed, using zdict (an
+    itin_codec.ZDict, which is saved in graph_dir) if given."""
+
+    def __init__(self, graph_dir, writer_id=None,
+            segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES, compress=False,
+            zdict=None):
+        if writer_id is None:
+            writer_id = misc_utils.make_process_id()
+        self.graph_dir = graph_dir
+        self.writer_id = writer_id
+        self.segment_max_bytes = segment_max_bytes
+        self.compress = compress
+        self.zdict = zdict
+        if not os.path.exists(graph_dir):
+            os.makedirs(graph_dir)
+        if compress and zdict is not None:
+            itin_codec.save_zdict(zdict, graph_dir)
+        self._index_file = open(os.path.join(graph_dir,
+            INDEX_PREFIX + writer_id + INDEX_EXT), 'a')
+        self._segment_no = len(glob.glob(os.path.join(graph_dir,
+            SEGMENT_PREFIX + writer_id + "-*" + SEGMENT_EXT)))
+        self._segment_file = None
+        self._segment_fname = None
+        self._lock = threading.Lock()
+
+    def _open_next_segment(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+        self._segment_fname = "%s%s-%05d%s" % (SEGMENT_PREFIX,
+            self.writer_id, self._segment_no, SEGMENT_EXT)
+        self._segment_no += 1
+        self._segment_file = open(os.path.join(self.graph_dir,
+            self._segment_fname), 'ab')
+
+    def append_json_str(self, trip_id, itin_json_str, flush=True):
+        trip_id = str(trip_id)
+        record = itin_codec.encode_itin_json_str(itin_json_str,
+            self.compress, self.zdict)
+        with self._lock:
+            if self._segment_file is None \
+                    or self._segment_file.tell() >= self.segment_max_bytes:
+                self._open_next_segment()
+            # In append mode, the position isn't moved to the end of the
+            # file until the first write.
+            self._segment_file.seek(0, os.SEEK_END)
+            offset = self._segment_file.tell() + len(trip_id) + 1
+            self._segment_file.write(trip_id + "\t" + record + "\n")
+            if flush:
+                self._segment_file.flush()
+            self._index_file.write("%s\t%s\t%d\t%d\n" % (trip_id,
+                self._segment_fname, offset, len(record)))
+            if flush:
+                self._index_file.flush()
+
+    def append_json_strs(self, trip_ids_and_json_strs, fsync=False):
+        """Appends a batch of (trip_id, itin_json_str). All the batch's
+        records are written and flushed (and fsynced, if fsync) before any
+        of their index lines are:- so the index never lists a record that
+        isn't whole, whenever the process (or with fsync, the machine)
+        crashes."""
+        records = [(str(trip_id), itin_codec.encode_itin_json_str(
+            itin_json_str, self.compress, self.zdict)) \
+            for trip_id, itin_json_str in trip_ids_and_json_strs]
+        index_lines = []
+        with self._lock:
+            # Tracked here, since a seek() or tell() per record would flush
+            # the file each time.
+            offset = None
+            for trip_id, record in records:
+                if self._segment_file is not None and offset is None:
+                    self._segment_file.seek(0, os.SEEK_END)
+                    offset = self._segment_file.tell()
+                if self._segment_file is None \
+                        or offset >= self.segment_max_bytes:
+                    if self._segment_file is not None:
+                        _flush_file(self._segment_file, fsync)
+                    self._open_next_segment()
+                    self._segment_file.seek(0, os.SEEK_END)
+                    offset = self._segment_file.tell()
+                self._segment_file.write(trip_id + "\t" + record + "\n")
+                index_lines.append("%s\t%s\t%d\t%d\n" % (trip_id,
+                    self._segment_fname, offset + len(trip_id) + 1,
+                    len(record)))
+                offset += len(trip_id) + len(record) + 2
+            if self._segment_file is not None:
+                _flush_file(self._segment_file, fsync)
+            self._index_file.write("".join(index_lines))
+            _flush_file(self._index_file, fsync)
+
+    def append(self, trip_id, trip_itin, flush=True):
+        self.append_json_str(trip_id, json.dumps(trip_itin.json), flush)
+
+    def close(self):
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.close()
+                self._segment_file = None
+            self._index_file.close()
+
+class ItinStoreReader:
+    """Reads itineraries from the store in graph_dir, by trip ID."""
+
+    def __init__(self, graph_dir):
+        self.graph_dir = graph_dir
+        self.index = read_index(graph_dir)
+        self._segment_files = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, trip_id):
+        return str(trip_id) in self.index
+
+    def get_trip_ids(self):
+        return self.index.keys()
+
+    def _get_segment_file(self, segment_fname):
+        segment_file = self._segment_files.get(segment_fname)
+        if segment_file is None:
+            segment_file = open(os.path.join(self.graph_dir, segment_fname),
+                'rb')
+            self._segment_files[segment_fname] = segment_file
+        return segment_file
+
+    def read_json_str(self, trip_id):
+        entry = self.index[str(trip_id)]
+        segment_file = self._get_segment_file(entry.segment_fname)
+        segment_file.seek(entry.offset)
+        return itin_codec.decode_itin_json_str(
+            segment_file.read(entry.length), self.graph_dir)
+
+    def read_itin(self, trip_id):
+        """The itinerary re-reads its JSON data from the store when it's
+        used, rather than keeping it."""
+        return make_lazy_itin(self.graph_dir, self.index[str(trip_id)],
+            json.loads(self.read_json_str(trip_id)))
+
+    def iter_itins(self):
+        """Yields (trip_id, itin) for all trips, in order of where they're
+        stored (so segments are read through sequentially)."""
+        entries = sorted(self.index.itervalues(),
+            key=lambda entry: (entry.segment_fname, entry.offset))
+        for entry in entries:
+            yield entry.trip_id, self.read_itin(entry.trip_id)
+
+    def close(self):
+        for segment_file in self._segment_files.itervalues():
+            segment_file.close()
+        self._segment_files = {}
+
+class MappedItinStore(collections.Mapping):
+    """Read-only mapping of trip ID to TripItinerary, for the trips in the
+    store in graph_dir (or just those in index, if given). Segment files
+    are memory-mapped, so looking up a trip is a slice of its segment's
+    map, and each itinerary is only decoded from JSON when it's looked up
+    (and isn't kept after that) - so memory use doesn't grow with the
+    number of trips used, though an itinerary looked up several times is
+    decoded each time.
+
+    Iterating goes through trips in the order they're stored. Subsets made
+    with get_subset() share this store's maps."""
+
+    def __init__(self, graph_dir, index=None, _maps=None):
+        self.graph_dir = graph_dir
+        if index is None:
+            index = read_index(graph_dir)
+        self.index = index
+        if _maps is None:
+            _maps = {}
+        self._maps = _maps
+        self._ordered_trip_ids = None
+
+    def _get_map(self, segment_fname, min_length):
+        seg_map = self._maps.get(segment_fname)
+        # Re-map segments that have been appended to since they were mapped.
+        if seg_map is None or len(seg_map) < min_length:
+            segment_file = open(os.path.join(self.graph_dir, segment_fname),
+                'rb')
+            seg_map = mmap.mmap(segment_file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+            segment_file.close()
+            self._maps[segment_fname] = seg_map
+        return seg_map
+
+    def read_json_str(self, trip_id):
+        entry = self.index[trip_id]
+        end = entry.offset + entry.length
+        return itin_codec.decode_itin_json_str(
+            self._get_map(entry.segment_fname, end)[entry.offset:end],
+            self.graph_dir)
+
+    def __getitem__(self, trip_id):
+        return TripItinerary.TripItinerary(
+            json.loads(self.read_json_str(trip_id)))
+
+    def __contains__(self, trip_id):
+        return trip_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        if self._ordered_trip_ids is None:
+            entries = sorted(self.index.itervalues(),
+                key=lambda entry: (entry.segment_fname, entry.offset))
+            self._ordered_trip_ids = [entry.trip_id for entry in entries]
+        return iter(self._ordered_trip_ids)
+
+    def get_subset(self, trip_ids):
+        """Returns a MappedItinStore of just the given trips. Raises a
+        KeyError if any aren't in this one."""
+        return MappedItinStore(self.graph_dir,
+            dict((trip_id, self.index[trip_id]) for trip_id in trip_ids),
+            self._maps)
+
+    def close(self):
+        for seg_map in self._maps.itervalues():
+            seg_map.close()
+        self._maps.clear()
+
+def convert_dir_to_store(graph_dir, remove_files=False,
+        writer_id=CONVERTED_WRITER_ID, compress=False, zdict=None):
+    """Adds each <trip_id>.json result file in graph_dir (in either
+    result_files layout, and not already in the store) to the store there
+    - compressed if compress, as for ItinStoreWriter. If remove_files, the
+    files are then deleted. Returns the number of results added."""
+    fnames_by_trip_id = result_files.get_result_fnames(graph_dir)
+    trip_ids = sorted(fnames_by_trip_id.iterkeys())
+    stored_trip_ids = set(read_index(graph_dir).iterkeys())
+    writer = ItinStoreWriter(graph_dir, writer_id, compress=compress,
+        zdict=zdict)
+    n_added = 0
+    for trip_id in trip_ids:
+        if trip_id in stored_trip_ids:
+            continue
+        f = open(fnames_by_trip_id[trip_id], 'rb')
+        itin_json_str = itin_codec.decode_itin_json_str(f.read(), graph_dir)
+        f.close()
+        # Check the file is valid, and store it without any newlines.
+        itin_json_str = json.dumps(json.loads(itin_json_str))
+        writer.append_json_str(trip_id, itin_json_str, flush=False)
+        n_added += 1
+    writer.close()
+    if remove_files:
+        for trip_id in trip_ids:
+            os.remove(fnames_by_trip_id[trip_id])
+    return n_added
@@ -1,4 +1,13 @@
 
+import os
+import socket
+
+def make_process_id():
+    """Returns an ID of this process that's unique among processes on all
+    machines (e.g. for naming files that several processes write to at
+    once):- the short host name and process ID."""
+    return "%s-%d" % (socket.gethostname().split('.')[0], os.getpid())
+
 def flatten_dict(input_dict, max_levels=None):
     """'Flatten' a dictionary with multiple sub-levels into a single level
     dict, where each entry has a key which is a tuple of all original sub-dict
@@ -0,0 +1,214 @@
+"""Where the <trip_id>.json result file of each routed trip is saved in its
+graph's results dir.
+
+Originally these were all saved directly in the graph's dir (the flat
+layout). For large runs that means hundreds of thousands of entries in one
+dir, which makes listing it, and checking for files in it, slow on many
+filesystems (particularly network ones). So they can instead be saved in
+the hashed layout:- fanned out into two levels of subdirs, named after the
+leading hex digits of the MD5 hash of the trip ID, e.g.
+<graph_dir>/3f/a/<trip_id>.json .
+
+Readers handle both layouts (and a mix of them, e.g. part way through
+moving files with move_result_files()). Other files in the graph's dir
+(itin_store files, manifests, compression dictionaries) always stay at its
+top level.
+
+Result files are written to a temp file first, then renamed (see
+write_file_atomic()):- so a reader, or a run resumed after a crash, never
+sees a partly-written one.
+"""
+
+import os, os.path
+import errno
+import shutil
+import hashlib
+import threading
+
+RESULT_FILE_EXT = ".json"
+# Hex digits of the trip ID's hash naming each level of subdirs:- 4096
+# leaf dirs in all, so a million trips is still only ~250 per dir.
+HASHED_DIR_DIGITS = [2, 1]
+
+def get_hashed_subdir(trip_id):
+    """Returns the path, relative to the graph's dir, of the subdir trip_id's
+    result file is saved in, in the hashed layout."""
+    trip_hash = hashlib.md5(trip_id).hexdigest()
+    level_names = []
+    start_i = 0
+    for n_digits in HASHED_DIR_DIGITS:
+        level_names.append(trip_hash[start_i:start_i+n_digits])
+        start_i += n_digits
+    return os.path.join(*level_names)
+
+def get_result_fname(graph_dir, trip_id, hashed_dirs=False):
+    if hashed_dirs:
+        return os.path.join(graph_dir, get_hashed_subdir(trip_id),
+            trip_id + RESULT_FILE_EXT)
+    return os.path.join(graph_dir, trip_id + RESULT_FILE_EXT)
+
+def make_result_fname(graph_dir, trip_id, hashed_dirs=False):
+    """As for get_result_fname(), but makes the file's subdir if it doesn't
+    exist yet. Safe to call from several threads or processes at once."""
+    fname = get_result_fname(graph_dir, trip_id, hashed_dirs)
+    if hashed_dirs:
+        _make_dirs(os.path.dirname(fname))
+    return fname
+
+def _make_dirs(dir_name):
+    if os.path.isdir(dir_name):
+        return
+    try:
+        os.makedirs(dir_name)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def write_temp_file(fname, data, fsync=False):
+    """Writes data to a temp file alongside fname (ignored by readers),
+    returning its name, ready to be renamed to fname. With fsync, it's
+    fsynced to disk first."""
+    tmp_fname = "%s.%d.%d.tmp" % (fname, os.getpid(),
+        threading.current_thread().ident)
+    f = open(tmp_fname, 'wb')
+    f.write(data)
+    if fsync:
+        f.flush()
+        os.fsync(f.fileno())
+    f.close()
+    return tmp_fname
+
+def write_file_atomic(fname, data, fsync=False):
+    """Writes data to fname by way of a temp file, so fname is only ever
+    missing, or whole."""
+    os.rename(write_temp_file(fname, data, fsync), fname)
+    if fsync:
+        fsync_dir(os.path.dirname(fname))
+
+def fsync_dir(dir_name):
+    """Makes sure renames into dir_name are on disk (where the platform
+    allows that)."""
+    try:
+        dir_fd = os.open(dir_name or os.curdir, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def _is_hashed_subdir_name(name, level_i):
+    if len(name) != HASHED_DIR_DIGITS[level_i]:
+        return False
+    try:
+        int(name, 16)
+    except ValueError:
+        return False
+    return name == name.lower()
+
+def get_graph_dir(result_fname):
+    """Returns the graph results dir a result file is saved in, in either
+    layout."""
+    file_dir = os.path.dirname(result_fname)
+    trip_id = os.path.splitext(os.path.basename(result_fname))[0]
+    hashed_subdir = get_hashed_subdir(trip_id)
+    if file_dir.endswith(os.sep + hashed_subdir) \
+            or file_dir == hashed_subdir:
+        return file_dir[:-len(hashed_subdir)].rstrip(os.sep) or os.curdir
+    return file_dir
+
+def get_result_fnames(graph_dir):
+    """Returns a dict of trip ID to the name of its result file in
+    graph_dir, for each trip with one (in either layout). If a trip has
+    files in both, the hashed layout's one is given."""
+    fnames_by_trip_id = {}
+    hashed_subdirs = []
+    for entry in os.listdir(graph_dir):
+        fbase, ext = os.path.splitext(entry)
+        if ext == RESULT_FILE_EXT:
+            fnames_by_trip_id[fbase] = os.path.join(graph_dir, entry)
+        elif _is_hashed_subdir_name(entry, 0):
+            hashed_subdirs.append(entry)
+    for level_i in range(1, len(HASHED_DIR_DIGITS)):
+        level_subdirs = []
+        for subdir in hashed_subdirs:
+            subdir_path = os.path.join(graph_dir, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for entry in os.listdir(subdir_path):
+                if _is_hashed_subdir_name(entry, level_i):
+                    level_subdirs.append(os.path.join(subdir, entry))
+        hashed_subdirs = level_subdirs
+    for subdir in hashed_subdirs:
+        subdir_path = os.path.join(graph_dir, subdir)
+        if not os.path.isdir(subdir_path):
+            continue
+        for entry in os.listdir(subdir_path):
+            fbase, ext = os.path.splitext(entry)
+            if ext == RESULT_FILE_EXT:
+                fnames_by_trip_id[fbase] = os.path.join(subdir_path, entry)
+    return fnames_by_trip_id
+
+def get_result_file_trip_ids(graph_dir):
+    """Returns the IDs of trips with a result file in graph_dir."""
+    return get_result_fnames(graph_dir).keys()
+
+def move_result_files(graph_dir, hashed_dirs=True):
+    """Moves all the result files in graph_dir into the hashed layout (or
+    if not hashed_dirs, back into the flat layout), removing any hashed
+    subdirs left empty. Returns the number of files moved.
+
+    Each file is renamed (not copied), so if interrupted, every result is
+    still in one layout or the other, and running this again finishes the
+    job."""
+    n_moved = 0
+    for trip_id, fname in sorted(get_result_fnames(graph_dir).iteritems()):
+        new_fname = make_result_fname(graph_dir, trip_id, hashed_dirs)
+        if new_fname != fname:
+            os.rename(fname, new_fname)
+            n_moved += 1
+        # Any copy left in the other layout isn't the one readers use.
+        other_fname = get_result_fname(graph_dir, trip_id, not hashed_dirs)
+        if os.path.exists(other_fname):
+            os.remove(other_fname)
+    if not hashed_dirs:
+        _remove_empty_hashed_subdirs(graph_dir)
+    return n_moved
+
+def _remove_empty_hashed_subdirs(graph_dir):
+    for entry in os.listdir(graph_dir):
+        subdir_path = os.path.join(graph_dir, entry)
+        if _is_hashed_subdir_name(entry, 0) and os.path.isdir(subdir_path):
+            for dir_path, dir_names, fnames in os.walk(subdir_path,
+                    topdown=False):
+                if not os.listdir(dir_path):
+                    os.rmdir(dir_path)
+
+def link_result_files(src_graph_dir, dest_graph_dir):
+    """Links (or if not possible, copies) the result files in
+    src_graph_dir into dest_graph_dir, in the same layout, skipping any
+    already there. Returns the number of files linked."""
+    n_linked = 0
+    for trip_id, src_fname in get_result_fnames(src_graph_dir).iteritems():
+        rel_fname = os.path.relpath(src_fname, src_graph_dir)
+        dest_fname = os.path.join(dest_graph_dir, rel_fname)
+        if link_file(src_fname, dest_fname):
+            n_linked += 1
+    return n_linked
+
+def link_file(src_fname, dest_fname):
+    """Links (or if not possible, copies) src_fname to dest_fname, making
+    its dir if needed. Returns whether it was linked, i.e. False if
+    dest_fname already existed."""
+    _make_dirs(os.path.dirname(dest_fname))
+    if os.path.exists(dest_fname):
+        return False
+    try:
+        os.link(src_fname, dest_fname)
+    except (OSError, AttributeError), e:
+        if isinstance(e, OSError) and e.errno == errno.EEXIST:
+            return False
+        shutil.copyfile(src_fname, dest_fname)
+    return True
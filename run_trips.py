@@ -4,13 +4,96 @@ import sys
 import os.path
 import json
 from datetime import datetime, date, time
+from optparse import OptionParser
 
 from pyOTPA import trips_io
 from pyOTPA import trip_itins_io
+from pyOTPA import http_pool
+from pyOTPA import misc_utils
 from TripRunner import otp_router
+from TripRunner import otp_endpoints
+from TripRunner import result_cache
+from TripRunner import plan_projection
+from TripRunner import rate_control
+from TripRunner import request_planning
+from TripRunner import routing_telemetry
+from TripRunner import sharding
+from TripRunner import param_sweep
 
 def main():
-    SERVER_URL = 'http://130.56.248.56'
+    parser = OptionParser()
+    parser.add_option('--no_resume', dest='resume', action='store_false',
+        default=True,
+        help="Re-route every trip, rather than skipping those the run "\
+            "manifests of an earlier run record as already routed.")
+    parser.add_option('--retry_failed', '--retry-failed', dest='retry_failed',
+        action='store_true', default=False,
+        help="Only re-route the trips that the run manifests of an earlier "\
+            "run record as having failed.")
+    parser.add_option('--routing_cache_dir', default=None,
+        help="Cache routing responses in this dir, so re-runs only request "\
+            "new trips/params.")
+    parser.add_option('--dedupe_requests', action='store_true',
+        default=False,
+        help="Only send one request per graph for trips with the same "\
+            "origin, destination and departure minute.")
+    parser.add_option('--project_itins', action='store_true', default=False,
+        help="Only keep (and save) the itinerary fields used in analysis, "\
+            "dropping leg geometries and walk steps.")
+    parser.add_option('--interleave_graphs', action='store_true',
+        default=False,
+        help="Route each trip on all graphs together, rather than graph "\
+            "by graph.")
+    parser.add_option('--order_by_locality', action='store_true',
+        default=False,
+        help="Send requests grouped by departure time and origin area, "\
+            "rather than in trip ID order, so the server can re-use cached "\
+            "graph searches.")
+    parser.add_option('--use_itin_store', action='store_true',
+        default=False,
+        help="Save results to a single itinerary store per graph, rather "\
+            "than a file per trip.")
+    parser.add_option('--compress_itins', action='store_true',
+        default=False,
+        help="Save results zlib-compressed (see itin_codec).")
+    parser.add_option('--hashed_result_dirs', action='store_true',
+        default=False,
+        help="If saving a file per trip, fan them out into hashed subdirs "\
+            "of each graph's dir (see result_files), rather than all in the "\
+            "one dir.")
+    parser.add_option('--target_p95_latency', type='float', default=None,
+        help="Start with fewer requests in flight, and adjust the number to "\
+            "hold the server's p95 response time near this many seconds "\
+            "(by default, MAX_IN_FLIGHT requests are always kept in "\
+            "flight).")
+    parser.add_option('--shard_index', type='int', default=None,
+        help="Only route the trips in this shard (from 0), of shard_count.")
+    parser.add_option('--shard_count', type='int', default=None)
+    parser.add_option('--leased_blocks', action='store_true', default=False,
+        help="Claim blocks of trips to route via lease files in the output "\
+            "dir, so several workers (e.g. on different machines sharing "\
+            "the output dir) can route the trips together, joining or "\
+            "leaving at any time.")
+    parser.add_option('--verify', action='store_true', default=False,
+        help="Don't route, just check the run manifests of all workers "\
+            "cover each trip exactly once.")
+    parser.add_option('--merge', action='store_true', default=False,
+        help="With --verify, also merge all workers' run manifests into one.")
+    parser.add_option('--sweep_grid', default=None,
+        help="JSON file of routing param names, each mapped to a list of "\
+            "values:- route the trips for every combination of these "\
+            "values (on top of ROUTING_PARAMS), as one sweep job.")
+    (options, args) = parser.parse_args()
+    if (options.shard_index is None) != (options.shard_count is None):
+        parser.error("--shard_index and --shard_count must be given together.")
+    if options.sweep_grid and (options.shard_count is not None \
+            or options.leased_blocks or options.verify):
+        parser.error("--sweep_grid can't be used with sharding or --verify.")
+
+    # If several OTP servers with the same graphs loaded are listed here,
+    # requests will be spread across them.
+    SERVER_URLS = ['http://130.56.248.56']
+    BALANCE_STRATEGY = otp_endpoints.LEAST_OUTSTANDING
     # See RoutingRequest.java in OTP for comments on each of these.
     ROUTING_PARAMS = {
         'arriveBy':'false',
@@ -47,7 +130,7 @@ def main():
     #trip_req_start_time = time(11,45)
     #origin_lon_lat = (144.876791,-37.749236) 
     #dest_lon_lat = (145.091024,-37.897849)
-    #route_single_trip_multi_graphs_print_stats(SERVER_URL, ROUTING_PARAMS,
+    #route_single_trip_multi_graphs_print_stats(SERVER_URLS[0], ROUTING_PARAMS,
     #    GRAPH_SPECS, trip_req_start_date, trip_req_start_time,
     #    origin_lon_lat, dest_lon_lat)
 
@@ -58,27 +141,118 @@ def main():
         (os.path.splitext(os.path.basename(trips_shpfilename))[0],
          ROUTING_PARAMS['maxWalkDistance'])
     output_base_dir = "./output/%s" % trips_set_name
+    param_grid = None
+    if options.sweep_grid:
+        param_grid = json.load(open(options.sweep_grid))
+        output_base_dir = "./output/%s-sweep-%s" % \
+            (os.path.splitext(os.path.basename(trips_shpfilename))[0],
+             os.path.splitext(os.path.basename(options.sweep_grid))[0])
 
     trips_by_id, trips = \
         trips_io.read_trips_from_shp_file_otp_srs(
             trips_shpfilename)
 
-    print "\nGoing to request OTP server at %s to route %d trips, defined in "\
-        "shpfile %s, with start date %s, and routing params as follows:\n%s" \
-        % (SERVER_URL, len(trips), trips_shpfilename, trip_req_start_date, 
+    if options.verify:
+        reports = sharding.verify_routing_run(output_base_dir,
+            GRAPH_SPECS.keys(), trips_by_id.keys(), merge=options.merge)
+        if not all(report.is_ok() for report in reports.itervalues()):
+            sys.exit(1)
+        return
+
+    if len(SERVER_URLS) == 1:
+        server = SERVER_URLS[0]
+    else:
+        server = otp_endpoints.EndpointBalancer.from_urls(SERVER_URLS,
+            strategy=BALANCE_STRATEGY)
+        server.discover_router_ids()
+
+    print "\nGoing to request OTP server(s) at %s to route %d trips, "\
+        "defined in shpfile %s, with start date %s, and routing params as "\
+        "follows:\n%s" \
+        % (server, len(trips), trips_shpfilename, trip_req_start_date, 
            ROUTING_PARAMS)
 
     save_incrementally = True
+    routing_cache = None
+    if options.routing_cache_dir:
+        routing_cache = result_cache.RoutingResultCache(
+            options.routing_cache_dir)
+    itin_projection = None
+    if options.project_itins:
+        itin_projection = plan_projection.PlanProjection(keep_geometry=False)
+    if options.order_by_locality:
+        request_order = request_planning.ORDER_BY_LOCALITY
+    else:
+        request_order = request_planning.ORDER_BY_ID
+    # Max number of routing requests to keep in flight to the server at once,
+    # per graph.
+    MAX_IN_FLIGHT = 4
+    if options.interleave_graphs:
+        max_total_in_flight = MAX_IN_FLIGHT * len(GRAPH_SPECS)
+    else:
+        max_total_in_flight = MAX_IN_FLIGHT
+    rate_controller = None
+    if options.target_p95_latency is not None:
+        rate_controller = rate_control.AIMDConcurrencyController(
+            options.target_p95_latency, max_limit=max_total_in_flight)
+    # Keep enough idle keep-alive connections to the server for all of these.
+    http_pool.set_default_pool(http_pool.HTTPConnectionPool(
+        max_idle_conns_per_host=max_total_in_flight, idle_timeout=30))
+
+    sharded = options.shard_count is not None or options.leased_blocks
+    worker_id = misc_utils.make_process_id()
+    # Metrics of routing progress are appended here every 10 seconds.
+    if not os.path.exists(output_base_dir):
+        os.makedirs(output_base_dir)
+    if sharded:
+        metrics_fname = "routing_metrics-%s.jsonl" % worker_id
+    else:
+        metrics_fname = "routing_metrics.jsonl"
+    telemetry = routing_telemetry.RoutingTelemetry(
+        os.path.join(output_base_dir, metrics_fname))
 
-    trip_results_by_graph = otp_router.route_trip_set_on_graphs(SERVER_URL,
-        ROUTING_PARAMS,
-        GRAPH_SPECS, trips, trips_by_id, output_base_dir,
-        trip_req_start_date, save_incrementally, resume_existing=True)
+    route_kwargs = dict(trip_req_start_date=trip_req_start_date,
+        save_incrementally=save_incrementally,
+        resume_existing=options.resume, max_in_flight=MAX_IN_FLIGHT,
+        retry_failed=options.retry_failed,
+        result_cache=routing_cache, dedupe_requests=options.dedupe_requests,
+        itin_projection=itin_projection, rate_controller=rate_controller,
+        telemetry=telemetry, interleave_graphs=options.interleave_graphs,
+        request_order=request_order, use_itin_store=options.use_itin_store,
+        compress_itins=options.compress_itins,
+        hashed_result_dirs=options.hashed_result_dirs)
+    if param_grid:
+        sweep_kwargs = dict(route_kwargs)
+        del sweep_kwargs['max_in_flight'], sweep_kwargs['interleave_graphs']
+        results_by_point = param_sweep.route_param_sweep(server,
+            ROUTING_PARAMS, param_grid, GRAPH_SPECS, trips_by_id,
+            output_base_dir, max_total_in_flight, **sweep_kwargs)
+    elif sharded:
+        trip_results_by_graph = sharding.route_trip_set_sharded(server,
+            ROUTING_PARAMS, GRAPH_SPECS, trips_by_id, output_base_dir,
+            options.shard_index, options.shard_count,
+            use_leases=options.leased_blocks, worker_id=worker_id,
+            **route_kwargs)
+    else:
+        trip_results_by_graph = otp_router.route_trip_set_on_graphs(server,
+            ROUTING_PARAMS,
+            GRAPH_SPECS, trips, trips_by_id, output_base_dir,
+            **route_kwargs)
+    telemetry.close()
 
     print "\nFinished routing all requested trips from shpfile %s ." \
         % trips_shpfilename
-    if not save_incrementally:
-        trip_itins_io.save_trip_itineraries(output_base_dir, trip_results_by_graph)
+    if not save_incrementally and param_grid:
+        for point_name, trip_results_by_graph in results_by_point.iteritems():
+            trip_itins_io.save_trip_itineraries(
+                os.path.join(output_base_dir, point_name),
+                trip_results_by_graph, use_store=options.use_itin_store,
+                compress=options.compress_itins,
+                hashed_dirs=options.hashed_result_dirs)
+    elif not save_incrementally:
+        trip_itins_io.save_trip_itineraries(output_base_dir, trip_results_by_graph,
+            use_store=options.use_itin_store, compress=options.compress_itins,
+            hashed_dirs=options.hashed_result_dirs)
     else:
         print "\nResults already saved in subdirs of output directory %s ." \
             % output_base_dir
@@ -0,0 +1,52 @@
+"""Shared fixtures for the tests:- a fake OTP server to route against, and
+temporary output dirs.
+
+The tests import pyOTPA as a package, so need its parent dir on the
+PYTHONPATH (as for the Benchmarks scripts)."""
+
+import shutil
+import tempfile
+import unittest
+
+from pyOTPA.Benchmarks import fake_otp_server
+from pyOTPA.Benchmarks import bench_routing
+
+GRAPH_SPECS = {'G0': 'router0', 'G1': 'router1'}
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="pyOTPA-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+class FakeServerTestCase(TempDirTestCase):
+    """Runs a fake OTP server for each test, at self.server_url."""
+
+    server_config = None
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.server = fake_otp_server.FakeOTPServer(
+            self.server_config or fake_otp_server.FakeOTPConfig(
+                latency=0.001, no_path_rate=0.05))
+        self.server_url = self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        TempDirTestCase.tearDown(self)
+
+def make_trips(n_trips, seed=1):
+    return bench_routing.make_bench_trips(n_trips, seed)
+
+def route_trips(server_url, trips_by_id, output_base_dir, **route_kwargs):
+    from pyOTPA.TripRunner import otp_router
+    return otp_router.route_trip_set_on_graphs(server_url,
+        bench_routing.BENCH_ROUTING_PARAMS, GRAPH_SPECS, None, trips_by_id,
+        output_base_dir, **route_kwargs)
+
+def get_itin_jsons(trip_results):
+    """Returns the JSON data of the itineraries in trip_results (a dict of
+    trip ID to TripItinerary, or None if routing found none)."""
+    return dict((trip_id, itin.json) \
+        for trip_id, itin in trip_results.iteritems() if itin)
@@ -0,0 +1,101 @@
+import json
+import unittest
+from datetime import datetime
+
+from pyOTPA import itin_codec
+from pyOTPA.Benchmarks import fake_otp_server
+
+import routing_fixtures
+
+def make_itin_json_strs(n_itins):
+    config = fake_otp_server.FakeOTPConfig(n_transit_legs=3)
+    return [json.dumps(fake_otp_server.make_synthetic_itinerary(config,
+        (-37.8, 144.9 + ii * 0.01), (-37.9, 145.0),
+        datetime(2015, 2, 16, 8, ii % 60))) for ii in range(n_itins)]
+
+class ItinCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.itin_json_strs = make_itin_json_strs(10)
+
+    def assert_round_trips(self, compress, zdict=None, zdict_dir=None):
+        records = [itin_codec.encode_itin_json_str(itin_json_str, compress,
+            zdict) for itin_json_str in self.itin_json_strs]
+        # Decoded out of order, so the ZDict's state isn't relied on.
+        for itin_json_str, record in reversed(zip(self.itin_json_strs,
+                records)):
+            self.assertEqual(itin_codec.decode_itin_json_str(record,
+                zdict_dir), itin_json_str)
+        return records
+
+    def test_plain(self):
+        records = self.assert_round_trips(False)
+        self.assertEqual(records, self.itin_json_strs)
+
+    def test_zlib(self):
+        records = self.assert_round_trips(True)
+        for record, itin_json_str in zip(records, self.itin_json_strs):
+            self.assertEqual(record[:1], itin_codec.ZLIB_MARKER)
+            self.assertTrue(len(record) < len(itin_json_str))
+
+    def test_base_zdict(self):
+        zlib_records = self.assert_round_trips(True)
+        records = self.assert_round_trips(True, itin_codec.BASE_ZDICT)
+        for record in records:
+            self.assertEqual(record[:1+itin_codec.ZDICT_ID_LEN],
+                itin_codec.ZDICT_MARKER + itin_codec.BASE_ZDICT.zdict_id)
+        self.assertTrue(sum(map(len, records)) < sum(map(len, zlib_records)))
+
+    def test_empty_itinerary(self):
+        self.itin_json_strs = ["{}"]
+        self.assert_round_trips(True, itin_codec.BASE_ZDICT)
+
+class SavedZDictTest(routing_fixtures.TempDirTestCase):
+    def setUp(self):
+        routing_fixtures.TempDirTestCase.setUp(self)
+        self.itin_json_strs = make_itin_json_strs(10)
+        self.zdict = itin_codec.build_names_zdict(
+            map(json.loads, self.itin_json_strs))
+
+    def forget_zdict(self):
+        # As if in a new process, that needs to load it from its file.
+        itin_codec._zdicts_by_id.pop(self.zdict.zdict_id, None)
+
+    def test_names_zdict(self):
+        self.assertTrue('"agencyName": "Fake Transit"' in self.zdict.dict_str)
+        self.assertTrue(self.zdict.dict_str.endswith(
+            itin_codec.BASE_ZDICT.dict_str))
+        self.assertTrue(len(self.zdict.dict_str) \
+            <= itin_codec.MAX_ZDICT_BYTES)
+
+    def test_round_trip_via_saved_zdict(self):
+        self.assertEqual(itin_codec.get_writing_zdict(self.tmp_dir),
+            itin_codec.BASE_ZDICT)
+        itin_codec.save_zdict(self.zdict, self.tmp_dir)
+        self.assertEqual(itin_codec.get_writing_zdict(self.tmp_dir).zdict_id,
+            self.zdict.zdict_id)
+        records = [itin_codec.encode_itin_json_str(itin_json_str, True,
+            self.zdict) for itin_json_str in self.itin_json_strs]
+        self.forget_zdict()
+        for itin_json_str, record in zip(self.itin_json_strs, records):
+            self.assertEqual(itin_codec.decode_itin_json_str(record,
+                self.tmp_dir), itin_json_str)
+
+    def test_missing_zdict(self):
+        record = itin_codec.encode_itin_json_str(self.itin_json_strs[0],
+            True, self.zdict)
+        self.forget_zdict()
+        self.assertRaises(ValueError, itin_codec.decode_itin_json_str,
+            record, self.tmp_dir)
+
+    def test_corrupt_zdict(self):
+        itin_codec.save_zdict(self.zdict, self.tmp_dir)
+        self.forget_zdict()
+        zdict_file = open(itin_codec.get_zdict_fname(self.tmp_dir,
+            self.zdict.zdict_id), 'ab')
+        zdict_file.write("extra")
+        zdict_file.close()
+        self.assertRaises(ValueError, itin_codec.get_zdict,
+            self.zdict.zdict_id, self.tmp_dir)
+
+if __name__ == "__main__":
+    unittest.main()
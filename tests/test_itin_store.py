@@ -0,0 +1,129 @@
+import os.path
+import json
+import zlib
+
+from pyOTPA import itin_codec
+from pyOTPA import itin_store
+from pyOTPA import result_files
+
+import routing_fixtures
+
+def make_itin_json_str(ii):
+    return json.dumps({'startTime': 1420088400000 + ii * 1000,
+        'endTime': 1420090000000 + ii * 7000, 'walkTime': ii,
+        'legs': [{'mode': 'WALK', 'startTime': 1420088400000,
+            'endTime': 1420090000000, 'distance': ii * 1.5,
+            'duration': 1600000.0}]})
+
+def make_results(n_results, first_i=0):
+    return [("T%04d" % ii, make_itin_json_str(ii)) \
+        for ii in range(first_i, first_i + n_results)]
+
+def find_result_compressing_to_newline():
+    """Returns a result whose zlib-compressed record contains newlines and
+    tabs, as records framed by line would be broken by."""
+    for ii in range(100000):
+        itin_json_str = make_itin_json_str(ii)
+        record = zlib.compress(itin_json_str, itin_codec.COMPRESS_LEVEL)
+        if "\n" in record and "\t" in record:
+            return "N%d" % ii, itin_json_str
+    raise AssertionError("No such result found.")
+
+class ItinStoreTest(routing_fixtures.TempDirTestCase):
+    def write(self, results, **writer_kwargs):
+        writer = itin_store.ItinStoreWriter(self.tmp_dir, **writer_kwargs)
+        for trip_id, itin_json_str in results:
+            writer.append_json_str(trip_id, itin_json_str)
+        writer.close()
+
+    def read_all(self):
+        reader = itin_store.ItinStoreReader(self.tmp_dir)
+        json_strs = dict((trip_id, reader.read_json_str(trip_id)) \
+            for trip_id in reader.get_trip_ids())
+        reader.close()
+        return json_strs
+
+    def test_round_trip(self):
+        results = make_results(20)
+        self.write(results, writer_id="w1")
+        self.assertTrue(itin_store.has_store(self.tmp_dir))
+        self.assertEqual(self.read_all(), dict(results))
+        reader = itin_store.ItinStoreReader(self.tmp_dir)
+        self.assertEqual(reader.read_itin("T0003").json,
+            json.loads(results[3][1]))
+        self.assertEqual([trip_id for trip_id, itin in reader.iter_itins()],
+            [trip_id for trip_id, itin_json_str in results])
+        reader.close()
+
+    def test_compressed_records_with_newlines(self):
+        results = make_results(10) + [find_result_compressing_to_newline()]
+        self.write(results, writer_id="w1", compress=True)
+        self.assertEqual(self.read_all(), dict(results))
+        store = itin_store.MappedItinStore(self.tmp_dir)
+        self.assertEqual(sorted(store), sorted(dict(results)))
+        self.assertEqual(store.read_json_str(results[-1][0]), results[-1][1])
+        store.close()
+
+    def test_compressed_with_zdict(self):
+        zdict = itin_codec.build_names_zdict(
+            [json.loads(itin_json_str) for trip_id, itin_json_str \
+                in make_results(20)])
+        results = make_results(10)
+        self.write(results, writer_id="w1", compress=True, zdict=zdict)
+        self.assertEqual(self.read_all(), dict(results))
+
+    def test_segment_rollover(self):
+        results = make_results(30)
+        self.write(results, writer_id="w1", segment_max_bytes=1000)
+        self.assertTrue(len(itin_store.get_segment_fnames(self.tmp_dir)) > 3)
+        self.assertEqual(self.read_all(), dict(results))
+        # A new writer with the same ID carries on in new segments.
+        n_segments = len(itin_store.get_segment_fnames(self.tmp_dir))
+        more_results = make_results(5, 30)
+        self.write(more_results, writer_id="w1", segment_max_bytes=1000)
+        self.assertTrue(len(itin_store.get_segment_fnames(self.tmp_dir)) \
+            > n_segments)
+        self.assertEqual(self.read_all(), dict(results + more_results))
+
+    def test_batch_append(self):
+        writer = itin_store.ItinStoreWriter(self.tmp_dir, "w1",
+            segment_max_bytes=2000, compress=True)
+        results = make_results(40)
+        writer.append_json_strs(results[:25])
+        writer.append_json_strs(results[25:])
+        writer.close()
+        self.assertTrue(len(itin_store.get_segment_fnames(self.tmp_dir)) > 1)
+        self.assertEqual(self.read_all(), dict(results))
+
+    def test_several_writers_and_rewrites(self):
+        self.write(make_results(10), writer_id="w1")
+        self.write(make_results(10, 10), writer_id="w2")
+        rewritten = [("T0002", make_itin_json_str(99))]
+        self.write(rewritten, writer_id="w1")
+        expected = dict(make_results(20))
+        expected.update(rewritten)
+        self.assertEqual(self.read_all(), expected)
+
+    def test_incomplete_index_line_skipped(self):
+        results = make_results(5)
+        self.write(results, writer_id="w1")
+        index_fname = itin_store.get_index_fnames(self.tmp_dir)[0]
+        index_file = open(index_fname, 'a')
+        index_file.write("T9999\titins-w1-00000.seg\t12")
+        index_file.close()
+        self.assertEqual(self.read_all(), dict(results))
+
+    def test_convert_dir_to_store(self):
+        results = make_results(10)
+        for ii, (trip_id, itin_json_str) in enumerate(results):
+            result_files.write_file_atomic(result_files.make_result_fname(
+                self.tmp_dir, trip_id, hashed_dirs=ii % 2 == 0),
+                itin_json_str)
+        self.assertEqual(itin_store.convert_dir_to_store(self.tmp_dir,
+            remove_files=True, compress=True), 10)
+        self.assertEqual(result_files.get_result_fnames(self.tmp_dir), {})
+        # The JSON is re-encoded when converted.
+        self.assertEqual(dict((trip_id, json.loads(itin_json_str)) \
+            for trip_id, itin_json_str in self.read_all().iteritems()),
+            dict((trip_id, json.loads(itin_json_str)) \
+                for trip_id, itin_json_str in results))
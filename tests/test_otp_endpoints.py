@@ -0,0 +1,46 @@
+import socket
+import unittest
+
+from pyOTPA import Trip
+from pyOTPA.Benchmarks import bench_routing
+from pyOTPA.TripRunner import otp_endpoints
+from pyOTPA.TripRunner import otp_router
+
+import routing_fixtures
+
+class RaisingConnPool:
+    def __init__(self, exc):
+        self.exc = exc
+
+    def get(self, url, timeout=None):
+        raise self.exc
+
+class EndpointBalancerTest(unittest.TestCase):
+    def request(self, balancer, conn_pool):
+        trip = routing_fixtures.make_trips(1).values()[0]
+        trip_req_start_dt = trip[Trip.START_DTIME]
+        return otp_router.request_trip_plan(balancer,
+            bench_routing.BENCH_ROUTING_PARAMS, trip_req_start_dt.date(),
+            trip_req_start_dt.time(), trip[Trip.ORIGIN], trip[Trip.DEST],
+            "router0", conn_pool=conn_pool)
+
+    def test_released_after_any_error(self):
+        balancer = otp_endpoints.EndpointBalancer.from_urls(
+            ["http://a", "http://b"], eject_after_failures=100)
+        for exc in [socket.error("reset"), ValueError("bug"),
+                KeyboardInterrupt()]:
+            self.assertRaises(type(exc), self.request, balancer,
+                RaisingConnPool(exc))
+        for endpoint in balancer.endpoints:
+            self.assertEqual(endpoint.outstanding, 0)
+        self.assertEqual(sum(endpoint.n_failures \
+            for endpoint in balancer.endpoints), 3)
+
+    def test_least_outstanding(self):
+        balancer = otp_endpoints.EndpointBalancer.from_urls(
+            ["http://a", "http://b"])
+        first = balancer.choose("router0")
+        second = balancer.choose("router0")
+        self.assertNotEqual(first, second)
+        balancer.release(first, 0.1)
+        self.assertEqual(balancer.choose("router0"), first)
@@ -0,0 +1,29 @@
+from pyOTPA.Benchmarks import fake_otp_server
+from pyOTPA.TripRunner import otp_router
+from pyOTPA.TripRunner import routing_retries
+
+import routing_fixtures
+
+class FailingServerTest(routing_fixtures.FakeServerTestCase):
+    server_config = fake_otp_server.FakeOTPConfig(latency=0.001,
+        error_rate=1.0)
+
+    def route_failing_trips(self, retry_policy):
+        trips_by_id = routing_fixtures.make_trips(100)
+        results = routing_fixtures.route_trips(self.server_url, trips_by_id,
+            self.tmp_dir, max_in_flight=2, retry_policy=retry_policy)
+        for graph_results in results.itervalues():
+            self.assertEqual(graph_results, {})
+        # Each graph should be given up on well before all its trips are
+        # tried.
+        self.assertTrue(self.server.n_requests \
+            < 2 * (otp_router.MAX_ALLOWED_FAIL_TO_GET_RESULT + 5))
+
+    def test_gives_up_without_breaker(self):
+        self.route_failing_trips(routing_retries.RetryPolicy(max_attempts=1,
+            breaker_failure_threshold=None))
+
+    def test_gives_up_with_breaker(self):
+        # A breaker that never opens:- the run must still give up.
+        self.route_failing_trips(routing_retries.RetryPolicy(max_attempts=1,
+            breaker_failure_threshold=1000))
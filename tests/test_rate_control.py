@@ -0,0 +1,57 @@
+import unittest
+
+from pyOTPA.TripRunner import rate_control
+
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual(rate_control.percentile(values, 95), 95)
+        self.assertEqual(rate_control.percentile([3, 1, 2], 50), 2)
+        self.assertEqual(rate_control.percentile([], 95), None)
+
+class AIMDConcurrencyControllerTest(unittest.TestCase):
+    def make_controller(self, **kwargs):
+        return rate_control.AIMDConcurrencyController(1.0, max_limit=16,
+            adjust_every=10, **kwargs)
+
+    def test_increases_under_target(self):
+        controller = self.make_controller(initial_limit=4)
+        for i in range(30):
+            controller.record_latency(0.1)
+        self.assertEqual(controller.get_limit(), 7)
+
+    def test_never_above_max_limit(self):
+        controller = self.make_controller(initial_limit=15)
+        for i in range(100):
+            controller.record_latency(0.1)
+        self.assertEqual(controller.get_limit(), 16)
+
+    def test_decreases_over_target(self):
+        controller = self.make_controller(initial_limit=10)
+        for i in range(10):
+            controller.record_latency(5.0)
+        self.assertEqual(controller.get_limit(), 7)
+
+    def test_overload_decreases_once_per_window(self):
+        controller = self.make_controller(initial_limit=16)
+        controller.record_overload()
+        self.assertEqual(controller.get_limit(), 11)
+        for i in range(controller.adjust_every - 1):
+            controller.record_overload()
+        self.assertEqual(controller.get_limit(), 11)
+        controller.record_overload()
+        self.assertEqual(controller.get_limit(), 7)
+
+    def test_overloads_after_adjustment_still_decrease(self):
+        # Every request timing out (so no latency samples) after an
+        # adjustment must still bring the limit down to min_limit.
+        controller = self.make_controller(initial_limit=4)
+        for i in range(10):
+            controller.record_latency(0.1)
+        self.assertEqual(controller.get_limit(), 5)
+        for i in range(100):
+            controller.record_overload()
+        self.assertEqual(controller.get_limit(), controller.min_limit)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os.path
+
+from pyOTPA import Trip
+from pyOTPA.Benchmarks import bench_routing
+from pyOTPA.TripRunner import otp_router
+from pyOTPA.TripRunner import result_cache
+
+import routing_fixtures
+
+class RoutingResultCacheTest(routing_fixtures.FakeServerTestCase):
+    def setUp(self):
+        routing_fixtures.FakeServerTestCase.setUp(self)
+        self.cache = result_cache.RoutingResultCache(
+            os.path.join(self.tmp_dir, "cache"))
+        self.trip = routing_fixtures.make_trips(1).values()[0]
+
+    def route_trip(self):
+        trip_req_start_dt = self.trip[Trip.START_DTIME]
+        return otp_router.route_trip(self.server_url,
+            bench_routing.BENCH_ROUTING_PARAMS, trip_req_start_dt.date(),
+            trip_req_start_dt.time(), self.trip[Trip.ORIGIN],
+            self.trip[Trip.DEST], "router0", result_cache=self.cache)
+
+    def test_put_and_get(self):
+        key = self.cache.make_key("router0", {'mode': 'WALK'}, (1.0, 2.0),
+            (3.0, 4.0), self.trip[Trip.START_DTIME])
+        self.assertEqual(self.cache.get(key), None)
+        self.cache.put(key, '{"plan": {}}')
+        self.assertEqual(self.cache.get(key), '{"plan": {}}')
+
+    def test_overwriting_key_keeps_size(self):
+        key = self.cache.make_key("router0", {'mode': 'WALK'}, (1.0, 2.0),
+            (3.0, 4.0), self.trip[Trip.START_DTIME])
+        for n_repeats in [10, 20, 5]:
+            self.cache.put(key, 'x' * n_repeats)
+        self.assertEqual(self.cache.get_stats()['size (bytes)'], 5)
+
+    def test_route_trip_caches_responses(self):
+        res_str = self.route_trip()
+        self.assertTrue(res_str)
+        n_requests = self.server.n_requests
+        self.assertEqual(self.route_trip(), res_str)
+        self.assertEqual(self.server.n_requests, n_requests)
+
+    def test_route_trip_and_get_itin_uses_cache(self):
+        result = otp_router.route_trip_and_get_itin(self.server_url,
+            bench_routing.BENCH_ROUTING_PARAMS, self.trip, "router0",
+            result_cache=self.cache)
+        self.assertFalse(result.from_cache)
+        n_requests = self.server.n_requests
+        cached_result = otp_router.route_trip_and_get_itin(self.server_url,
+            bench_routing.BENCH_ROUTING_PARAMS, self.trip, "router0",
+            result_cache=self.cache)
+        self.assertTrue(cached_result.from_cache)
+        self.assertEqual(cached_result.status, result.status)
+        self.assertEqual(self.server.n_requests, n_requests)
@@ -0,0 +1,92 @@
+import os, os.path
+
+from pyOTPA import result_files
+from pyOTPA import trip_itins_io
+
+import routing_fixtures
+
+TRIP_IDS = ["%06d" % ii for ii in range(30)]
+
+class ResultFilesTest(routing_fixtures.TempDirTestCase):
+    def write_results(self, trip_ids, hashed_dirs):
+        for trip_id in trip_ids:
+            result_files.write_file_atomic(result_files.make_result_fname(
+                self.tmp_dir, trip_id, hashed_dirs), '{"id": "%s"}' % trip_id)
+
+    def test_hashed_layout(self):
+        fname = result_files.get_result_fname(self.tmp_dir, "000001", True)
+        subdirs = os.path.relpath(os.path.dirname(fname), self.tmp_dir)
+        self.assertEqual([len(name) for name in subdirs.split(os.sep)],
+            result_files.HASHED_DIR_DIGITS)
+        self.assertEqual(result_files.get_hashed_subdir("000001"), subdirs)
+        self.assertEqual(result_files.get_graph_dir(fname), self.tmp_dir)
+        self.assertEqual(result_files.get_graph_dir(
+            result_files.get_result_fname(self.tmp_dir, "000001")),
+            self.tmp_dir)
+
+    def test_round_trip(self):
+        for hashed_dirs in [False, True]:
+            self.write_results(TRIP_IDS, hashed_dirs)
+            fnames = result_files.get_result_fnames(self.tmp_dir)
+            self.assertEqual(sorted(fnames), TRIP_IDS)
+            for trip_id, fname in fnames.iteritems():
+                self.assertEqual(fname, result_files.get_result_fname(
+                    self.tmp_dir, trip_id, hashed_dirs))
+                self.assertEqual(open(fname).read(), '{"id": "%s"}' % trip_id)
+
+    def test_other_files_ignored(self):
+        self.write_results(TRIP_IDS[:5], True)
+        open(os.path.join(self.tmp_dir, "routing_manifest.csv"), 'w').close()
+        open(result_files.get_result_fname(self.tmp_dir, TRIP_IDS[0], True) \
+            + ".1.2.tmp", 'w').close()
+        self.assertEqual(sorted(result_files.get_result_file_trip_ids(
+            self.tmp_dir)), TRIP_IDS[:5])
+
+    def test_mixed_layouts(self):
+        self.write_results(TRIP_IDS[:20], False)
+        self.write_results(TRIP_IDS[10:], True)
+        fnames = result_files.get_result_fnames(self.tmp_dir)
+        self.assertEqual(sorted(fnames), TRIP_IDS)
+        # Hashed copies are preferred.
+        self.assertEqual(fnames[TRIP_IDS[15]], result_files.get_result_fname(
+            self.tmp_dir, TRIP_IDS[15], True))
+
+    def test_move_result_files(self):
+        self.write_results(TRIP_IDS[:20], False)
+        self.write_results(TRIP_IDS[10:], True)
+        self.assertEqual(result_files.move_result_files(self.tmp_dir, True),
+            10)
+        self.assertEqual([entry for entry in os.listdir(self.tmp_dir) \
+            if entry.endswith(result_files.RESULT_FILE_EXT)], [])
+        self.assertEqual(sorted(result_files.get_result_fnames(
+            self.tmp_dir)), TRIP_IDS)
+
+        self.assertEqual(result_files.move_result_files(self.tmp_dir, False),
+            len(TRIP_IDS))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+            [trip_id + ".json" for trip_id in TRIP_IDS])
+
+    def test_link_result_files(self):
+        self.write_results(TRIP_IDS, True)
+        dest_dir = os.path.join(self.tmp_dir, "linked")
+        self.assertEqual(result_files.link_result_files(self.tmp_dir,
+            dest_dir), len(TRIP_IDS))
+        self.assertEqual(result_files.link_result_files(self.tmp_dir,
+            dest_dir), 0)
+        self.assertEqual(sorted(result_files.get_result_fnames(dest_dir)),
+            TRIP_IDS)
+
+class HashedResultsLoadTest(routing_fixtures.FakeServerTestCase):
+    def test_routed_results_load(self):
+        trips_by_id = routing_fixtures.make_trips(40)
+        results = routing_fixtures.route_trips(self.server_url, trips_by_id,
+            self.tmp_dir, hashed_result_dirs=True, compress_itins=True)
+        for graph_name in routing_fixtures.GRAPH_SPECS:
+            graph_dir = os.path.join(self.tmp_dir, graph_name)
+            self.assertFalse([entry for entry in os.listdir(graph_dir) \
+                if entry.endswith(result_files.RESULT_FILE_EXT)])
+        loaded = trip_itins_io.load_trip_itineraries(self.tmp_dir)
+        for graph_name, graph_results in results.iteritems():
+            self.assertEqual(routing_fixtures.get_itin_jsons(
+                loaded[graph_name]), routing_fixtures.get_itin_jsons(
+                    graph_results))
@@ -0,0 +1,145 @@
+import os.path
+import time
+import json
+
+from pyOTPA import itin_codec
+from pyOTPA import itin_store
+from pyOTPA import result_files
+from pyOTPA.TripRunner import otp_router
+from pyOTPA.TripRunner import result_writer
+from pyOTPA.TripRunner import routing_telemetry
+from pyOTPA.TripRunner import run_manifest
+from pyOTPA.Benchmarks import fake_otp_server
+
+import routing_fixtures
+
+def make_results(n_results):
+    return [("T%03d" % ii, json.dumps({'duration': ii})) \
+        for ii in range(n_results)]
+
+def read_result_files(graph_dir):
+    return dict((trip_id, itin_codec.decode_itin_json_str(
+        open(fname, 'rb').read(), graph_dir)) for trip_id, fname \
+        in result_files.get_result_fnames(graph_dir).iteritems())
+
+class FailingItinWriter:
+    def append_json_strs(self, trip_ids_and_json_strs, fsync=False):
+        raise IOError("disk full")
+
+    def close(self):
+        pass
+
+class CheckingManifestWriter(run_manifest.RunManifestWriter):
+    """Checks each trip's result is already saved when it's recorded."""
+    def record(self, trip_id, status, *args, **kwargs):
+        fname = result_files.get_result_fname(os.path.dirname(self.fname),
+            trip_id, True)
+        assert os.path.exists(fname), fname
+        run_manifest.RunManifestWriter.record(self, trip_id, status,
+            *args, **kwargs)
+
+class BatchedResultWriterTest(routing_fixtures.TempDirTestCase):
+    def test_writes_result_files_in_batches(self):
+        writer = result_writer.BatchedResultWriter(self.tmp_dir,
+            compress=True, hashed_dirs=True, max_batch_size=5,
+            max_batch_seconds=60, fsync=False)
+        results = make_results(12)
+        for trip_id, itin_json_str in results[:5]:
+            writer.add_result([trip_id], itin_json_str)
+        # A full batch is written without waiting for max_batch_seconds.
+        wait_until = time.time() + 5.0
+        while writer.n_batches_written == 0 and time.time() < wait_until:
+            time.sleep(0.01)
+        self.assertEqual(writer.n_results_written, 5)
+        for trip_id, itin_json_str in results[5:]:
+            writer.add_result([trip_id], itin_json_str)
+        writer.close()
+        self.assertEqual(read_result_files(self.tmp_dir), dict(results))
+        self.assertEqual(writer.n_results_written, 12)
+
+    def test_batch_waits_for_size_or_time(self):
+        writer = result_writer.BatchedResultWriter(self.tmp_dir,
+            max_batch_size=10, max_batch_seconds=0.3, fsync=False)
+        writer.add_result(["T1", "T2"], "{}")
+        time.sleep(0.1)
+        self.assertEqual(read_result_files(self.tmp_dir), {})
+        time.sleep(0.5)
+        self.assertEqual(read_result_files(self.tmp_dir),
+            {"T1": "{}", "T2": "{}"})
+        writer.close()
+
+    def test_writes_to_itin_store(self):
+        itin_writer = itin_store.ItinStoreWriter(self.tmp_dir, "w1",
+            compress=True)
+        writer = result_writer.BatchedResultWriter(self.tmp_dir,
+            itin_writer=itin_writer, max_batch_size=4, fsync=False)
+        results = make_results(10)
+        for trip_id, itin_json_str in results:
+            writer.add_result([trip_id], itin_json_str)
+        writer.close()
+        reader = itin_store.ItinStoreReader(self.tmp_dir)
+        self.assertEqual(dict((trip_id, reader.read_json_str(trip_id)) \
+            for trip_id in reader.get_trip_ids()), dict(results))
+        reader.close()
+
+    def test_manifest_entries_after_results(self):
+        writer = result_writer.BatchedResultWriter(self.tmp_dir,
+            hashed_dirs=True, manifest_writer=CheckingManifestWriter(
+                self.tmp_dir), max_batch_size=3, fsync=False)
+        for trip_id, itin_json_str in make_results(10):
+            writer.add_result([trip_id], itin_json_str)
+            writer.record_outcome(trip_id, otp_router.RESULT_OK, 1, 0.1)
+        writer.close()
+        self.assertEqual(sorted(run_manifest.read_manifest(self.tmp_dir)),
+            sorted(trip_id for trip_id, itin_json_str in make_results(10)))
+
+    def test_nothing_added_after_close(self):
+        writer = result_writer.BatchedResultWriter(self.tmp_dir,
+            manifest_writer=run_manifest.RunManifestWriter(self.tmp_dir),
+            fsync=False)
+        writer.close()
+        self.assertFalse(writer.add_result(["T1"], "{}"))
+        self.assertFalse(writer.record_outcome("T1", otp_router.RESULT_OK))
+        self.assertEqual(read_result_files(self.tmp_dir), {})
+
+    def test_write_errors_raised(self):
+        writer = result_writer.BatchedResultWriter(self.tmp_dir,
+            itin_writer=FailingItinWriter(), max_batch_size=1, fsync=False)
+        writer.add_result(["T1"], "{}")
+        self.assertRaises(IOError, writer.close)
+        self.assertRaises(IOError, writer.add_result, ["T2"], "{}")
+
+class InterruptingTelemetry(routing_telemetry.RoutingTelemetry):
+    """Mimics Ctrl-C part way through routing."""
+    def __init__(self, n_results_before_interrupt):
+        routing_telemetry.RoutingTelemetry.__init__(self)
+        self.n_results_left = n_results_before_interrupt
+
+    def maybe_write(self, graph_telemetry, extra=None):
+        self.n_results_left -= 1
+        if self.n_results_left == 0:
+            raise KeyboardInterrupt()
+
+class InterruptedRoutingTest(routing_fixtures.FakeServerTestCase):
+    server_config = fake_otp_server.FakeOTPConfig(latency=0.01,
+        latency_jitter=0.5)
+
+    def test_interrupt_saves_results_routed(self):
+        trips_by_id = routing_fixtures.make_trips(40)
+        start_time = time.time()
+        self.assertRaises(KeyboardInterrupt, routing_fixtures.route_trips,
+            self.server_url, trips_by_id, self.tmp_dir, max_in_flight=8,
+            telemetry=InterruptingTelemetry(10))
+        # Shouldn't have waited on the requests still in flight.
+        self.assertTrue(time.time() - start_time < 5.0)
+        # Graphs are routed one at a time, so only the first has started.
+        graph_names = os.listdir(self.tmp_dir)
+        self.assertEqual(len(graph_names), 1)
+        for graph_name in graph_names:
+            graph_dir = os.path.join(self.tmp_dir, graph_name)
+            manifest = run_manifest.read_manifest(graph_dir)
+            saved = result_files.get_result_fnames(graph_dir)
+            self.assertTrue(len(manifest) >= 1)
+            for trip_id, entry in manifest.iteritems():
+                if entry.status == otp_router.RESULT_OK:
+                    self.assertTrue(trip_id in saved)
@@ -0,0 +1,80 @@
+import threading
+import time
+import unittest
+
+from pyOTPA.TripRunner import routing_pool
+
+def wait_then_return(event, value):
+    event.wait()
+    return value
+
+class BoundedWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+
+    def tearDown(self):
+        # Let any call left blocked finish.
+        self.release.set()
+
+    def test_yields_all_results(self):
+        pool = routing_pool.BoundedWorkerPool(4)
+        results = dict(pool.imap_unordered(lambda x: x * 2,
+            [(ii,) for ii in range(20)]))
+        self.assertEqual(results, dict(((ii,), ii * 2) \
+            for ii in range(20)))
+
+    def test_serial_when_one_in_flight(self):
+        pool = routing_pool.BoundedWorkerPool(1)
+        thread_names = [args_result[1] for args_result \
+            in pool.imap_unordered(
+                lambda: threading.current_thread().name, [(), ()])]
+        self.assertEqual(set(thread_names),
+            set([threading.current_thread().name]))
+
+    def test_func_errors_reraised(self):
+        def fail(x):
+            raise ValueError(x)
+        pool = routing_pool.BoundedWorkerPool(2)
+        self.assertRaises(ValueError, list, pool.imap_unordered(fail,
+            [(1,), (2,)]))
+
+    def test_stopping_early_waits_on_calls_in_flight(self):
+        pool = routing_pool.BoundedWorkerPool(2)
+        results = pool.imap_unordered(wait_then_return,
+            [(self.release, 1), (self.release, 2), (self.release, 3)])
+        threading.Timer(0.2, self.release.set).start()
+        results.next()
+        results.close()
+        self.assertTrue(self.release.is_set())
+
+    def test_abandon_doesnt_wait_on_calls_in_flight(self):
+        pool = routing_pool.BoundedWorkerPool(3)
+        done = threading.Event()
+        done.set()
+        results = pool.imap_unordered(wait_then_return,
+            [(done, 1), (self.release, 2), (self.release, 3)])
+        self.assertEqual(results.next(), ((done, 1), 1))
+        pool.abandon_in_flight()
+        start_time = time.time()
+        results.close()
+        self.assertTrue(time.time() - start_time < 1.0)
+        self.assertFalse(self.release.is_set())
+
+    def test_interrupt_doesnt_wait_on_calls_in_flight(self):
+        pool = routing_pool.BoundedWorkerPool(2)
+        n_gets = [0]
+        def interrupted_get_result():
+            # Ctrl-C while waiting on the first result:- any further wait
+            # would be draining the calls in flight.
+            n_gets[0] += 1
+            if n_gets[0] == 1:
+                raise KeyboardInterrupt()
+            return None, None, None
+        pool._get_result = interrupted_get_result
+        results = pool.imap_unordered(wait_then_return,
+            [(self.release, 1), (self.release, 2)])
+        self.assertRaises(KeyboardInterrupt, results.next)
+        self.assertEqual(n_gets[0], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import socket
+import threading
+import time
+import unittest
+import urllib2
+
+from pyOTPA import http_pool
+from pyOTPA.TripRunner import routing_retries
+
+COOLDOWN = 0.05
+
+def run_in_thread(func):
+    """Runs func in another thread, returning the thread, and a list that
+    gets func's result (or exception) once it's done."""
+    outcome = []
+    def run():
+        try:
+            outcome.append(func())
+        except Exception, e:
+            outcome.append(e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread, outcome
+
+class ClassifyTransportErrorTest(unittest.TestCase):
+    def test_causes(self):
+        self.assertEqual(routing_retries.classify_transport_error(
+            urllib2.URLError(socket.timeout("timed out"))),
+            routing_retries.CAUSE_TIMEOUT)
+        self.assertEqual(routing_retries.classify_transport_error(
+            http_pool.HTTPRequestError("Server error", status=500)),
+            routing_retries.CAUSE_HTTP_STATUS)
+        self.assertEqual(routing_retries.classify_transport_error(
+            urllib2.URLError("reset")), routing_retries.CAUSE_CONN_ERROR)
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_backoff_capped(self):
+        policy = routing_retries.RetryPolicy(initial_backoff=1,
+            max_backoff=5)
+        for attempt in range(1, 10):
+            backoff = policy.get_backoff_seconds(attempt)
+            self.assertTrue(0 <= backoff <= min(5, 2 ** (attempt - 1)))
+
+    def test_should_retry(self):
+        policy = routing_retries.RetryPolicy(max_attempts=3)
+        self.assertTrue(policy.should_retry(2))
+        self.assertFalse(policy.should_retry(3))
+
+    def test_no_breaker(self):
+        policy = routing_retries.RetryPolicy(breaker_failure_threshold=None)
+        self.assertEqual(policy.new_circuit_breaker(), None)
+
+class CircuitBreakerTest(unittest.TestCase):
+    def make_open_breaker(self, **kwargs):
+        breaker = routing_retries.CircuitBreaker(failure_threshold=3,
+            cooldown=COOLDOWN, **kwargs)
+        for ii in range(3):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        return breaker
+
+    def test_opens_after_threshold(self):
+        breaker = routing_retries.CircuitBreaker(failure_threshold=3)
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(breaker.n_times_opened, 1)
+
+    def test_probe_success_closes(self):
+        breaker = self.make_open_breaker()
+        start_time = time.time()
+        breaker.wait_until_allowed()
+        self.assertTrue(time.time() - start_time >= COOLDOWN * 0.9)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        # Other requests wait on the probe.
+        thread, outcome = run_in_thread(breaker.wait_until_allowed)
+        thread.join(COOLDOWN)
+        self.assertEqual(outcome, [])
+        breaker.record_success()
+        thread.join(1.0)
+        self.assertEqual(outcome, [None])
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_probe_failure_reopens(self):
+        breaker = self.make_open_breaker()
+        breaker.wait_until_allowed()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(breaker.n_times_opened, 2)
+        self.assertEqual(breaker._cooldown, COOLDOWN * 2)
+        # Failures are counted afresh once it re-opens.
+        self.assertEqual(breaker._consecutive_failures, 0)
+
+    def test_late_failure_isnt_probe_failure(self):
+        breaker = self.make_open_breaker()
+        breaker.wait_until_allowed()
+        # A request sent before the breaker opened fails meanwhile.
+        thread, outcome = run_in_thread(breaker.record_failure)
+        thread.join(1.0)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.record_success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_released_probe_lets_another_probe(self):
+        breaker = self.make_open_breaker()
+        def probe_dies():
+            breaker.wait_until_allowed()
+            try:
+                raise KeyError('plan')
+            finally:
+                breaker.release_probe()
+        thread, outcome = run_in_thread(probe_dies)
+        thread.join(1.0)
+        self.assertTrue(isinstance(outcome[0], KeyError))
+        thread, outcome = run_in_thread(breaker.wait_until_allowed)
+        thread.join(1.0)
+        self.assertEqual(outcome, [None])
+
+    def test_open_too_long_raises(self):
+        breaker = self.make_open_breaker(max_open_seconds=COOLDOWN)
+        time.sleep(COOLDOWN * 2)
+        self.assertRaises(routing_retries.CircuitOpenError,
+            breaker.wait_until_allowed)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import os.path
+
+from pyOTPA import itin_store
+from pyOTPA import result_files
+from pyOTPA.TripRunner import otp_router
+from pyOTPA.TripRunner import run_manifest
+
+import routing_fixtures
+
+class RunManifestTest(routing_fixtures.TempDirTestCase):
+    def test_round_trip(self):
+        writer = run_manifest.RunManifestWriter(self.tmp_dir)
+        writer.record("T1", otp_router.RESULT_OK, 1, 0.25)
+        writer.record("T2", otp_router.RESULT_FAILED, 3, 30.0,
+            "timeout")
+        writer.record("T2", otp_router.RESULT_NO_ITIN, 1, 0.5)
+        writer.close()
+        entries = run_manifest.read_manifest(self.tmp_dir)
+        self.assertEqual(sorted(entries), ["T1", "T2"])
+        self.assertEqual(entries["T1"].latency_s, 0.25)
+        # The last entry for a trip is the current one.
+        self.assertEqual(entries["T2"].status, otp_router.RESULT_NO_ITIN)
+        self.assertEqual(entries["T2"].cause, None)
+
+    def test_several_manifests_and_incomplete_lines(self):
+        writer = run_manifest.RunManifestWriter(self.tmp_dir)
+        writer.record("T1", otp_router.RESULT_OK, 1)
+        writer.close()
+        other_writer = run_manifest.RunManifestWriter(self.tmp_dir,
+            "routing_manifest-w2.csv")
+        other_writer.record("T2", otp_router.RESULT_OK, 1)
+        other_writer.close()
+        manifest_file = open(other_writer.fname, 'a')
+        manifest_file.write("T3,ok")
+        manifest_file.close()
+        self.assertTrue(run_manifest.has_manifest(self.tmp_dir))
+        self.assertEqual(sorted(run_manifest.read_manifest(self.tmp_dir)),
+            ["T1", "T2"])
+
+    def test_latest_entry_across_workers(self):
+        # Sorts after the retrying worker's manifest, but is older.
+        failed_writer = run_manifest.RunManifestWriter(self.tmp_dir,
+            "routing_manifest-zeta-100.csv")
+        failed_writer.record("T1", otp_router.RESULT_FAILED, 3, None,
+            "timeout", recorded_at=1000.0)
+        failed_writer.record("T2", otp_router.RESULT_OK, 1,
+            recorded_at=3000.0)
+        failed_writer.close()
+        retry_writer = run_manifest.RunManifestWriter(self.tmp_dir,
+            "routing_manifest-alpha-200.csv")
+        retry_writer.record("T1", otp_router.RESULT_OK, 1,
+            recorded_at=2000.0)
+        retry_writer.record("T2", otp_router.RESULT_FAILED, 3,
+            recorded_at=2000.0)
+        retry_writer.close()
+        entries = run_manifest.read_manifest(self.tmp_dir)
+        self.assertEqual(entries["T1"].status, otp_router.RESULT_OK)
+        self.assertEqual(entries["T1"].recorded_at, 2000.0)
+        self.assertEqual(entries["T2"].status, otp_router.RESULT_OK)
+
+    def test_untimed_manifest_entries_use_file_mtime(self):
+        old_fname = os.path.join(self.tmp_dir,
+            "routing_manifest-zeta-100.csv")
+        old_file = open(old_fname, 'w')
+        old_file.write("trip_id,status,attempts,latency_s,cause\n"\
+            "T1,failed,3,,timeout\nT2,ok,1,0.500,\n")
+        old_file.close()
+        os.utime(old_fname, (1000, 1000))
+        # A timestamped entry appended to it later still counts.
+        writer = run_manifest.RunManifestWriter(self.tmp_dir,
+            "routing_manifest-zeta-100.csv")
+        writer.record("T3", otp_router.RESULT_OK, 1, recorded_at=500.0)
+        writer.close()
+        os.utime(old_fname, (1000, 1000))
+        retry_writer = run_manifest.RunManifestWriter(self.tmp_dir,
+            "routing_manifest-alpha-200.csv")
+        retry_writer.record("T1", otp_router.RESULT_OK, 1,
+            recorded_at=2000.0)
+        retry_writer.record("T2", otp_router.RESULT_FAILED, 3,
+            recorded_at=500.0)
+        retry_writer.close()
+        entries = run_manifest.read_manifest(self.tmp_dir)
+        self.assertEqual(sorted(entries), ["T1", "T2", "T3"])
+        self.assertEqual(entries["T1"].status, otp_router.RESULT_OK)
+        self.assertEqual(entries["T2"].status, otp_router.RESULT_OK)
+        self.assertEqual(entries["T2"].recorded_at, 1000.0)
+
+    def test_bootstrap_from_results(self):
+        for trip_id in ["T1", "T2"]:
+            result_files.write_file_atomic(result_files.make_result_fname(
+                self.tmp_dir, trip_id, True), "{}")
+        writer = itin_store.ItinStoreWriter(self.tmp_dir, "w1")
+        writer.append_json_str("T3", "{}")
+        writer.close()
+        self.assertEqual(run_manifest.bootstrap_manifest_from_results(
+            self.tmp_dir, otp_router.RESULT_OK), 3)
+        entries = run_manifest.read_manifest(self.tmp_dir)
+        self.assertEqual(sorted(entries), ["T1", "T2", "T3"])
+
+class ResumeTest(routing_fixtures.FakeServerTestCase):
+    def setUp(self):
+        routing_fixtures.FakeServerTestCase.setUp(self)
+        self.trips_by_id = routing_fixtures.make_trips(40)
+
+    def route(self, **kwargs):
+        return routing_fixtures.route_trips(self.server_url,
+            self.trips_by_id, self.tmp_dir, max_in_flight=4, **kwargs)
+
+    def test_resume_skips_routed_trips(self):
+        trip_ids = sorted(self.trips_by_id)
+        all_trips_by_id = self.trips_by_id
+        self.trips_by_id = dict((trip_id, all_trips_by_id[trip_id]) \
+            for trip_id in trip_ids[:25])
+        self.route()
+        n_requests = self.server.n_requests
+        self.trips_by_id = all_trips_by_id
+        results = self.route(resume_existing=True)
+        self.assertEqual(self.server.n_requests - n_requests,
+            15 * len(routing_fixtures.GRAPH_SPECS))
+        for graph_results in results.itervalues():
+            self.assertEqual(sorted(graph_results), trip_ids[25:])
+
+    def test_retry_failed(self):
+        self.route()
+        failed_ids = sorted(self.trips_by_id)[:3]
+        for graph_name in routing_fixtures.GRAPH_SPECS:
+            writer = run_manifest.RunManifestWriter(os.path.join(
+                self.tmp_dir, graph_name))
+            for trip_id in failed_ids:
+                writer.record(trip_id, otp_router.RESULT_FAILED, 3, None,
+                    "timeout")
+            writer.close()
+        n_requests = self.server.n_requests
+        results = self.route(retry_failed=True)
+        self.assertEqual(self.server.n_requests - n_requests,
+            len(failed_ids) * len(routing_fixtures.GRAPH_SPECS))
+        for graph_name, graph_results in results.iteritems():
+            self.assertEqual(sorted(graph_results), failed_ids)
+            entries = run_manifest.read_manifest(os.path.join(self.tmp_dir,
+                graph_name))
+            for trip_id in failed_ids:
+                self.assertNotEqual(entries[trip_id].status,
+                    otp_router.RESULT_FAILED)
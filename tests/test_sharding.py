@@ -0,0 +1,105 @@
+import os.path
+
+from pyOTPA import trip_itins_io
+from pyOTPA.Benchmarks import bench_routing
+from pyOTPA.TripRunner import otp_router
+from pyOTPA.TripRunner import run_manifest
+from pyOTPA.TripRunner import sharding
+
+import routing_fixtures
+
+class ShardingTest(routing_fixtures.FakeServerTestCase):
+    def route_sharded(self, trips_by_id, **kwargs):
+        return sharding.route_trip_set_sharded(self.server_url,
+            bench_routing.BENCH_ROUTING_PARAMS, routing_fixtures.GRAPH_SPECS,
+            trips_by_id, self.tmp_dir, **kwargs)
+
+    def test_shards_partition_trips(self):
+        trips_by_id = routing_fixtures.make_trips(200)
+        shards = [sharding.select_shard(trips_by_id, shard_i, 3) \
+            for shard_i in range(3)]
+        self.assertEqual(sum(len(shard) for shard in shards),
+            len(trips_by_id))
+        self.assertEqual(set().union(*shards), set(trips_by_id))
+
+    def test_leased_run_loads(self):
+        trips_by_id = routing_fixtures.make_trips(120)
+        results = self.route_sharded(trips_by_id, use_leases=True,
+            n_blocks=4, worker_id="w1", max_in_flight=4)
+        self.assertTrue(os.path.isdir(os.path.join(self.tmp_dir,
+            sharding.LEASE_DIR_NAME)))
+        self.assertEqual(sorted(trip_itins_io.read_graph_names(
+            self.tmp_dir)), sorted(routing_fixtures.GRAPH_SPECS))
+
+        loaded = trip_itins_io.load_trip_itineraries(self.tmp_dir)
+        self.assertEqual(sorted(loaded), sorted(routing_fixtures.GRAPH_SPECS))
+        for graph_name in routing_fixtures.GRAPH_SPECS:
+            self.assertEqual(routing_fixtures.get_itin_jsons(
+                loaded[graph_name]), routing_fixtures.get_itin_jsons(
+                    results[graph_name]))
+
+        reports = sharding.verify_routing_run(self.tmp_dir,
+            routing_fixtures.GRAPH_SPECS.keys(), trips_by_id.keys())
+        for report in reports.itervalues():
+            self.assertTrue(report.is_ok())
+
+    def test_second_worker_finds_blocks_done(self):
+        trips_by_id = routing_fixtures.make_trips(60)
+        self.route_sharded(trips_by_id, use_leases=True, n_blocks=3,
+            worker_id="w1")
+        n_requests = self.server.n_requests
+        results = self.route_sharded(trips_by_id, use_leases=True,
+            n_blocks=3, worker_id="w2")
+        self.assertEqual(self.server.n_requests, n_requests)
+        for graph_results in results.itervalues():
+            self.assertEqual(graph_results, {})
+
+    def test_stale_lease_taken_over(self):
+        leases = sharding.BlockLeases(os.path.join(self.tmp_dir, "leases"),
+            "w1", lease_seconds=60)
+        other_leases = sharding.BlockLeases(leases.lease_dir, "w2",
+            lease_seconds=60)
+        self.assertTrue(leases.try_claim(0))
+        self.assertFalse(other_leases.try_claim(0))
+        lease_fname = leases._lease_fname(0)
+        os.utime(lease_fname, (0, 0))
+        self.assertTrue(other_leases.try_claim(0))
+        other_leases.mark_done(0)
+        self.assertFalse(leases.try_claim(0))
+
+class VerifyRunTest(routing_fixtures.TempDirTestCase):
+    def test_trip_retried_by_another_worker(self):
+        graph_dir = os.path.join(self.tmp_dir, "graph_a")
+        os.makedirs(graph_dir)
+        writers = {}
+        for worker_id in ["zeta-100", "alpha-200"]:
+            writers[worker_id] = run_manifest.RunManifestWriter(graph_dir,
+                sharding.get_worker_manifest_fname(worker_id))
+        writers["zeta-100"].record("T1", otp_router.RESULT_FAILED, 3, None,
+            "timeout", recorded_at=1000.0)
+        writers["zeta-100"].record("T2", otp_router.RESULT_OK, 1,
+            recorded_at=1000.0)
+        writers["alpha-200"].record("T1", otp_router.RESULT_OK, 1,
+            recorded_at=2000.0)
+        for writer in writers.itervalues():
+            writer.close()
+
+        reports = sharding.verify_routing_run(self.tmp_dir, ["graph_a"],
+            ["T1", "T2"], merge=True)
+        self.assertTrue(reports["graph_a"].is_ok())
+        self.assertEqual(run_manifest.get_manifest_fnames(graph_dir),
+            [os.path.join(graph_dir, run_manifest.MANIFEST_FNAME)])
+        entries = run_manifest.read_manifest(graph_dir)
+        self.assertEqual(entries["T1"].status, otp_router.RESULT_OK)
+        self.assertEqual(entries["T1"].recorded_at, 2000.0)
+
+        # A later failure by another worker supersedes the merged entry,
+        # even though the merged manifest sorts after it.
+        writer = run_manifest.RunManifestWriter(graph_dir,
+            sharding.get_worker_manifest_fname("alpha-300"))
+        writer.record("T2", otp_router.RESULT_FAILED, 3, None, "timeout",
+            recorded_at=3000.0)
+        writer.close()
+        reports = sharding.verify_routing_run(self.tmp_dir, ["graph_a"],
+            ["T1", "T2"])
+        self.assertEqual(reports["graph_a"].failed_ids, set(["T2"]))
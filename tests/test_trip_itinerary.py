@@ -0,0 +1,109 @@
+import pickle
+import unittest
+from datetime import datetime, timedelta
+
+from pyOTPA import TripItinerary
+
+START_MS = 1420088400250
+
+def make_itin_json():
+    return {
+        'startTime': START_MS,
+        'endTime': START_MS + 1800500,
+        'duration': 1800,
+        'waitingTime': 120,
+        'walkTime': 600,
+        'transitTime': 1080,
+        'walkDistance': 750.5,
+        'transfers': 0,
+        'legs': [
+            {'mode': 'WALK', 'startTime': START_MS,
+                'endTime': START_MS + 300250, 'distance': 400.0,
+                'duration': 300250.0},
+            {'mode': 'BUS', 'startTime': START_MS + 420750,
+                'endTime': START_MS + 1500000, 'distance': 8000.0,
+                'duration': 1079250.0, 'agencyName': "Buses",
+                'routeId': "1:200", 'routeShortName': "200"},
+            {'mode': 'WALK', 'startTime': START_MS + 1500000,
+                'endTime': START_MS + 1800500, 'distance': 350.5,
+                'duration': 300500.0},
+            ],
+        }
+
+class TripItineraryTest(unittest.TestCase):
+    def setUp(self):
+        self.itin_json = make_itin_json()
+        self.itin = TripItinerary.TripItinerary(self.itin_json)
+        self.req_start_dt = datetime.fromtimestamp(START_MS / 1000) \
+            - timedelta(minutes=5)
+
+    def test_times_keep_fractional_seconds(self):
+        self.assertEqual(self.itin.get_start_dt(),
+            datetime.fromtimestamp(START_MS / 1000.0))
+        self.assertEqual(self.itin.get_end_dt(),
+            datetime.fromtimestamp((START_MS + 1800500) / 1000.0))
+        self.assertEqual(self.itin.get_wait_before_leg(1,
+            self.req_start_dt), timedelta(seconds=120.5))
+        self.assertEqual(self.itin.get_transfer_wait_before_leg(2,
+            self.req_start_dt), timedelta(0))
+
+    def test_getters(self):
+        self.assertEqual(self.itin.get_walk_td(), timedelta(seconds=600))
+        self.assertEqual(self.itin.get_dist_travelled(), 8750.5)
+        self.assertEqual(self.itin.get_longest_walk_leg_dist_m(), 400.0)
+        self.assertEqual(self.itin.get_mode_sequence(),
+            ['WALK', 'BUS', 'WALK'])
+        self.assertEqual(self.itin.get_first_non_walk_mode(), 'BUS')
+        self.assertEqual(self.itin.get_set_of_agencies_used(),
+            set(["Buses"]))
+        self.assertEqual(self.itin.get_leg_route(1), ("1:200", "200", None))
+        self.assertEqual(self.itin.get_time_sec_by_mode(),
+            {'WALK': 600.75, 'BUS': 1079.25})
+
+    def test_missing_optional_fields(self):
+        for itin_attr in ['waitingTime', 'walkTime', 'transitTime',
+                'walkDistance', 'transfers']:
+            del self.itin_json[itin_attr]
+        del self.itin_json['legs'][1]['agencyName']
+        itin = TripItinerary.TripItinerary(self.itin_json)
+        self.assertEqual(itin.get_itin_attr('walkTime'), None)
+        self.assertEqual(itin.get_walk_dist_m(), None)
+        self.assertEqual(itin.get_set_of_agencies_used(), set([None]))
+        self.assertEqual(itin.get_dist_travelled(), 8750.5)
+
+    def test_missing_leg_values_left_out_of_totals(self):
+        del self.itin_json['legs'][2]['distance']
+        del self.itin_json['legs'][0]['duration']
+        itin = TripItinerary.TripItinerary(self.itin_json)
+        self.assertEqual(itin.get_n_legs_missing_dist(), 1)
+        self.assertEqual(itin.get_dist_travelled(), 8400.0)
+        self.assertEqual(itin.get_dist_m_by_mode(),
+            {'WALK': 400.0, 'BUS': 8000.0})
+        self.assertEqual(itin.get_time_sec_by_mode(),
+            {'WALK': 300.5, 'BUS': 1079.25})
+        self.assertEqual(itin.get_longest_walk_leg_dist_m(), 400.0)
+        self.assertEqual(self.itin.get_n_legs_missing_dist(), 0)
+
+    def test_itin_attr_without_loading_json(self):
+        loads = []
+        def json_loader():
+            loads.append(1)
+            return self.itin_json
+        itin = TripItinerary.TripItinerary(self.itin_json, json_loader)
+        self.assertEqual(itin.get_itin_attr('walkTime'), 600)
+        self.assertEqual(itin.get_itin_attr('transfers'), 0)
+        self.assertEqual(loads, [])
+        self.assertEqual(itin.get_itin_attr('duration'), 1800)
+        self.assertEqual(loads, [1])
+
+    def test_pickles(self):
+        itin = pickle.loads(pickle.dumps(self.itin, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(itin.json, self.itin_json)
+        self.assertEqual(itin.get_start_dt(), self.itin.get_start_dt())
+        self.assertEqual(itin.get_wait_before_leg(1, self.req_start_dt),
+            self.itin.get_wait_before_leg(1, self.req_start_dt))
+        self.assertEqual(itin.get_mode_sequence(),
+            self.itin.get_mode_sequence())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import os.path
+import unittest
+from datetime import time
+
+from pyOTPA import Trip
+from pyOTPA import TripItinerary
+from pyOTPA import trip_itins_io
+from pyOTPA import trip_summary_table
+try:
+    from pyOTPA import trip_analysis
+except ImportError:
+    # Needs the GDAL Python bindings (osgeo).
+    trip_analysis = None
+
+import routing_fixtures
+
+DEP_TIME_CATS = {
+    'early': (set(range(7)), time(0, 0), time(8, 30)),
+    'late': (set(range(7)), time(8, 30), time(23, 59)),
+    }
+
+def assert_means_equal(test_case, means, expected_means):
+    if expected_means is None:
+        test_case.assertEqual(means, None)
+        return
+    test_case.assertEqual(sorted(means), sorted(expected_means))
+    for mean_name, expected_mean in expected_means.iteritems():
+        if isinstance(expected_mean, float):
+            test_case.assertAlmostEqual(means[mean_name], expected_mean)
+        else:
+            test_case.assertEqual(means[mean_name], expected_mean)
+
+class TripSummaryTableTest(routing_fixtures.FakeServerTestCase):
+    def setUp(self):
+        routing_fixtures.FakeServerTestCase.setUp(self)
+        self.trips_by_id = routing_fixtures.make_trips(60)
+        self.trip_req_start_dts = dict((trip_id, trip[Trip.START_DTIME]) \
+            for trip_id, trip in self.trips_by_id.iteritems())
+        routing_fixtures.route_trips(self.server_url, self.trips_by_id,
+            self.tmp_dir)
+        self.graph_name = sorted(routing_fixtures.GRAPH_SPECS)[0]
+
+    def load_results(self):
+        return trip_itins_io.load_trip_itineraries(self.tmp_dir,
+            [self.graph_name])[self.graph_name]
+
+    def get_table(self, trip_results):
+        return trip_summary_table.get_summary_table(self.tmp_dir,
+            self.graph_name, trip_results, self.trips_by_id,
+            self.trip_req_start_dts)
+
+    def test_saved_table_reused(self):
+        trip_results = self.load_results()
+        table = self.get_table(trip_results)
+        self.assertTrue(table.results_signature)
+        loaded_table = trip_summary_table.load_summary_table(self.tmp_dir,
+            self.graph_name)
+        self.assertEqual(loaded_table.results_signature,
+            table.results_signature)
+        self.assertEqual(self.get_table(trip_results).trip_ids.tolist(),
+            table.trip_ids.tolist())
+
+    def test_rebuilt_when_same_trips_rerouted(self):
+        trip_results = self.load_results()
+        table = self.get_table(trip_results)
+        trip_id = table.trip_ids[0]
+        # Save a different result for the same trip.
+        itin_json = trip_results[trip_id].json
+        itin_json['walkTime'] += 10000
+        TripItinerary.TripItinerary(itin_json).save_to_file(
+            os.path.join(self.tmp_dir, self.graph_name, trip_id + ".json"))
+        trip_results = self.load_results()
+        new_table = self.get_table(trip_results)
+        self.assertNotEqual(new_table.results_signature,
+            table.results_signature)
+        row = new_table.get_rows([trip_id])[0]
+        self.assertEqual(new_table.get_col('walk_s')[row],
+            table.get_col('walk_s')[row] + 10000)
+
+    @unittest.skipIf(trip_analysis is None, "trip_analysis needs osgeo")
+    def test_means_match_trip_analysis(self):
+        trip_results = dict((trip_id, itin) for trip_id, itin \
+            in self.load_results().iteritems() if itin)
+        table = self.get_table(trip_results)
+        assert_means_equal(self, trip_summary_table.calc_means(table),
+            trip_analysis.calc_means(trip_results, self.trips_by_id,
+                self.trip_req_start_dts))
+        for calc_means_name in ['calc_means_by_first_non_walk_mode',
+                'calc_means_by_agencies_used']:
+            means_by_cat = getattr(trip_summary_table, calc_means_name)(table)
+            expected_means_by_cat = getattr(trip_analysis, calc_means_name)(
+                trip_results, self.trips_by_id, self.trip_req_start_dts)
+            self.assertEqual(sorted(means_by_cat),
+                sorted(expected_means_by_cat))
+            for cat, expected_means in expected_means_by_cat.iteritems():
+                assert_means_equal(self, means_by_cat[cat], expected_means)
+        means_by_dep_time = trip_summary_table.calc_means_by_dep_times(table,
+            DEP_TIME_CATS)
+        for cat, expected_means in trip_analysis.calc_means_by_dep_times(
+                trip_results, self.trips_by_id, self.trip_req_start_dts,
+                DEP_TIME_CATS).iteritems():
+            assert_means_equal(self, means_by_dep_time[cat], expected_means)
+
+if __name__ == "__main__":
+    unittest.main()
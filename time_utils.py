@@ -2,6 +2,13 @@
 def get_total_sec(td):
     return td.days * 24 * 3600 + td.seconds + td.microseconds / float(10**6)
 
+def is_in_dep_time_range(trip_start_dt, dep_time_info):
+    """dep_time_info is a tuple of a list of weekdays (0 for Monday), a
+    start time, and an (exclusive) end time."""
+    return trip_start_dt.weekday() in dep_time_info[0] \
+        and trip_start_dt.time() >= dep_time_info[1] \
+        and trip_start_dt.time() < dep_time_info[2]
+
 def get_total_mins(td):
     return get_total_sec(td) / 60.0
 
@@ -3,6 +3,7 @@ import csv
 import os, os.path
 from datetime import timedelta
 import itertools
+import math
 import operator
 import json
 import copy
@@ -61,7 +62,7 @@ def calc_mean_total_time(trip_itins, trip_req_start_dts):
 def calc_mean_basic_itin_attr(trip_itins, itin_attr):
     """Convenience function."""
     sum_val = sum(itertools.imap(
-        lambda ti: ti.json[itin_attr], trip_itins.itervalues()))
+        lambda ti: ti.get_itin_attr(itin_attr), trip_itins.itervalues()))
     mean = sum_val / float(len(trip_itins))
     return mean
 
@@ -85,7 +86,9 @@ def calc_mean_tfer_waits(trip_itins):
     return timedelta(seconds=mean_sec)
 
 def calc_mean_walk_dist_km(trip_itins):
-    return calc_mean_basic_itin_attr(trip_itins, 'walkDistance') / 1000.0
+    sum_val = sum(itertools.imap(
+        lambda ti: ti.get_walk_dist_m(), trip_itins.itervalues()))
+    return sum_val / float(len(trip_itins)) / 1000.0
 
 def calc_mean_transfers(trip_itins):
     # Can't use the standard mean-calculating algorithm here :- since OTP
@@ -93,7 +96,7 @@ def calc_mean_transfers(trip_itins):
     # only one transfer. We want to use zero for pure-walk trips for this mean
     # calculation, so adjust.
     tfer_vals = itertools.imap(
-        lambda ti: ti.json['transfers'], trip_itins.itervalues())
+        lambda ti: ti.get_transfers(), trip_itins.itervalues())
     tfer_vals_adjust = itertools.imap(
         lambda tval: tval if tval >= 0 else 0, tfer_vals)
     mean = sum(tfer_vals_adjust) / float(len(trip_itins))
@@ -245,6 +248,157 @@ def calc_means(trip_results, trips_by_id, trip_req_start_dts):
     means['transfers'] = calc_mean_transfers(trip_results)
     return means
 
+class MeansAccumulator:
+    """Running sums of the values calc_means() averages, added one trip at a
+    time:- so means can be calculated over a stream of results without
+    keeping them all in memory."""
+
+    def __init__(self):
+        self.n_trips = 0
+        self.sum_total_sec = 0
+        self.sum_init_wait = timedelta(0)
+        self.sum_tfer_wait = timedelta(0)
+        self.sum_direct_speed = 0
+        self.sum_dist_direct = 0
+        self.sum_dist_travelled = 0
+        self.sum_walk_dist = 0
+        self.sum_transfers = 0
+
+    def add(self, trip, trip_req_start_dt, trip_itin):
+        self.add_values(calc_trip_mean_values(trip, trip_req_start_dt,
+            trip_itin))
+
+    def add_values(self, trip_values):
+        """trip_values is a tuple, as returned by calc_trip_mean_values()."""
+        total_sec, init_wait, tfer_wait, direct_speed, dist_direct, \
+            dist_travelled, walk_dist, transfers = trip_values
+        self.n_trips += 1
+        self.sum_total_sec += total_sec
+        self.sum_init_wait += init_wait
+        self.sum_tfer_wait += tfer_wait
+        self.sum_direct_speed += direct_speed
+        self.sum_dist_direct += dist_direct
+        self.sum_dist_travelled += dist_travelled
+        self.sum_walk_dist += walk_dist
+        self.sum_transfers += transfers
+
+    def get_means(self):
+        """Returns the means in the same form as calc_means(), or None if no
+        trips have been added."""
+        if self.n_trips == 0:
+            return None
+        n_trips = float(self.n_trips)
+        means = {}
+        means['n trips'] = self.n_trips
+        means['total time'] = timedelta(
+            seconds=self.sum_total_sec / n_trips)
+        means['init wait'] = timedelta(
+            seconds=time_utils.get_total_sec(self.sum_init_wait) / n_trips)
+        means['tfer wait'] = timedelta(
+            seconds=time_utils.get_total_sec(self.sum_tfer_wait) / n_trips)
+        means['direct speed (kph)'] = self.sum_direct_speed / n_trips
+        means['dist direct (km)'] = self.sum_dist_direct / 1000.0 / n_trips
+        means['dist travelled (km)'] = \
+            self.sum_dist_travelled / 1000.0 / n_trips
+        means['walk dist (km)'] = self.sum_walk_dist / n_trips / 1000.0
+        means['transfers'] = self.sum_transfers / n_trips
+        return means
+
+def calc_trip_mean_values(trip, trip_req_start_dt, trip_itin):
+    """Returns a tuple of one trip's values that MeansAccumulator sums."""
+    return (trip_itin.get_total_trip_sec(trip_req_start_dt),
+        trip_itin.get_init_wait_td(trip_req_start_dt),
+        trip_itin.get_tfer_wait_td(),
+        calc_trip_speed_direct(trip, trip_req_start_dt, trip_itin),
+        calc_trip_direct_dist_km(trip),
+        trip_itin.get_dist_travelled(),
+        trip_itin.get_walk_dist_m(),
+        # Pure-walk trips have transfers of -1 :- see calc_mean_transfers().
+        max(trip_itin.get_transfers(), 0))
+
+def calc_means_streaming(trip_itins_iter, trips_by_id, trip_req_start_dts,
+        categorisers):
+    """Calculates means of trip results in one pass over trip_itins_iter
+    (an iterable of (trip_id, trip_itin), such as
+    trip_itins_io.iter_trip_itineraries()), keeping only running sums.
+
+    categorisers is a dict of names to functions taking a trip ID and
+    itinerary, and returning a list of the categories that trip is in.
+    Returns a dict of those names to dicts of categories to means (as
+    calc_means() returns)."""
+    accums = dict((cat_name, {}) for cat_name in categorisers)
+    for trip_id, trip_itin in trip_itins_iter:
+        trip_values = calc_trip_mean_values(trips_by_id[trip_id],
+            trip_req_start_dts[trip_id], trip_itin)
+        for cat_name, categorise in categorisers.iteritems():
+            cat_accums = accums[cat_name]
+            for category in categorise(trip_id, trip_itin):
+                if category not in cat_accums:
+                    cat_accums[category] = MeansAccumulator()
+                cat_accums[category].add_values(trip_values)
+    means_by_cats = {}
+    for cat_name, cat_accums in accums.iteritems():
+        means_by_cats[cat_name] = dict((category, accum.get_means()) \
+            for category, accum in cat_accums.iteritems())
+    return means_by_cats
+
+ALL_TRIPS_CATEGORY = 'all'
+
+def categorise_all_trips(trip_id, trip_itin):
+    return [ALL_TRIPS_CATEGORY]
+
+def categorise_by_first_non_walk_mode(trip_id, trip_itin):
+    first_non_walk_mode = trip_itin.get_first_non_walk_mode()
+    if first_non_walk_mode:
+        return [first_non_walk_mode]
+    return []
+
+def categorise_by_agencies_used(trip_id, trip_itin):
+    return [tuple(sorted(list(trip_itin.get_set_of_agencies_used())))]
+
+def make_dep_times_categoriser(trip_req_start_dts, dep_time_cats):
+    def categorise_by_dep_times(trip_id, trip_itin):
+        trip_start_dt = trip_req_start_dts[trip_id]
+        return [dep_time_cat for dep_time_cat, dt_info \
+            in dep_time_cats.iteritems() \
+            if time_utils.is_in_dep_time_range(trip_start_dt, dt_info)]
+    return categorise_by_dep_times
+
+def calc_all_means_streaming(trip_itins_iter, trips_by_id,
+        trip_req_start_dts, dep_time_cats=None):
+    """Calculates, in one pass over trip_itins_iter, the means of the
+    results overall, by first non-walk mode, by agencies used, and (if
+    dep_time_cats is given) by departure times. Returns a dict of these,
+    keyed 'overall', 'by_first_nonwalk_mode', 'by_agencies_used' and
+    'by_deptime', each in the same form as calc_means(),
+    calc_means_by_first_non_walk_mode(), calc_means_by_agencies_used() and
+    calc_means_by_dep_times() return."""
+    categorisers = {
+        'overall': categorise_all_trips,
+        'by_first_nonwalk_mode': categorise_by_first_non_walk_mode,
+        'by_agencies_used': categorise_by_agencies_used,
+        }
+    if dep_time_cats is not None:
+        categorisers['by_deptime'] = make_dep_times_categoriser(
+            trip_req_start_dts, dep_time_cats)
+    means_by_cats = calc_means_streaming(trip_itins_iter, trips_by_id,
+        trip_req_start_dts, categorisers)
+
+    all_means = {}
+    all_means['overall'] = \
+        means_by_cats['overall'].get(ALL_TRIPS_CATEGORY)
+    all_means['by_first_nonwalk_mode'] = {}
+    for mode in otp_config.OTP_NON_WALK_MODES:
+        all_means['by_first_nonwalk_mode'][mode] = \
+            means_by_cats['by_first_nonwalk_mode'].get(mode)
+    all_means['by_agencies_used'] = means_by_cats['by_agencies_used']
+    if dep_time_cats is not None:
+        all_means['by_deptime'] = {}
+        for dep_time_cat in dep_time_cats.iterkeys():
+            all_means['by_deptime'][dep_time_cat] = \
+                means_by_cats['by_deptime'].get(dep_time_cat)
+    return all_means
+
 def calc_save_trip_info_by_mode_agency_route(trip_itins, trip_req_start_dts, output_fname):
 
     trips_by_mar, trips_by_mar_legs = \
@@ -277,6 +431,7 @@ def calc_save_trip_info_by_mode_agency_route(trip_itins, trip_req_start_dts, out
                 sum_duration = 0
                 sum_speeds_km_h = 0
                 valid_speeds_cnt = 0
+                n_legs_missing_dist = 0
                 mean_wait_min = 0
                 sum_wait = timedelta(seconds=0)
                 for trip_id, trip_itin in trip_itins.iteritems():
@@ -284,13 +439,19 @@ def calc_save_trip_info_by_mode_agency_route(trip_itins, trip_req_start_dts, out
                     leg_is = trips_by_mar_legs[mode][agency][route][trip_id] 
                     sum_legs += len(leg_is)
                     for leg_i in leg_is:
-                        leg_dist_m = trip_itin.json['legs'][leg_i]['distance'] 
-                        leg_time_s = trip_itin.json['legs'][leg_i]['duration'] \
-                            / 1000.0
+                        leg_dist_m = trip_itin.get_leg_dist_m(leg_i)
+                        leg_time_s = trip_itin.get_leg_duration_sec(leg_i)
                         wait = trip_itin.get_transfer_wait_before_leg(leg_i, 
                             trip_req_start_dt)
                         sum_wait += wait
+                        # Legs OTP gave no distance or duration for (NaN)
+                        # are left out of the sums.
+                        if math.isnan(leg_dist_m):
+                            n_legs_missing_dist += 1
+                            continue
                         sum_dist += leg_dist_m
+                        if math.isnan(leg_time_s):
+                            continue
                         sum_duration += leg_time_s
                         if leg_time_s > 0:
                             leg_speed_km_h = (leg_dist_m / 1000.0) \
@@ -299,13 +460,16 @@ def calc_save_trip_info_by_mode_agency_route(trip_itins, trip_req_start_dts, out
                             valid_speeds_cnt += 1
                 sum_dist_km = sum_dist / 1000.0            
                 sum_wait_min = time_utils.get_total_mins(sum_wait)
+                if sum_legs > n_legs_missing_dist:
+                    avg_dist_km = sum_dist \
+                        / float(sum_legs - n_legs_missing_dist) / 1000.0
+                else:
+                    avg_dist_km = 0
                 if sum_legs:
-                    avg_dist_km = sum_dist / float(sum_legs) / 1000.0    
                     mean_wait_min = sum_wait_min / float(sum_legs)
                 else:
-                    # Putting these to zero in the case of this route not
+                    # Putting this to zero in the case of this route not
                     # being used at all.
-                    avg_dist_km = 0
                     mean_wait_min = 0
                 if valid_speeds_cnt:
                     mean_valid_speed_km_h = sum_speeds_km_h / float(valid_speeds_cnt)
@@ -7,6 +7,7 @@ from osgeo import ogr, osr
 
 from pyOTPA import geom_utils
 from pyOTPA import otp_config
+from pyOTPA import time_utils
 from pyOTPA import Trip
 from pyOTPA.Trips_Generator import abs_zone_io
 
@@ -40,10 +41,8 @@ def get_results_in_dep_time_range(trip_results, trip_req_start_dts,
         dep_time_info):
     trip_results_subset = {}
     for trip_id, trip_result in trip_results.iteritems():
-        trip_start_dt = trip_req_start_dts[trip_id]
-        if trip_start_dt.weekday() in dep_time_info[0] \
-                and trip_start_dt.time() >= dep_time_info[1] \
-                and trip_start_dt.time() < dep_time_info[2]:
+        if time_utils.is_in_dep_time_range(trip_req_start_dts[trip_id],
+                dep_time_info):
             trip_results_subset[trip_id] = trip_result
     return trip_results_subset
 
@@ -158,15 +157,11 @@ def categorise_trip_ids_by_mode_agency_route(trip_itins):
         trips_by_mar[mode] = {}
         trips_by_mar_legs[mode] = {}
     for trip_id, trip_itin in trip_itins.iteritems():
-        legs = trip_itin.json['legs']
-        for leg_i, leg in enumerate(legs):
-            mode = leg['mode']
+        for leg_i in range(trip_itin.get_n_legs()):
+            mode = trip_itin.get_leg_mode(leg_i)
             if mode == otp_config.OTP_WALK_MODE: continue
-            a_name = leg['agencyName']
-            r_id = leg['routeId']
-            r_s_name = leg['routeShortName']
-            r_l_name = leg['routeLongName']
-            r_tup = (r_id, r_s_name, r_l_name)
+            a_name = trip_itin.get_leg_agency(leg_i)
+            r_tup = trip_itin.get_leg_route(leg_i)
             if a_name not in trips_by_mar[mode]:
                 trips_by_mar[mode][a_name] = {}
                 trips_by_mar_legs[mode][a_name] = {}
@@ -1,9 +1,14 @@
 
 import os, os.path
 import sys
-import glob
+import json
+import multiprocessing
 
 import TripItinerary
+import itin_store
+import itin_codec
+import result_files
+import time_utils
 
 # min size:- percent to use
 LOAD_STATUS_PRINT_PERCENTS = [
@@ -13,7 +18,16 @@ LOAD_STATUS_PRINT_PERCENTS = [
     (100000, 1),
     ]
 
-def save_trip_itineraries(output_base_dir, trip_results_by_graph):
+# Number of results each process loads at a time, when loading in parallel.
+LOAD_CHUNK_SIZE = 500
+
+def save_trip_itineraries(output_base_dir, trip_results_by_graph,
+        use_store=False, compress=False, hashed_dirs=False):
+    """Saves each graph's itineraries to a subdir named after the graph:-
+    in a file per trip (in the result_files hashed layout, if hashed_dirs),
+    or if use_store, appended to an itin_store there. If compress, they're
+    saved zlib-compressed (with the itin_codec dictionary saved in the
+    subdir, if any)."""
     print "\nSaving trip itinerary results to base dir %s:" % output_base_dir
     if not os.path.exists(output_base_dir):
         os.makedirs(output_base_dir)
@@ -22,71 +36,246 @@ def save_trip_itineraries(output_base_dir, trip_results_by_graph):
         subdir = os.path.join(output_base_dir, graph_name)
         if not os.path.exists(subdir):
             os.makedirs(subdir)
-        for trip_id, trip_itin in trip_results.iteritems():
-            fname = os.path.join(subdir, "%s.json" % trip_id)
-            if trip_itin:
-                trip_itin.save_to_file(fname)
-                saved_valid_cnt += 1
+        zdict = None
+        if compress:
+            zdict = itin_codec.get_writing_zdict(subdir)
+        store_writer = None
+        if use_store:
+            store_writer = itin_store.ItinStoreWriter(subdir,
+                compress=compress, zdict=zdict)
+        for trip_id, trip_itin in sorted(trip_results.iteritems()):
+            if not trip_itin:
+                continue
+            if store_writer:
+                store_writer.append(trip_id, trip_itin, flush=False)
+            else:
+                fname = result_files.make_result_fname(subdir, trip_id,
+                    hashed_dirs)
+                trip_itin.save_to_file(fname, compress, zdict)
+            saved_valid_cnt += 1
+        if store_writer:
+            store_writer.close()
         print "...saved %d valid results (out of %d trip reqs) on "\
             "graph '%s' to dir %s ." \
             % (saved_valid_cnt, len(trip_results), graph_name, subdir)
     return
 
 def read_graph_names(output_base_dir):
-    # Calculate these based on all sub-directories of output dir.
+    # Calculate these based on all sub-directories of output dir:- except
+    # those named with a leading '_' or '.', which hold other run state
+    # (e.g. sharding's lease files), not results.
     graph_names = []
     for entry in os.listdir(output_base_dir):
+        if entry.startswith('_') or entry.startswith('.'):
+            continue
         if os.path.isdir(os.path.join(output_base_dir, entry)):
             graph_names.append(entry)
     return graph_names
 
-def load_trip_itineraries(output_base_dir, graph_names=None):
+def iter_trip_itineraries(output_base_dir, graph_name, trip_ids=None,
+        trip_req_start_dts=None, dep_time_info=None):
+    """Generator of (trip_id, itin) for the itineraries saved for
+    graph_name, reading and decoding them one at a time:- so unlike
+    load_trip_itineraries(), memory use doesn't grow with the number of
+    results, as long as the consumer doesn't keep them.
+
+    Results saved in files are given in trip ID order, and those in an
+    itin_store in the order they're stored (so segments are read through
+    sequentially):- either way, the same order each time for the same saved
+    results.
+
+    If trip_ids (a set) is given, only those trips are read. If
+    dep_time_info is given (a tuple of a list of weekdays, a start time and
+    an end time, as in trip_itin_filters.get_results_in_dep_time_range()),
+    only trips whose requested start in trip_req_start_dts is in that
+    range are read."""
+    subdir = os.path.join(output_base_dir, graph_name)
+
+    def is_wanted(trip_id):
+        if trip_ids is not None and trip_id not in trip_ids:
+            return False
+        if dep_time_info is not None and not time_utils.is_in_dep_time_range(
+                trip_req_start_dts[trip_id], dep_time_info):
+            return False
+        return True
+
+    if itin_store.has_store(subdir):
+        store_reader = itin_store.ItinStoreReader(subdir)
+        try:
+            entries = sorted(store_reader.index.itervalues(),
+                key=lambda entry: (entry.segment_fname, entry.offset))
+            for entry in entries:
+                if is_wanted(entry.trip_id):
+                    yield entry.trip_id, TripItinerary.TripItinerary(
+                        json.loads(store_reader.read_json_str(entry.trip_id)))
+        finally:
+            store_reader.close()
+        return
+
+    fnames_by_trip_id = result_files.get_result_fnames(subdir)
+    if not fnames_by_trip_id:
+        print "Warning:- no trip results found in dir %s." % (subdir)
+    for trip_id in sorted(fnames_by_trip_id.iterkeys()):
+        if is_wanted(trip_id):
+            yield trip_id, TripItinerary.read_trip_itin_from_file(
+                fnames_by_trip_id[trip_id])
+
+def _get_load_print_increment(n_results):
+    print_pct = LOAD_STATUS_PRINT_PERCENTS[0]
+    pct_cat_ii = 0
+    while pct_cat_ii < len(LOAD_STATUS_PRINT_PERCENTS) \
+            and n_results > LOAD_STATUS_PRINT_PERCENTS[pct_cat_ii][0]:
+        print_pct = LOAD_STATUS_PRINT_PERCENTS[pct_cat_ii][1] 
+        pct_cat_ii += 1
+
+    load_count_print_inc = print_pct / 100.0 \
+        * n_results
+    return max(1, load_count_print_inc)
+
+def _iter_itins_with_progress(itins_iter, n_results):
+    """Passes on the (trip_id, itin) pairs of itins_iter, printing progress
+    as they're loaded."""
+    load_count_print_inc = _get_load_print_increment(n_results)
+    next_print_cnt = load_count_print_inc
+    for ii, trip_id_itin in enumerate(itins_iter):
+        yield trip_id_itin
+        loaded_cnt = ii + 1
+        if loaded_cnt > next_print_cnt:
+            while loaded_cnt > next_print_cnt:
+                next_print_cnt += load_count_print_inc
+            loaded_pct = loaded_cnt / float(n_results) * 100.0
+            print "  ...loaded %d results (%.2f %% of total)" \
+                % (loaded_cnt, loaded_pct)    
+
+def _iter_itins_from_files(trip_result_files):
+    for fname in trip_result_files:
+        fbase = os.path.basename(fname)
+        trip_id = os.path.splitext(fbase)[0]
+        itin = TripItinerary.read_trip_itin_from_file(fname, keep_json=False)
+        yield trip_id, itin
+
+def _load_result_files_chunk(trip_result_files):
+    """Worker function for loading in parallel:- returns (trip_id,
+    itinerary) for each file."""
+    results = []
+    for fname in trip_result_files:
+        trip_id = os.path.splitext(os.path.basename(fname))[0]
+        results.append((trip_id, TripItinerary.read_trip_itin_from_file(
+            fname, keep_json=False)))
+    return results
+
+def _load_store_chunk(graph_dir_and_entries):
+    """Worker function for loading in parallel:- returns (trip_id,
+    itinerary) for each of the itin_store index entries."""
+    graph_dir, entries = graph_dir_and_entries
+    segment_files = {}
+    results = []
+    for trip_id, segment_fname, offset, length in entries:
+        segment_file = segment_files.get(segment_fname)
+        if segment_file is None:
+            segment_file = open(os.path.join(graph_dir, segment_fname), 'rb')
+            segment_files[segment_fname] = segment_file
+        segment_file.seek(offset)
+        itin_json = json.loads(itin_codec.decode_itin_json_str(
+            segment_file.read(length), graph_dir))
+        results.append((trip_id, itin_store.make_lazy_itin(graph_dir,
+            itin_store.IndexEntry(trip_id, segment_fname, offset, length),
+            itin_json)))
+    for segment_file in segment_files.itervalues():
+        segment_file.close()
+    return results
+
+def _iter_itins_in_parallel(worker_pool, load_chunk_func, chunks):
+    for chunk_results in worker_pool.imap(load_chunk_func, chunks):
+        for trip_id, itin in chunk_results:
+            yield trip_id, itin
+
+def _split_into_chunks(items, chunk_size=LOAD_CHUNK_SIZE):
+    return [items[ii:ii+chunk_size] for ii in range(0, len(items),
+        chunk_size)]
+
+def load_trip_itineraries(output_base_dir, graph_names=None, lazy=False,
+        n_processes=1):
+    """Loads the itineraries saved in the subdir for each graph (from an
+    itin_store, if the subdir has one, otherwise from a file per trip).
+
+    With lazy, the results for graphs with an itin_store are returned as an
+    itin_store.MappedItinStore, rather than a dict:- so itineraries are
+    only read from the store as they're looked up.
+
+    With n_processes above 1, results are read and decoded by a pool of
+    this many processes, each loading chunks of LOAD_CHUNK_SIZE results.
+
+    Loaded itineraries don't keep their JSON data, but re-read it from
+    their file or the store when it's used (see TripItinerary). Results
+    saved compressed or not are both read."""
     print "\nLoading trip itinerary results from base dir %s:" \
         % output_base_dir
     trip_results_by_graph = {}
     if not graph_names:
         graph_names = read_graph_names(output_base_dir)
+    worker_pool = None
+    if n_processes > 1:
+        worker_pool = multiprocessing.Pool(n_processes)
 
     for graph_name in graph_names:
         print "Loading results for graph %s" % graph_name
         trip_results = {}
         subdir = os.path.join(output_base_dir, graph_name)
-        trip_result_files = glob.glob("%s%s*.json" % (subdir, os.sep))
-        if len(trip_result_files) == 0:
+        store_reader = None
+        if lazy and itin_store.has_store(subdir):
+            trip_results = itin_store.MappedItinStore(subdir)
+            if len(trip_results) == 0:
+                print "Error:- no trip results found in dir %s." % (subdir)
+                sys.exit(1)
+            print "Mapped the %d results in the itinerary store in this "\
+                "directory, to be read as needed." % len(trip_results)
+            trip_results_by_graph[graph_name] = trip_results
+            continue
+        if itin_store.has_store(subdir):
+            store_reader = itin_store.ItinStoreReader(subdir)
+            n_results = len(store_reader)
+            if worker_pool:
+                entries = [(entry.trip_id, entry.segment_fname, entry.offset,
+                    entry.length) for entry in sorted(
+                        store_reader.index.itervalues(),
+                        key=lambda entry: (entry.segment_fname, entry.offset))]
+                itins_iter = _iter_itins_in_parallel(worker_pool,
+                    _load_store_chunk, [(subdir, chunk) for chunk \
+                        in _split_into_chunks(entries)])
+            else:
+                itins_iter = store_reader.iter_itins()
+            print "Found %d results in the itinerary store in this "\
+                "directory." % n_results
+        else:
+            trip_result_files = \
+                result_files.get_result_fnames(subdir).values()
+            n_results = len(trip_result_files)
+            if worker_pool:
+                itins_iter = _iter_itins_in_parallel(worker_pool,
+                    _load_result_files_chunk,
+                    _split_into_chunks(trip_result_files))
+            else:
+                itins_iter = _iter_itins_from_files(trip_result_files)
+            if n_results:
+                print "Found %d result files in this directory." % \
+                    n_results
+        if n_results == 0:
             print "Error:- no trip results found in dir %s." % (subdir)
+            if worker_pool:
+                worker_pool.terminate()
             sys.exit(1)
-        else:
-            print "Found %d result files in this directory." % \
-                len(trip_result_files)
-
-        n_results = len(trip_result_files)
-        print_pct = LOAD_STATUS_PRINT_PERCENTS[0]
-        pct_cat_ii = 0
-        while pct_cat_ii < len(LOAD_STATUS_PRINT_PERCENTS) \
-                and n_results > LOAD_STATUS_PRINT_PERCENTS[pct_cat_ii][0]:
-            print_pct = LOAD_STATUS_PRINT_PERCENTS[pct_cat_ii][1] 
-            pct_cat_ii += 1
-
-        load_count_print_inc = print_pct / 100.0 \
-            * n_results
-        load_count_print_inc = max(1, load_count_print_inc)
-        next_print_cnt = load_count_print_inc
-        for ii, fname in enumerate(trip_result_files):
-            fbase = os.path.basename(fname)
-            trip_id = os.path.splitext(fbase)[0]
-            itin = TripItinerary.read_trip_itin_from_file(fname)
+
+        for trip_id, itin in _iter_itins_with_progress(itins_iter,
+                n_results):
             trip_results[trip_id] = itin
-            loaded_cnt = ii + 1
-            if loaded_cnt > next_print_cnt:
-                while loaded_cnt > next_print_cnt:
-                    next_print_cnt += load_count_print_inc
-                loaded_pct = loaded_cnt / float(len(trip_result_files)) * 100.0
-                print "  ...loaded %d results (%.2f %% of total)" \
-                    % (loaded_cnt, loaded_pct)    
-
-                
+        if store_reader:
+            store_reader.close()
         trip_results_by_graph[graph_name] = trip_results
         print "...loaded %d results on graph '%s' from dir %s ." \
             % (len(trip_results), graph_name, subdir)
+    if worker_pool:
+        worker_pool.close()
+        worker_pool.join()
     return trip_results_by_graph
 
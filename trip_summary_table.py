@@ -0,0 +1,323 @@
+"""A compact, columnar summary of the trip results routed on one graph:- a
+NumPy array per summary value (total time, waits, distances, transfers,
+first non-walk mode etc), with a row per trip.
+
+Extracting these values means decoding and walking each trip's itinerary,
+which the analyses in trip_analysis otherwise do again for every subset
+and category of trips they calculate means over. A TripSummaryTable is
+built in a single pass over the itineraries, and saved in the results dir
+(see get_summary_table()), after which means over any subset of trips are
+a few array operations on the subset's rows.
+
+The calc_means*() functions here return the same values as those of the
+same names in trip_analysis, so can be used in their place.
+"""
+
+import os, os.path
+import time
+import json
+import hashlib
+from datetime import timedelta
+
+import numpy
+
+from pyOTPA import Trip
+from pyOTPA import geom_utils
+from pyOTPA import otp_config
+from pyOTPA import time_utils
+
+SUMMARY_FNAME_TEMPLATE = "trip_summary-%s.npz"
+
+# Code used in the first_non_walk_mode column for walk-only trips.
+NO_MODE_CODE = -1
+
+# The summary columns, and their array types. Times are in seconds,
+# distances in metres. transfers is as given by OTP (-1 for walk-only
+# trips), first_non_walk_mode is an index into otp_config.OTP_MODES, and
+# agency_set an index into the table's agency_sets.
+COLUMN_TYPES = [
+    ('req_start_s', numpy.float64),
+    ('dep_weekday', numpy.int8),
+    ('dep_time_of_day_s', numpy.int32),
+    ('total_s', numpy.float64),
+    ('init_wait_s', numpy.float64),
+    ('tfer_wait_s', numpy.float64),
+    ('walk_s', numpy.float64),
+    ('transit_s', numpy.float64),
+    ('dist_direct_m', numpy.float64),
+    ('dist_travelled_m', numpy.float64),
+    ('walk_dist_m', numpy.float64),
+    ('longest_walk_leg_m', numpy.float64),
+    ('transfers', numpy.int16),
+    ('first_non_walk_mode', numpy.int8),
+    ('agency_set', numpy.int32),
+    ]
+COLUMN_NAMES = [col_name for col_name, col_type in COLUMN_TYPES]
+
+def _get_epoch_sec(dt):
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+class TripSummaryTable:
+    """Summary values of a set of trip results:- trip_ids is an array of
+    the trips' IDs, and columns a dict of each column's array of values, in
+    the same order. agency_sets is the list of (sorted) tuples of agencies
+    used that the agency_set column indexes into."""
+
+    def __init__(self, trip_ids, columns, agency_sets,
+            results_signature=None):
+        self.trip_ids = trip_ids
+        self.columns = columns
+        self.agency_sets = agency_sets
+        # Of the saved results it was built from (see
+        # get_results_signature()), if known.
+        self.results_signature = results_signature
+        self._rows_by_trip_id = None
+
+    def __len__(self):
+        return len(self.trip_ids)
+
+    def get_rows(self, trip_ids):
+        """Returns an array of the row numbers of the given trips."""
+        if self._rows_by_trip_id is None:
+            self._rows_by_trip_id = dict((trip_id, row) for row, trip_id \
+                in enumerate(self.trip_ids))
+        return numpy.array([self._rows_by_trip_id[trip_id] \
+            for trip_id in trip_ids], dtype=numpy.int64)
+
+    def get_col(self, col_name, rows=None):
+        """Returns a column's values (just for the given rows, if set)."""
+        if rows is None:
+            return self.columns[col_name]
+        return self.columns[col_name][rows]
+
+    def matches_req_start_dts(self, trip_req_start_dts):
+        """Returns whether the table was built for the same trip request
+        times as in trip_req_start_dts (the table's time values depend on
+        them)."""
+        req_start_s = numpy.array([_get_epoch_sec(
+            trip_req_start_dts[trip_id]) for trip_id in self.trip_ids],
+            dtype=numpy.float64)
+        return numpy.array_equal(req_start_s, self.columns['req_start_s'])
+
+def build_summary_table(trip_results, trips_by_id, trip_req_start_dts):
+    """Builds a TripSummaryTable of the trips in trip_results (a dict of
+    trip ID to TripItinerary), making one pass over the itineraries. Rows
+    are in trip ID order."""
+    trip_ids = sorted(trip_results.iterkeys())
+    n_trips = len(trip_ids)
+    columns = {}
+    for col_name, col_type in COLUMN_TYPES:
+        columns[col_name] = numpy.zeros(n_trips, dtype=col_type)
+    mode_codes = dict((mode, code) for code, mode \
+        in enumerate(otp_config.OTP_MODES))
+    agency_sets = []
+    agency_set_codes = {}
+    n_trips_missing_dist = 0
+
+    for row, trip_id in enumerate(trip_ids):
+        trip_itin = trip_results[trip_id]
+        trip = trips_by_id[trip_id]
+        req_start_dt = trip_req_start_dts[trip_id]
+        columns['req_start_s'][row] = _get_epoch_sec(req_start_dt)
+        columns['dep_weekday'][row] = req_start_dt.weekday()
+        req_start_time = req_start_dt.time()
+        columns['dep_time_of_day_s'][row] = req_start_time.hour * 3600 \
+            + req_start_time.minute * 60 + req_start_time.second
+        columns['total_s'][row] = trip_itin.get_total_trip_sec(req_start_dt)
+        columns['init_wait_s'][row] = time_utils.get_total_sec(
+            trip_itin.get_init_wait_td(req_start_dt))
+        columns['tfer_wait_s'][row] = time_utils.get_total_sec(
+            trip_itin.get_tfer_wait_td())
+        columns['walk_s'][row] = time_utils.get_total_sec(
+            trip_itin.get_walk_td())
+        columns['transit_s'][row] = time_utils.get_total_sec(
+            trip_itin.get_transit_td())
+        columns['dist_direct_m'][row] = geom_utils.haversine(
+            trip[Trip.ORIGIN][0], trip[Trip.ORIGIN][1],
+            trip[Trip.DEST][0], trip[Trip.DEST][1])
+        columns['walk_dist_m'][row] = trip_itin.get_walk_dist_m()
+        columns['transfers'][row] = trip_itin.get_transfers()
+        columns['dist_travelled_m'][row] = trip_itin.get_dist_travelled()
+        if trip_itin.get_n_legs_missing_dist():
+            n_trips_missing_dist += 1
+        columns['longest_walk_leg_m'][row] = \
+            trip_itin.get_longest_walk_leg_dist_m()
+        first_non_walk_mode = trip_itin.get_first_non_walk_mode()
+        if first_non_walk_mode is None:
+            columns['first_non_walk_mode'][row] = NO_MODE_CODE
+        else:
+            columns['first_non_walk_mode'][row] = \
+                mode_codes[first_non_walk_mode]
+        agency_set = tuple(sorted(trip_itin.get_set_of_agencies_used()))
+        if agency_set not in agency_set_codes:
+            agency_set_codes[agency_set] = len(agency_sets)
+            agency_sets.append(agency_set)
+        columns['agency_set'][row] = agency_set_codes[agency_set]
+
+    if n_trips_missing_dist:
+        print "Warning:- %d of %d trips have legs OTP gave no distance for:- "\
+            "their distances travelled only count the other legs." \
+            % (n_trips_missing_dist, n_trips)
+    return TripSummaryTable(numpy.array(trip_ids), columns, agency_sets)
+
+def get_results_signature(graph_dir):
+    """Returns a digest of the names, sizes and modification times of the
+    files in a graph's results dir (result files, itin_store files,
+    manifests etc):- which changes whenever any result there is saved
+    again, even for the same trips. Returns None if there's no such dir."""
+    if not os.path.isdir(graph_dir):
+        return None
+    file_stats = []
+    for dir_path, dir_names, fnames in os.walk(graph_dir):
+        for fname in fnames:
+            # Skip temp files of results still being written.
+            if fname.endswith(".tmp"):
+                continue
+            full_fname = os.path.join(dir_path, fname)
+            try:
+                stat = os.stat(full_fname)
+            except OSError:
+                continue
+            file_stats.append((os.path.relpath(full_fname, graph_dir),
+                stat.st_size, repr(stat.st_mtime)))
+    file_stats.sort()
+    return hashlib.md5(repr(file_stats)).hexdigest()
+
+def get_summary_fname(output_base_dir, graph_name):
+    return os.path.join(output_base_dir, SUMMARY_FNAME_TEMPLATE % graph_name)
+
+def save_summary_table(table, output_base_dir, graph_name):
+    arrays = dict(table.columns)
+    arrays['trip_ids'] = table.trip_ids
+    # Saved as JSON, since the sets vary in length.
+    arrays['agency_sets'] = numpy.array(json.dumps(table.agency_sets))
+    arrays['modes'] = numpy.array(json.dumps(otp_config.OTP_MODES))
+    arrays['results_signature'] = numpy.array(
+        json.dumps(table.results_signature))
+    numpy.savez(get_summary_fname(output_base_dir, graph_name), **arrays)
+
+def load_summary_table(output_base_dir, graph_name):
+    """Returns the TripSummaryTable saved for graph_name, or None if there
+    isn't one (or it was saved with different mode codes)."""
+    summary_fname = get_summary_fname(output_base_dir, graph_name)
+    if not os.path.exists(summary_fname):
+        return None
+    npz_file = numpy.load(summary_fname)
+    if json.loads(str(npz_file['modes'])) != otp_config.OTP_MODES:
+        npz_file.close()
+        return None
+    columns = {}
+    for col_name in COLUMN_NAMES:
+        columns[col_name] = npz_file[col_name]
+    trip_ids = npz_file['trip_ids']
+    agency_sets = map(tuple, json.loads(str(npz_file['agency_sets'])))
+    results_signature = None
+    if 'results_signature' in npz_file.files:
+        results_signature = json.loads(str(npz_file['results_signature']))
+    npz_file.close()
+    return TripSummaryTable(trip_ids, columns, agency_sets,
+        results_signature)
+
+def get_summary_table(output_base_dir, graph_name, trip_results,
+        trips_by_id, trip_req_start_dts):
+    """Returns the TripSummaryTable of trip_results, loading it from the
+    results dir if saved there already. If it isn't saved yet, or the saved
+    table doesn't match trip_results and trip_req_start_dts, or the graph's
+    saved results have changed since it was built (e.g. since more trips
+    were routed, or the same trips re-routed), it's built, and saved for
+    next time."""
+    results_signature = get_results_signature(
+        os.path.join(output_base_dir, graph_name))
+    table = load_summary_table(output_base_dir, graph_name)
+    if table is not None and results_signature is not None \
+            and table.results_signature == results_signature \
+            and len(table) == len(trip_results) \
+            and all(trip_id in trip_results for trip_id in table.trip_ids) \
+            and table.matches_req_start_dts(trip_req_start_dts):
+        return table
+    table = build_summary_table(trip_results, trips_by_id,
+        trip_req_start_dts)
+    table.results_signature = results_signature
+    save_summary_table(table, output_base_dir, graph_name)
+    return table
+
+########################
+## Analysis
+
+def calc_means(table, rows=None):
+    """Means over the given rows of table (or all its rows), as for
+    trip_analysis.calc_means()."""
+    n_trips = len(table) if rows is None else len(rows)
+    assert n_trips > 0
+    total_s = table.get_col('total_s', rows)
+    dist_direct_m = table.get_col('dist_direct_m', rows)
+    means = {}
+    means['n trips'] = n_trips
+    means['total time'] = timedelta(seconds=float(total_s.mean()))
+    means['init wait'] = timedelta(
+        seconds=float(table.get_col('init_wait_s', rows).mean()))
+    means['tfer wait'] = timedelta(
+        seconds=float(table.get_col('tfer_wait_s', rows).mean()))
+    means['direct speed (kph)'] = float(
+        ((dist_direct_m / 1000.0) / (total_s / (60 * 60.0))).mean())
+    means['dist direct (km)'] = float(dist_direct_m.mean() / 1000.0)
+    means['dist travelled (km)'] = float(
+        table.get_col('dist_travelled_m', rows).mean() / 1000.0)
+    means['walk dist (km)'] = float(
+        table.get_col('walk_dist_m', rows).mean() / 1000.0)
+    # OTP gives walk-only trips -1 transfers, but count these as zero.
+    means['transfers'] = float(numpy.maximum(
+        table.get_col('transfers', rows), 0).mean())
+    return means
+
+def _get_all_rows(table, rows):
+    if rows is None:
+        return numpy.arange(len(table))
+    return numpy.asarray(rows)
+
+def get_rows_in_dep_time_range(table, dep_time_info, rows=None):
+    """Returns those of rows (default all) departing in the weekdays and
+    time range of dep_time_info, as in
+    trip_itin_filters.get_results_in_dep_time_range()."""
+    rows = _get_all_rows(table, rows)
+    weekdays = table.get_col('dep_weekday', rows)
+    dep_time_s = table.get_col('dep_time_of_day_s', rows)
+    start_s = dep_time_info[1].hour * 3600 + dep_time_info[1].minute * 60 \
+        + dep_time_info[1].second
+    end_s = dep_time_info[2].hour * 3600 + dep_time_info[2].minute * 60 \
+        + dep_time_info[2].second
+    in_range = numpy.in1d(weekdays, list(dep_time_info[0])) \
+        & (dep_time_s >= start_s) & (dep_time_s < end_s)
+    return rows[in_range]
+
+def calc_means_by_first_non_walk_mode(table, rows=None):
+    rows = _get_all_rows(table, rows)
+    first_modes = table.get_col('first_non_walk_mode', rows)
+    means_by_first_non_walk_mode = {}
+    for mode in otp_config.OTP_NON_WALK_MODES:
+        mode_rows = rows[first_modes == otp_config.OTP_MODES.index(mode)]
+        if len(mode_rows):
+            means_by_first_non_walk_mode[mode] = calc_means(table, mode_rows)
+        else:
+            means_by_first_non_walk_mode[mode] = None
+    return means_by_first_non_walk_mode
+
+def calc_means_by_agencies_used(table, rows=None):
+    rows = _get_all_rows(table, rows)
+    agency_set_codes = table.get_col('agency_set', rows)
+    means_by_agencies_used = {}
+    for code in numpy.unique(agency_set_codes):
+        means_by_agencies_used[table.agency_sets[code]] = calc_means(table,
+            rows[agency_set_codes == code])
+    return means_by_agencies_used
+
+def calc_means_by_dep_times(table, dep_time_cats, rows=None):
+    means_by_deptime = {}
+    for dep_time_cat, dt_info in dep_time_cats.iteritems():
+        cat_rows = get_rows_in_dep_time_range(table, dt_info, rows)
+        if len(cat_rows):
+            means_by_deptime[dep_time_cat] = calc_means(table, cat_rows)
+        else:
+            # In case there's no results in that time period
+            means_by_deptime[dep_time_cat] = None
+    return means_by_deptime
@@ -0,0 +1,151 @@
+"""Pre-encoded templates of OTP request URLs.
+
+Building a request URL from scratch quotes and joins every routing
+parameter, and formats the date and time, for each request - which for
+runs of millions of requests with the same parameters adds up to a
+noticeable amount of CPU. A template instead encodes everything that stays
+the same across requests (the path, the routing parameters and the router
+ID) once, so only the per-request fields (places, date and time etc) need
+formatting for each URL.
+"""
+
+import urllib2
+
+from pyOTPA import otp_config
+
+WS_BASE_PATH = "/opentripplanner-api-webapp/ws"
+
+# Max number of date/time strings (and templates) to remember, before
+# starting afresh.
+MAX_MEMO_SIZE = 100000
+MAX_TEMPLATES = 1000
+
+_time_param_strs = {}
+_trip_plan_templates = {}
+
+def encode_params(routing_params):
+    return "&".join([name+'='+urllib2.quote(str(val)) for name, val \
+        in routing_params.iteritems()])
+
+def format_place(lon_lat):
+    """OTP takes places as lat,lon."""
+    return str(lon_lat[1]) + ',' + str(lon_lat[0])
+
+def _memo_time_param_str(key, date_str, time_str):
+    time_param_str = date_str + 'T' + urllib2.quote(time_str)
+    if len(_time_param_strs) >= MAX_MEMO_SIZE:
+        _time_param_strs.clear()
+    _time_param_strs[key] = time_param_str
+    return time_param_str
+
+def get_time_param_str(trip_date, trip_time):
+    """Returns the (quoted) value of the time parameter, for the given date
+    and time objects."""
+    key = (trip_date, trip_time)
+    try:
+        return _time_param_strs[key]
+    except KeyError:
+        return _memo_time_param_str(key,
+            trip_date.strftime(otp_config.OTP_DATE_FMT),
+            trip_time.strftime(otp_config.OTP_TIME_FMT))
+
+def get_time_param_str_from_strs(date_str, time_str):
+    """As for get_time_param_str(), given already formatted date and time
+    strings."""
+    key = (date_str, time_str)
+    try:
+        return _time_param_strs[key]
+    except KeyError:
+        return _memo_time_param_str(key, date_str, time_str)
+
+class RequestURLTemplate:
+    """The parts of requests to one of the OTP web service's paths that are
+    the same for every request:- the routing parameters, any other
+    fixed_params (a list of (name, already encoded value) pairs), and the
+    router ID."""
+
+    def __init__(self, ws_path, routing_params, otp_router_id=None,
+            fixed_params=None):
+        self.routing_params = dict(routing_params)
+        self.otp_router_id = otp_router_id
+        self.path_str = WS_BASE_PATH + ws_path + '?'
+        self.params_str = encode_params(routing_params)
+        suffix = ""
+        if fixed_params:
+            for name, val in fixed_params:
+                suffix += '&' + name + '=' + val
+        if otp_router_id is not None:
+            suffix += '&' + 'routerId' + '=' + otp_router_id
+        self.suffix_str = suffix
+
+class TripPlanURLTemplate(RequestURLTemplate):
+    """Template of trip plan requests."""
+
+    def __init__(self, routing_params, otp_router_id=None):
+        RequestURLTemplate.__init__(self, "/plan", routing_params,
+            otp_router_id)
+
+    def build_spec_section(self, trip_date, trip_time, origin_lon_lat,
+            dest_lon_lat):
+        """Returns the query string section specifying the trip (without the
+        router ID)."""
+        return self.params_str \
+            + '&fromPlace=' + format_place(origin_lon_lat) \
+            + '&toPlace=' + format_place(dest_lon_lat) \
+            + '&time=' + get_time_param_str(trip_date, trip_time)
+
+    def build_url(self, server_url, trip_date, trip_time, origin_lon_lat,
+            dest_lon_lat):
+        return server_url + self.path_str \
+            + self.build_spec_section(trip_date, trip_time, origin_lon_lat,
+                dest_lon_lat) \
+            + self.suffix_str
+
+class IsoRasterURLTemplate(RequestURLTemplate):
+    """Template of isochrone raster (WMS) requests, at a given
+    resolution."""
+
+    def __init__(self, routing_params, raster_res, otp_router_id=None):
+        RequestURLTemplate.__init__(self, "/wms", routing_params,
+            otp_router_id, fixed_params=[
+                ('format', "image/geotiff"),
+                ('srs', "EPSG:%d" % otp_config.OTP_ROUTER_EPSG),
+                ('resolution', str(raster_res))])
+
+    def build_url(self, server_url, date_str, time_str, lon_lat, img_bbox):
+        place_str = format_place(lon_lat)
+        return server_url + self.path_str + self.params_str \
+            + '&fromPlace=' + place_str + '&toPlace=' + place_str \
+            + '&time=' + get_time_param_str_from_strs(date_str, time_str) \
+            + '&bbox=' + ','.join(str(ii) for ii in \
+                img_bbox[0] + img_bbox[1]) \
+            + self.suffix_str
+
+class IsoVectorURLTemplate(RequestURLTemplate):
+    """Template of isochrone vector requests."""
+
+    def __init__(self, routing_params, otp_router_id=None):
+        RequestURLTemplate.__init__(self, "/iso", routing_params,
+            otp_router_id)
+
+    def build_url(self, server_url, date_str, time_str, lon_lat,
+            time_radius, vec_type):
+        place_str = format_place(lon_lat)
+        return server_url + self.path_str + self.params_str \
+            + '&fromPlace=' + place_str + '&toPlace=' + place_str \
+            + '&time=' + get_time_param_str_from_strs(date_str, time_str) \
+            + '&walkTime=' + str(time_radius) + '&output=' + vec_type \
+            + self.suffix_str
+
+def get_trip_plan_template(routing_params, otp_router_id=None):
+    """Returns a TripPlanURLTemplate for routing_params and otp_router_id,
+    only building a new one the first time a given params dict and router
+    are used (or if the params dict has been changed since)."""
+    key = (id(routing_params), otp_router_id)
+    template = _trip_plan_templates.get(key)
+    if template is None or template.routing_params != routing_params:
+        template = TripPlanURLTemplate(routing_params, otp_router_id)
+        if len(_trip_plan_templates) >= MAX_TEMPLATES:
+            _trip_plan_templates.clear()
+        _trip_plan_templates[key] = template
+    return template